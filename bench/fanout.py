@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark the CPU time spent per subscriber on notifying of a publish.
+
+A single item is published to a node with many subscribers, and the
+notifications are sent out on an XML stream with a fake transport, that
+counts the writes made to it. This is done with the publish-subscribe
+service of Wokkel, which serializes the items for each subscriber and sends
+each notification on its own, and with that of Idavoll, which serializes
+them once, and buffers the notifications. Idavoll's service is also run
+with a buffer that is flushed for each notification.
+
+Usage: python bench/fanout.py [options]
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from twisted.words.protocols.jabber import jid, xmlstream
+from twisted.words.xish import domish
+
+from wokkel.pubsub import PubSubService as BasePubSubService, Subscription
+
+from idavoll.protocol import PubSubService
+
+SERVICE = jid.JID('pubsub.example.org')
+
+def makeItem(size):
+    item = domish.Element((None, 'item'))
+    item['id'] = 'item1'
+    entry = item.addElement(('http://www.w3.org/2005/Atom', 'entry'))
+    entry.addElement('title', content=u'Item')
+    for i in xrange(size // 100):
+        entry.addElement('content', content=u'x' * 80)
+    return item
+
+
+
+class CountingTransport(object):
+    """
+    Transport that drops written data, counting the writes and bytes.
+    """
+
+    def __init__(self):
+        self.writes = 0
+        self.size = 0
+
+
+    def write(self, data):
+        self.writes += 1
+        self.size += len(data)
+
+
+
+def bench(name, service, notifications):
+    xs = xmlstream.XmlStream(xmlstream.Authenticator())
+    xs.transport = CountingTransport()
+    xs.namespace = 'jabber:component:accept'
+    service.send = xs.send
+
+    start = time.clock()
+    service.notifyPublish(SERVICE, 'bench', notifications)
+    if hasattr(service, 'sendBuffer'):
+        service.sendBuffer.flush()
+    elapsed = time.clock() - start
+
+    print "%-18s %7.3fs %7.1f us/subscriber %7d writes %10d bytes" % (
+            name, elapsed, elapsed * 1000000 / len(notifications),
+            xs.transport.writes, xs.transport.size)
+
+
+
+def run():
+    parser = OptionParser()
+    parser.add_option('--subscribers', type='int', default=20000)
+    parser.add_option('--size', type='int', default=10000,
+                      help='approximate size of the item in bytes')
+    options, args = parser.parse_args()
+
+    items = [makeItem(options.size)]
+    notifications = []
+    for i in xrange(options.subscribers):
+        subscriber = jid.JID('user%d@example.org/home' % i)
+        subscription = Subscription('bench', subscriber, 'subscribed')
+        notifications.append((subscriber, [subscription], items))
+
+    bench('wokkel', BasePubSubService(), notifications)
+
+    service = PubSubService()
+    service.sendBuffer.maxSize = 0
+    bench('idavoll-unbuffered', service, notifications)
+
+    bench('idavoll', PubSubService(), notifications)
+
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Measure the memory used for each item retained by the memory storage.
+
+Items are retained as they are now, serialized in a L{PublishedItem}, and,
+for comparison, as they were before: the element tree with the publisher's
+JID, in an instance with a C{__dict__}. Each is measured in a new process,
+as the growth of its resident set size.
+
+Usage: python bench/memory.py [--items N]
+"""
+
+import datetime
+import gc
+import os
+import subprocess
+import sys
+from optparse import OptionParser
+
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+def makeItem(i):
+    item = domish.Element((None, 'item'))
+    item['id'] = 'item%d' % i
+    entry = item.addElement(('http://www.w3.org/2005/Atom', 'entry'))
+    entry.addElement('title', content=u'Item %d' % i)
+    entry.addElement('id', content=u'urn:uuid:%08d' % i)
+    entry.addElement('updated', content=u'2008-07-01T12:00:00Z')
+    return item
+
+
+
+class ElementItem(object):
+    """
+    A published item as retained before: the element tree itself.
+    """
+
+    def __init__(self, element, publisher, date=None):
+        self.element = element
+        self.publisher = publisher
+        self.date = date or datetime.datetime.utcnow()
+
+
+
+def getResidentSize():
+    """
+    Get the resident set size of this process, in bytes.
+    """
+    f = open('/proc/self/statm')
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+
+def measure(kind, count):
+    from idavoll import memory_storage
+
+    if kind == 'serialized':
+        factory = memory_storage.PublishedItem
+    else:
+        factory = ElementItem
+
+    gc.collect()
+    before = getResidentSize()
+    # Each item is published by a JID of its own, as happens when the
+    # publisher is taken from an incoming request.
+    items = [factory(makeItem(i), jid.JID('publisher@example.org/bench'))
+             for i in xrange(count)]
+    gc.collect()
+    return (getResidentSize() - before) / len(items)
+
+
+
+def run():
+    parser = OptionParser()
+    parser.add_option('--items', type='int', default=100000)
+    parser.add_option('--kind', choices=['element', 'serialized'])
+    options, args = parser.parse_args()
+
+    if options.kind:
+        print measure(options.kind, options.items)
+        return
+
+    for kind in ('element', 'serialized'):
+        output = subprocess.Popen([sys.executable, __file__,
+                                   '--items', str(options.items),
+                                   '--kind', kind],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        print "%-10s %7s bytes/item" % (kind, output.strip())
+
+
+
+if __name__ == '__main__':
+    sys.exit(run())
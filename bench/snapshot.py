@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark writing and loading snapshots of the memory storage.
+
+Usage: python bench/snapshot.py [options]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from idavoll import memory_storage
+
+def populate(storage, nodes, items, subscriptions):
+    owner = jid.JID('owner@example.org')
+    publisher = jid.JID('publisher@example.org/bench')
+    config = dict(storage.getDefaultConfiguration('leaf'))
+    config['pubsub#node_type'] = 'leaf'
+
+    leafNodes = []
+    for i in xrange(nodes):
+        storage.createNode('node%d' % i, owner, config)
+        leafNodes.append(storage._nodes['node%d' % i])
+
+    for i in xrange(items):
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item%d' % i
+        entry = item.addElement(('http://www.w3.org/2005/Atom', 'entry'))
+        entry.addElement('title', content=u'Item %d' % i)
+        leafNodes[i % nodes].storeItems([item], publisher)
+
+    for i in xrange(subscriptions):
+        subscriber = jid.JID('user%d@example.org/home' % i)
+        leafNodes[i % nodes].addSubscription(subscriber, 'subscribed', {})
+
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--nodes', type='int', default=1000)
+    parser.add_option('--items', type='int', default=1000000)
+    parser.add_option('--subscriptions', type='int', default=100000)
+    options, args = parser.parse_args()
+
+    storage = memory_storage.Storage()
+
+    start = time.time()
+    populate(storage, options.nodes, options.items, options.subscriptions)
+    print "populate: %.2fs" % (time.time() - start)
+
+    fd, path = tempfile.mkstemp(suffix='.snapshot')
+    os.close(fd)
+
+    try:
+        start = time.time()
+        snapshot = storage._getSnapshot()
+        print "take:     %.2fs" % (time.time() - start)
+
+        start = time.time()
+        memory_storage._writeSnapshotFile(path, snapshot)
+        print "write:    %.2fs (%d bytes)" % (time.time() - start,
+                                             os.path.getsize(path))
+        del snapshot
+
+        restored = memory_storage.Storage()
+        start = time.time()
+        restored.loadSnapshot(path)
+        print "load:     %.2fs" % (time.time() - start)
+    finally:
+        os.unlink(path)
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark publishing and retrieving items on the storage backends.
+
+The memory, file and SQLite backends are always run. The PostgreSQL
+backend is run when a database is given with --pgsql, set up with
+db/pubsub.sql.
+
+Usage: python bench/storage.py [options]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+OWNER = jid.JID('owner@example.org')
+PUBLISHER = jid.JID('publisher@example.org/bench')
+
+def makeItem(i):
+    item = domish.Element((None, 'item'))
+    item['id'] = 'item%d' % i
+    entry = item.addElement(('http://www.w3.org/2005/Atom', 'entry'))
+    entry.addElement('title', content=u'Item %d' % i)
+    return item
+
+
+
+def runConcurrently(f, count, concurrency):
+    """
+    Call C{f} with each number up to C{count}, with at most C{concurrency}
+    of the returned Deferreds waiting at a time.
+    """
+    work = (f(i) for i in xrange(count))
+    coop = task.Cooperator()
+    return defer.DeferredList([coop.coiterate(work)
+                               for i in xrange(concurrency)])
+
+
+
+@defer.inlineCallbacks
+def bench(name, storage, options):
+    config = dict(storage.getDefaultConfiguration('leaf'))
+    config['pubsub#node_type'] = 'leaf'
+    nodeIdentifiers = ['bench%d' % i for i in xrange(options.nodes)]
+    for nodeIdentifier in nodeIdentifiers:
+        yield storage.createNode(nodeIdentifier, OWNER, config)
+
+    nodes = []
+    for nodeIdentifier in nodeIdentifiers:
+        node = yield storage.getNode(nodeIdentifier)
+        nodes.append(node)
+
+    def publish(i):
+        return nodes[i % len(nodes)].storeItems([makeItem(i)], PUBLISHER)
+
+    def retrieve(i):
+        return nodes[i % len(nodes)].getItems(10)
+
+    def getNode(i):
+        return storage.getNode(nodeIdentifiers[i % len(nodes)])
+
+    for label, f, count in (('publish', publish, options.items),
+                            ('getItems', retrieve, options.retrievals),
+                            ('getNode', getNode, options.retrievals)):
+        start = time.time()
+        yield runConcurrently(f, count, options.concurrency)
+        elapsed = time.time() - start
+        print "%-8s %-8s %7.2fs %9.0f/s" % (name, label, elapsed,
+                                           count / elapsed)
+
+    for nodeIdentifier in nodeIdentifiers:
+        yield storage.deleteNode(nodeIdentifier)
+
+
+
+@defer.inlineCallbacks
+def main(options):
+    from idavoll import file_storage, memory_storage, sqlite_storage
+
+    yield bench('memory', memory_storage.Storage(), options)
+
+    directory = tempfile.mkdtemp()
+    try:
+        storage = file_storage.Storage(os.path.join(directory, 'nodes'))
+        yield bench('file', storage, options)
+        storage.close()
+
+        dbpool = sqlite_storage.ConnectionPool(
+                os.path.join(directory, 'pubsub.db'), options.readers)
+        dbpool.start()
+        yield bench('sqlite', sqlite_storage.Storage(dbpool), options)
+        dbpool.close()
+    finally:
+        shutil.rmtree(directory)
+
+    if options.pgsql:
+        from twisted.enterprise import adbapi
+        from idavoll import pgsql_storage
+        dbpool = adbapi.ConnectionPool('pyPgSQL.PgSQL',
+                                       database=options.pgsql,
+                                       client_encoding='utf-8',
+                                       cp_max=options.readers + 1)
+        dbpool.start()
+        yield bench('pgsql', pgsql_storage.Storage(dbpool), options)
+        dbpool.close()
+
+
+
+def run():
+    parser = OptionParser()
+    parser.add_option('--nodes', type='int', default=10)
+    parser.add_option('--items', type='int', default=10000)
+    parser.add_option('--retrievals', type='int', default=10000)
+    parser.add_option('--concurrency', type='int', default=10)
+    parser.add_option('--readers', type='int', default=4)
+    parser.add_option('--pgsql', metavar='DATABASE')
+    options, args = parser.parse_args()
+
+    d = main(options)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -2,6 +2,7 @@ create table callbacks (
     service text not null,
     node text not null,
     uri text not null,
+    encoding text,
     PRIMARY KEY (service, node, uri)
 );
 
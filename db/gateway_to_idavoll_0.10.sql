@@ -0,0 +1 @@
+ALTER TABLE callbacks ADD COLUMN encoding text;
@@ -47,3 +47,11 @@ CREATE TABLE items (
     date timestamp with time zone NOT NULL DEFAULT now(),
     UNIQUE (node_id, item)
 );
+
+CREATE INDEX items_node_id_date_item_id ON items (node_id, date, item_id);
+
+CREATE TABLE node_changes (
+    change_id serial PRIMARY KEY,
+    node text NOT NULL,
+    date timestamp with time zone NOT NULL DEFAULT now()
+);
@@ -105,8 +105,12 @@ class BackendService(service.Service, utility.EventDispatcher):
         return d
 
 
-    def getNodes(self):
-        return self.storage.getNodeIds()
+    def getNodes(self, after=None, maxNodes=None):
+        return self.storage.getNodeIds(after, maxNodes)
+
+
+    def getNodesVersion(self):
+        return self.storage.getNodesVersion()
 
 
     def getNodeMetaData(self, nodeIdentifier):
@@ -345,14 +349,17 @@ class BackendService(service.Service, utility.EventDispatcher):
 
 
     def getItems(self, nodeIdentifier, requestor, maxItems=None,
-                       itemIdentifiers=None):
+                       itemIdentifiers=None, after=None, before=None,
+                       since=None):
         d = self.storage.getNode(nodeIdentifier)
         d.addCallback(_getAffiliation, requestor)
-        d.addCallback(self._doGetItems, maxItems, itemIdentifiers)
+        d.addCallback(self._doGetItems, maxItems, itemIdentifiers,
+                                        after, before, since)
         return d
 
 
-    def _doGetItems(self, result, maxItems, itemIdentifiers):
+    def _doGetItems(self, result, maxItems, itemIdentifiers,
+                          after=None, before=None, since=None):
         node, affiliation = result
 
         if not ILeafNode.providedBy(node):
@@ -363,6 +370,8 @@ class BackendService(service.Service, utility.EventDispatcher):
 
         if itemIdentifiers:
             return node.getItemsById(itemIdentifiers)
+        elif after is not None or before is not None or since is not None:
+            return node.getItems(maxItems, after, before, since)
         else:
             return node.getItems(maxItems)
 
@@ -519,6 +528,7 @@ class PubSubResourceFromBackend(PubSubResource):
                                   'unsupported',
                                   'persistent-node'),
         error.NoRootNode: ('bad-request', None, None),
+        error.ItemNotFound: ('item-not-found', None, None),
         error.NoCollections: ('feature-not-implemented',
                               'unsupported',
                               'collections'),
@@ -615,10 +625,11 @@ class PubSubResourceFromBackend(PubSubResource):
         return d
 
 
-    def getNodes(self, requestor, service, nodeIdentifier):
+    def getNodes(self, requestor, service, nodeIdentifier, after=None,
+                       maxNodes=None):
         if service.resource:
             return defer.succeed([])
-        d = self.backend.getNodes()
+        d = self.backend.getNodes(after, maxNodes)
         return d.addErrback(self._mapErrors)
 
 
@@ -681,10 +692,18 @@ class PubSubResourceFromBackend(PubSubResource):
 
 
     def items(self, request):
+        rsmRequest = getattr(request, 'rsm', None)
+        if rsmRequest is not None:
+            after, before = rsmRequest.after, rsmRequest.before
+        else:
+            after, before = None, None
+
         d = self.backend.getItems(request.nodeIdentifier,
                                   request.sender,
                                   request.maxItems,
-                                  request.itemIdentifiers)
+                                  request.itemIdentifiers,
+                                  after, before,
+                                  getattr(request, 'since', None))
         return d.addErrback(self._mapErrors)
 
 
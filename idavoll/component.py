@@ -0,0 +1,180 @@
+# -*- test-case-name: idavoll.test.test_component -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+XMPP external component with several connections to the server.
+"""
+
+import zlib
+
+from twisted.application import service
+from twisted.words.protocols.jabber import jid, xmlstream
+from twisted.words.xish import domish, utility
+
+from wokkel.component import Component
+from wokkel.subprotocols import XMPPHandlerCollection
+
+from idavoll.protocol import SendBuffer
+
+def getShard(recipient, count):
+    """
+    Get the shard that stanzas to a recipient go to.
+
+    Recipients are sharded on their bare JID, so that all stanzas to a
+    single entity go to the same shard.
+
+    @param recipient: The JID of the recipient, or C{None}.
+    @type recipient: C{unicode}
+    @param count: The number of shards.
+    @type count: C{int}
+    @return: The index of the shard, the first for no recipient.
+    @rtype: C{int}
+    """
+    if not recipient:
+        return 0
+
+    entity = jid.internJID(recipient).userhost().encode('utf-8')
+    return (zlib.crc32(entity) & 0xffffffff) % count
+
+
+
+class Connection(Component):
+    """
+    A connection of a L{ComponentPool}.
+
+    Stanzas received on this connection are passed on to the handlers of
+    the pool.
+
+    @ivar pool: The pool this connection belongs to.
+    @type pool: L{ComponentPool}
+    @ivar sendBuffer: The buffer for stanzas sent over this connection.
+    @type sendBuffer: L{SendBuffer}
+    """
+
+    def __init__(self, pool, host, port, jid, password):
+        Component.__init__(self, host, port, jid, password)
+        self.pool = pool
+        self.sendBuffer = SendBuffer(self._sendBuffered)
+
+
+    def _sendBuffered(self, data):
+        self.send(data)
+
+
+    def _authd(self, xs):
+        Component._authd(self, xs)
+        xs.addObserver('/*', self.pool.xmlstream.dispatch)
+
+
+
+class _PoolSendBuffer(object):
+    """
+    The send buffers of the connections of a pool, used as a single one.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    def send(self, stanza):
+        connection = self.pool.getConnection(stanza.getAttribute('to'))
+        connection.sendBuffer.send(stanza)
+
+
+    def flush(self):
+        for connection in self.pool.connections:
+            connection.sendBuffer.flush()
+
+
+
+class ComponentPool(XMPPHandlerCollection, service.Service):
+    """
+    External component with several connections to the server.
+
+    All connections are made under the same JID, which requires a server
+    that allows that, and balances incoming stanzas over them. Handlers are
+    connected to a stream of their own, with the stanzas received on all
+    connections. Stanzas sent by the handlers are spread over the
+    connections by the bare JID of their recipient, see L{getShard}, so
+    that the stanzas to a single entity are all sent over the same
+    connection, and keep their order. If that connection is down, stanzas
+    are queued until it is back.
+
+    @ivar connections: The connections to the server.
+    @type connections: C{list} of L{Connection}
+    @ivar xmlstream: The stream the handlers are connected to.
+    @ivar sendBuffer: Buffer that sends stanzas over the connections in the
+                      same way, and can be used in place of a
+                      L{SendBuffer}.
+    """
+
+    def __init__(self, host, port, jid, password, connections=2):
+        XMPPHandlerCollection.__init__(self)
+        self.connections = [Connection(self, host, port, jid, password)
+                            for i in xrange(connections)]
+        self.sendBuffer = _PoolSendBuffer(self)
+
+        self.xmlstream = utility.EventDispatcher()
+        self.xmlstream.send = self.send
+        xmlstream.upgradeWithIQResponseTracker(self.xmlstream)
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        for connection in self.connections:
+            connection.startService()
+
+        for e in self:
+            e.makeConnection(self.xmlstream)
+            e.connectionInitialized()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        for connection in self.connections:
+            connection.sendBuffer.flush()
+            connection.stopService()
+
+        for e in self:
+            e.connectionLost(None)
+
+
+    def addHandler(self, handler):
+        """
+        Add a new handler, connecting it if the pool has been started.
+        """
+        XMPPHandlerCollection.addHandler(self, handler)
+
+        if self.running:
+            handler.makeConnection(self.xmlstream)
+            handler.connectionInitialized()
+
+
+    def getConnection(self, recipient):
+        """
+        Get the connection to send stanzas to a recipient over.
+
+        @param recipient: The JID of the recipient, or C{None}.
+        @type recipient: C{unicode}
+        @rtype: L{Connection}
+        """
+        return self.connections[getShard(recipient, len(self.connections))]
+
+
+    def send(self, obj):
+        """
+        Send a stanza over the connection for its recipient.
+
+        Serialized data has no recipient, and is sent over the first
+        connection.
+        """
+        if domish.IElement.providedBy(obj):
+            connection = self.getConnection(obj.getAttribute('to'))
+        else:
+            connection = self.connections[0]
+
+        connection.send(obj)
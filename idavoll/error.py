@@ -77,6 +77,13 @@ class NoRootNode(Error):
 
 
 
+class ItemNotFound(Error):
+    """
+    The item does not exist in this node.
+    """
+
+
+
 class NoCallbacks(Error):
     """
     There are no callbacks for this node.
@@ -93,3 +100,10 @@ class NoPublishing(Error):
     """
     This node does not support publishing.
     """
+
+
+
+class UnsupportedEncoding(Error):
+    """
+    The requested content coding is not supported.
+    """
@@ -0,0 +1,683 @@
+# -*- test-case-name: idavoll.test.test_file_storage -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Log-structured storage of items in files.
+
+Nodes, with their configuration, affiliations and subscriptions, are kept in
+memory as in L{idavoll.memory_storage}, and written to a metadata file in a
+directory per node on every change. The directories are named by a hash of
+the node identifier.
+
+The items of a leaf node are not kept in memory. They are appended to a
+segment file in the directory of the node. An index file holds an entry of
+fixed size for each item, in order of publication, with the position of
+the item in the segment file and its time of publication. Both files are
+memory-mapped to retrieve items. Only a mapping from item identifiers to
+index entries is kept in memory.
+
+Retracting an item only marks its index entry as removed. When enough of
+the index consists of removed entries, the node is compacted in a thread:
+the remaining items are copied to new files, which then replace the old.
+"""
+
+import calendar
+import cPickle
+import datetime
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+
+from zope.interface import implements
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.words.protocols.jabber import jid
+
+from wokkel.pubsub import Subscription
+
+from idavoll import error, iidavoll, memory_storage
+from idavoll.serialized import SerializedItem
+
+# Offset and length of the item in the segment, time of publication in
+# microseconds since the epoch, and flags.
+INDEX_ENTRY = struct.Struct('>QIqI')
+FLAGS = struct.Struct('>I')
+FLAGS_OFFSET = INDEX_ENTRY.size - FLAGS.size
+FLAG_REMOVED = 1
+
+def _toTimestamp(date):
+    return calendar.timegm(date.utctimetuple()) * 1000000 + date.microsecond
+
+
+
+def _makeRecord(itemIdentifier, publisher, element):
+    # Item identifiers and publishers can't hold NUL characters, as they
+    # can't be expressed in XML.
+    return '\0'.join([itemIdentifier.encode('utf-8'),
+                      publisher.full().encode('utf-8'),
+                      element.toXml().encode('utf-8')])
+
+
+
+def _readItems(records):
+    """
+    Get the items in segment records, as they are returned by storages.
+    """
+    items = []
+    for record in records:
+        itemIdentifier, publisher, data = record.split('\0', 2)
+        items.append(SerializedItem(data, itemIdentifier))
+    return items
+
+
+
+def _map(f):
+    """
+    Map a file into memory, or return C{None} if it is empty.
+    """
+    f.flush()
+    if not os.fstat(f.fileno()).st_size:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+
+def _writeCompacted(segmentFile, indexFile, newSegmentFile, newIndexFile,
+                    count):
+    """
+    Copy the items in the first C{count} index entries, that are not
+    removed, to new segment and index files.
+
+    @return: The positions of the copied index entries.
+    @rtype: C{list}
+    """
+    try:
+        segment = _map(segmentFile)
+        index = _map(indexFile)
+        kept = []
+        offset = 0
+
+        for position in xrange(count):
+            entry = INDEX_ENTRY.unpack_from(index, position * INDEX_ENTRY.size)
+            oldOffset, length, timestamp, flags = entry
+            if flags & FLAG_REMOVED:
+                continue
+
+            newSegmentFile.write(segment[oldOffset:oldOffset + length])
+            newIndexFile.write(INDEX_ENTRY.pack(offset, length, timestamp,
+                                                flags))
+            offset += length
+            kept.append(position)
+
+        for f in (newSegmentFile, newIndexFile):
+            f.flush()
+            os.fsync(f.fileno())
+
+        return kept
+    finally:
+        for f in (segmentFile, indexFile, newSegmentFile, newIndexFile):
+            f.close()
+
+
+
+class Storage(memory_storage.Storage):
+    """
+    Storage of nodes in a directory, with their items in segment files.
+
+    The nodes are loaded from the directory when the storage is created.
+
+    @ivar directory: The directory to keep the nodes in.
+    @type directory: C{str}
+    """
+
+    def __init__(self, directory):
+        memory_storage.Storage.__init__(self)
+        self.directory = directory
+        self._nodes[''] = CollectionNode(self._getNodePath(''), '',
+                                         jid.JID('localhost'),
+                                         self._nodes['']._config)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._load()
+
+
+    def _load(self):
+        placeholder = jid.internJID('localhost')
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+
+            try:
+                f = open(os.path.join(path, 'metadata'), 'rb')
+            except IOError:
+                # The node was not completely created or deleted.
+                shutil.rmtree(path)
+                continue
+
+            try:
+                (nodeIdentifier, config, affiliations,
+                 subscriptions) = cPickle.load(f)
+            finally:
+                f.close()
+
+            # The node is kept where it was found, also if it was named
+            # differently before.
+            if nodeIdentifier == '':
+                node = CollectionNode(path, nodeIdentifier, placeholder,
+                                      config)
+            else:
+                node = LeafNode(path, nodeIdentifier, placeholder, config)
+            node._affiliations = affiliations
+            for subscriber, state, options in subscriptions:
+                node._subscriptions[subscriber.full()] = Subscription(
+                        nodeIdentifier, subscriber, state, options)
+            self._nodes[nodeIdentifier] = node
+
+
+    def _getNodePath(self, nodeIdentifier):
+        # Node identifiers are hashed, so that any of them, of any length,
+        # can be used as the name of a directory. The identifier itself is
+        # kept in the metadata.
+        return os.path.join(
+                self.directory,
+                hashlib.sha1(nodeIdentifier.encode('utf-8')).hexdigest())
+
+
+    def _makeLeafNode(self, nodeIdentifier, owner, config):
+        return LeafNode(self._getNodePath(nodeIdentifier), nodeIdentifier,
+                        owner, config)
+
+
+    def createNode(self, nodeIdentifier, owner, config):
+        d = memory_storage.Storage.createNode(self, nodeIdentifier, owner,
+                                              config)
+        d.addCallback(lambda _: self._nodes[nodeIdentifier]._writeMetadata())
+        return d
+
+
+    def deleteNode(self, nodeIdentifier):
+        node = self._nodes.get(nodeIdentifier)
+        d = memory_storage.Storage.deleteNode(self, nodeIdentifier)
+        d.addCallback(lambda _: node.remove())
+        return d
+
+
+    def close(self):
+        """
+        Close the files of all nodes.
+        """
+        for node in self._nodes.itervalues():
+            if node.nodeType == 'leaf':
+                node.close()
+
+
+
+class MetadataMixin:
+    """
+    Mixin for nodes that write their metadata to a file on every change.
+
+    @ivar path: The directory with the files of this node.
+    @type path: C{str}
+    """
+
+    def _writeMetadata(self):
+        subscriptions = [(subscription.subscriber, subscription.state,
+                          dict(subscription.options or {}))
+                         for subscription in self._subscriptions.itervalues()]
+        metadata = (self.nodeIdentifier, self._config, self._affiliations,
+                    subscriptions)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        path = os.path.join(self.path, 'metadata')
+        f = open(path + '.tmp', 'wb')
+        try:
+            cPickle.dump(metadata, f, cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+
+    def setConfiguration(self, options):
+        d = memory_storage.Node.setConfiguration(self, options)
+        d.addCallback(lambda _: self._writeMetadata())
+        return d
+
+
+    def addSubscription(self, subscriber, state, options):
+        d = memory_storage.Node.addSubscription(self, subscriber, state,
+                                                options)
+        d.addCallback(lambda _: self._writeMetadata())
+        return d
+
+
+    def removeSubscription(self, subscriber):
+        d = memory_storage.Node.removeSubscription(self, subscriber)
+        d.addCallback(lambda _: self._writeMetadata())
+        return d
+
+
+
+class CollectionNode(MetadataMixin, memory_storage.CollectionNode):
+    """
+    Collection node with its metadata in a file.
+
+    Its directory is only created when the metadata is first written.
+    """
+
+    def __init__(self, path, nodeIdentifier, owner, config):
+        memory_storage.CollectionNode.__init__(self, nodeIdentifier, owner,
+                                               config)
+        self.path = path
+
+
+
+class LeafNode(MetadataMixin, memory_storage.Node):
+    """
+    Leaf node with its items in a segment file.
+
+    @ivar path: The directory with the files of this node.
+    @type path: C{str}
+    @ivar compactMinimum: The minimum number of removed index entries for
+                          compacting.
+    @type compactMinimum: C{int}
+    @ivar compactRatio: The fraction of the index entries that have to be
+                        removed for compacting.
+    @type compactRatio: C{float}
+    """
+
+    implements(iidavoll.ILeafNode)
+
+    nodeType = 'leaf'
+    compactMinimum = 1000
+    compactRatio = 0.5
+
+    def __init__(self, path, nodeIdentifier, owner, config):
+        memory_storage.Node.__init__(self, nodeIdentifier, owner, config)
+        self.path = path
+        self._ids = {}
+        self._count = 0
+        self._removed = 0
+        self._lastTimestamp = 0
+        self._epoch = 0
+        self._compacting = None
+        self._removedWhileCompacting = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._openFiles()
+        self._recover()
+
+
+    def _openFiles(self):
+        for name in ('segment', 'index'):
+            open(os.path.join(self.path, name), 'ab').close()
+
+        self._segmentFile = open(os.path.join(self.path, 'segment'), 'r+b')
+        self._indexFile = open(os.path.join(self.path, 'index'), 'r+b')
+        self._segment = None
+        self._index = None
+
+
+    def _recover(self):
+        """
+        Drop partly written items, and find the index entry of each item.
+        """
+        segmentSize = os.fstat(self._segmentFile.fileno()).st_size
+        count = (os.fstat(self._indexFile.fileno()).st_size //
+                 INDEX_ENTRY.size)
+        index = _map(self._indexFile)
+        segment = _map(self._segmentFile)
+
+        end = 0
+        for position in xrange(count):
+            offset, length, timestamp, flags = INDEX_ENTRY.unpack_from(
+                    index, position * INDEX_ENTRY.size)
+            if offset + length > segmentSize:
+                count = position
+                break
+
+            end = offset + length
+            self._lastTimestamp = timestamp
+            if flags & FLAG_REMOVED:
+                self._removed += 1
+                continue
+
+            itemIdentifier = segment[offset:segment.find('\0', offset)]
+            itemIdentifier = itemIdentifier.decode('utf-8')
+            if itemIdentifier in self._ids:
+                # Stored again, but the old entry was not marked removed.
+                self._markRemoved(self._ids[itemIdentifier])
+            self._ids[itemIdentifier] = position
+
+        for m in (index, segment):
+            if m is not None:
+                m.close()
+
+        self._flush()
+        self._indexFile.truncate(count * INDEX_ENTRY.size)
+        self._segmentFile.truncate(end)
+        self._count = count
+        self._segmentSize = end
+
+
+    def _getIndex(self, count):
+        """
+        Get the index, mapped at least up to entry C{count}.
+        """
+        if self._index is None or len(self._index) < count * INDEX_ENTRY.size:
+            if self._index is not None:
+                self._index.close()
+            self._index = _map(self._indexFile)
+        return self._index
+
+
+    def _getSegment(self, end):
+        """
+        Get the segment, mapped at least up to C{end}.
+        """
+        if self._segment is None or len(self._segment) < end:
+            if self._segment is not None:
+                self._segment.close()
+            self._segment = _map(self._segmentFile)
+        return self._segment
+
+
+    def _getEntry(self, position):
+        return INDEX_ENTRY.unpack_from(self._getIndex(position + 1),
+                                       position * INDEX_ENTRY.size)
+
+
+    def _isRemoved(self, position):
+        return self._getEntry(position)[3] & FLAG_REMOVED
+
+
+    def _readRecords(self, positions):
+        records = []
+        for position in positions:
+            offset, length, timestamp, flags = self._getEntry(position)
+            segment = self._getSegment(offset + length)
+            records.append(segment[offset:offset + length])
+        return records
+
+
+    def _append(self, record, timestamp, flags=0):
+        self._segmentFile.seek(self._segmentSize)
+        self._segmentFile.write(record)
+        self._indexFile.seek(self._count * INDEX_ENTRY.size)
+        self._indexFile.write(INDEX_ENTRY.pack(self._segmentSize,
+                                               len(record), timestamp,
+                                               flags))
+        self._segmentSize += len(record)
+        self._count += 1
+        return self._count - 1
+
+
+    def _markRemoved(self, position):
+        self._indexFile.seek(position * INDEX_ENTRY.size + FLAGS_OFFSET)
+        self._indexFile.write(FLAGS.pack(FLAG_REMOVED))
+        self._removed += 1
+
+        if self._removedWhileCompacting is not None:
+            self._removedWhileCompacting.append(position)
+
+
+    def _flush(self):
+        self._segmentFile.flush()
+        self._indexFile.flush()
+
+
+    def storeItems(self, items, publisher):
+        for element in items:
+            self._storeItem(element, publisher)
+
+        self._flush()
+        return defer.succeed(None)
+
+
+    def _storeItem(self, element, publisher, date=None):
+        itemIdentifier = element["id"]
+
+        # Keep the index ordered by date, even if the clock is set back,
+        # for _getSincePosition.
+        timestamp = _toTimestamp(date or datetime.datetime.utcnow())
+        timestamp = max(timestamp, self._lastTimestamp)
+        self._lastTimestamp = timestamp
+
+        # The item is appended before the old one is marked removed, so
+        # that at least one of them is kept if the process stops between.
+        position = self._append(_makeRecord(itemIdentifier, publisher,
+                                            element),
+                                timestamp)
+        if itemIdentifier in self._ids:
+            self._markRemoved(self._ids[itemIdentifier])
+        self._ids[itemIdentifier] = position
+
+
+    def removeItems(self, itemIdentifiers):
+        deleted = []
+
+        for itemIdentifier in itemIdentifiers:
+            try:
+                position = self._ids.pop(itemIdentifier)
+            except KeyError:
+                pass
+            else:
+                self._markRemoved(position)
+                deleted.append(itemIdentifier)
+
+        self._flush()
+
+        if (self._removed >= self.compactMinimum and
+            self._removed >= self._count * self.compactRatio):
+            self.compact()
+
+        return defer.succeed(deleted)
+
+
+    def _getPosition(self, itemIdentifier):
+        try:
+            return self._ids[itemIdentifier]
+        except KeyError:
+            raise error.ItemNotFound()
+
+
+    def _getSincePosition(self, since):
+        """
+        Find the position of the first item published after C{since}.
+        """
+        if not isinstance(since, datetime.datetime):
+            return self._getPosition(since) + 1
+
+        # Binary search on the index, which is ordered by date.
+        timestamp = _toTimestamp(since)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._getEntry(middle)[2] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+    def _getPositions(self, maxItems, after, before, since):
+        # Removed entries are skipped. The result is ordered from newest
+        # to oldest.
+        if since is not None:
+            first = self._getSincePosition(since)
+        else:
+            first = 0
+
+        positions = []
+        if before is not None:
+            if before:
+                start = self._getPosition(before) + 1
+            else:
+                start = 0
+
+            for position in xrange(max(start, first), self._count):
+                if maxItems is not None and len(positions) == maxItems:
+                    break
+                if not self._isRemoved(position):
+                    positions.append(position)
+
+            positions.reverse()
+        else:
+            if after is not None:
+                end = self._getPosition(after)
+            else:
+                end = self._count
+
+            for position in xrange(end - 1, first - 1, -1):
+                if maxItems is not None and len(positions) == maxItems:
+                    break
+                if not self._isRemoved(position):
+                    positions.append(position)
+
+        return positions
+
+
+    def getItems(self, maxItems=None, after=None, before=None, since=None):
+        try:
+            positions = self._getPositions(maxItems, after, before, since)
+        except error.ItemNotFound:
+            return defer.fail()
+
+        return defer.succeed(_readItems(self._readRecords(positions)))
+
+
+    def getItemsById(self, itemIdentifiers):
+        positions = [self._ids[itemIdentifier]
+                     for itemIdentifier in itemIdentifiers
+                     if itemIdentifier in self._ids]
+        return defer.succeed(_readItems(self._readRecords(positions)))
+
+
+    def purge(self):
+        # The files are replaced instead of truncated, as they may still
+        # be mapped by a compaction in progress.
+        self.close()
+        for name in ('segment', 'index'):
+            os.remove(os.path.join(self.path, name))
+        self._openFiles()
+
+        self._ids = {}
+        self._count = 0
+        self._removed = 0
+        self._segmentSize = 0
+        return defer.succeed(None)
+
+
+    def compact(self):
+        """
+        Copy the items that were not removed to new files, in a thread.
+
+        Items stored or removed while the files are being copied are
+        accounted for when the new files replace the old.
+
+        @return: Deferred that fires when the new files are in use.
+        """
+        if self._compacting is not None:
+            return self._compacting
+
+        def done(result):
+            self._compacting = None
+            self._removedWhileCompacting = None
+
+        # The files are opened here, so that the thread keeps using these
+        # even if they are replaced by purging or removing the node.
+        self._flush()
+        files = [open(os.path.join(self.path, name), mode)
+                 for name, mode in (('segment', 'rb'),
+                                    ('index', 'rb'),
+                                    ('segment.compact', 'wb'),
+                                    ('index.compact', 'wb'))]
+        self._removedWhileCompacting = []
+        d = threads.deferToThread(_writeCompacted, *(files + [self._count]))
+        d.addCallback(self._compacted, self._count, self._epoch)
+        d.addErrback(log.err, "Compacting %r failed" % self.nodeIdentifier)
+        d.addCallback(done)
+        self._compacting = d
+        return d
+
+
+    def _compacted(self, kept, count, epoch):
+        if epoch != self._epoch:
+            # Purged or closed while compacting.
+            for name in ('segment.compact', 'index.compact'):
+                path = os.path.join(self.path, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        newPositions = dict((position, newPosition)
+                            for newPosition, position in enumerate(kept))
+        removed = [position for position in self._removedWhileCompacting
+                   if position in newPositions]
+
+        # Copy the items stored since the copying started.
+        tail = [position for position in xrange(count, self._count)
+                if not self._isRemoved(position)]
+        tailEntries = [self._getEntry(position) for position in tail]
+        tailRecords = self._readRecords(tail)
+
+        self.close()
+        for name in ('segment', 'index'):
+            os.rename(os.path.join(self.path, name + '.compact'),
+                      os.path.join(self.path, name))
+        self._openFiles()
+
+        self._segmentSize = os.fstat(self._segmentFile.fileno()).st_size
+        self._count = len(kept)
+        for position, entry, record in zip(tail, tailEntries, tailRecords):
+            newPositions[position] = self._append(record, entry[2])
+
+        self._ids = dict((itemIdentifier, newPositions[position])
+                         for itemIdentifier, position in self._ids.iteritems())
+
+        self._removed = 0
+        self._removedWhileCompacting = None
+        for position in removed:
+            self._markRemoved(newPositions[position])
+        self._flush()
+
+
+    def _closeMaps(self):
+        for m in (self._segment, self._index):
+            if m is not None:
+                m.close()
+        self._segment = None
+        self._index = None
+
+
+    def close(self):
+        """
+        Close the files of this node.
+        """
+        self._epoch += 1
+        self._closeMaps()
+        self._segmentFile.close()
+        self._indexFile.close()
+
+
+    def remove(self):
+        """
+        Close and remove the files of this node.
+        """
+        self.close()
+        shutil.rmtree(self.path)
@@ -7,33 +7,54 @@
 Web resources and client for interacting with pubsub services.
 """
 
+import calendar
 import cgi
-from time import gmtime, strftime
+from time import gmtime, strftime, strptime
 import urllib
 import urlparse
+import zlib
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 import simplejson
 
 from twisted.application import service
 from twisted.internet import defer, reactor
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.web import client
 from twisted.web2 import http, http_headers, resource, responsecode
 from twisted.web2 import channel, server
-from twisted.web2.stream import readStream
+from twisted.web2.filter.gzip import deflateStream, gzipStream
+from twisted.web2.stream import SimpleStream, readStream
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.protocols.jabber.error import StanzaError
 from twisted.words.xish import domish
 
+from wokkel import shim
 from wokkel.pubsub import Item
-from wokkel.pubsub import PubSubClient
+from wokkel.pubsub import NS_PUBSUB, PubSubClient, PubSubRequest
 
 from idavoll import error
 
 NS_ATOM = 'http://www.w3.org/2005/Atom'
 MIME_ATOM_ENTRY = 'application/atom+xml;type=entry'
+MIME_ATOM_FEED = 'application/atom+xml;type=feed'
 MIME_JSON = 'application/json'
 
+# Response bodies smaller than this number of bytes are sent uncompressed.
+COMPRESS_THRESHOLD = 1024
+
+COMPRESSIBLE_TYPES = set(['application/atom+xml',
+                          'application/json',
+                          'application/xml'])
+
+# Content codings a callback can ask notifications to be POSTed with.
+CALLBACK_ENCODINGS = (None, 'identity', 'gzip')
+
 class XMPPURIParseError(ValueError):
     """
     Raised when a given XMPP URI couldn't be properly parsed.
@@ -110,19 +131,167 @@ class WebStreamParser(object):
         self.done = True
 
 
-    def parse(self, stream):
+    def parse(self, stream, encoding=None):
+        """
+        Parse an XML document from a stream.
+
+        @param encoding: The content coding of the stream, C{'gzip'} or
+                         C{'deflate'}, or C{None} if it is not encoded.
+        @type encoding: C{str}
+        """
+        def gotCompressedData(data):
+            self.elementStream.parse(decompressor.decompress(data))
+
         def endOfStream(result):
+            if encoding:
+                self.elementStream.parse(decompressor.flush())
+
             if not self.done:
                 raise Exception("No more stuff?")
             else:
                 return self.document
 
-        d = readStream(stream, self.elementStream.parse)
+        if encoding:
+            # Accept both gzip and zlib headers.
+            decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            d = readStream(stream, gotCompressedData)
+        else:
+            d = readStream(stream, self.elementStream.parse)
         d.addCallback(endOfStream)
         return d
 
 
 
+def getContentEncoding(request):
+    """
+    Get the content coding of the body of a request.
+
+    @return: C{'gzip'} or C{'deflate'}, or C{None} if the body is not
+             encoded.
+    @rtype: C{str}
+    @raise http.HTTPError: If the body was encoded with another content
+                           coding.
+    """
+    encodings = [encoding.lower() for encoding
+                 in request.headers.getHeader('content-encoding', [])
+                 if encoding.lower() != 'identity']
+
+    if not encodings:
+        return None
+    elif len(encodings) == 1 and encodings[0] in ('gzip', 'x-gzip'):
+        return 'gzip'
+    elif encodings == ['deflate']:
+        return 'deflate'
+    else:
+        raise http.HTTPError(
+            http.StatusResponse(
+                responsecode.UNSUPPORTED_MEDIA_TYPE,
+                "Unsupported Content-Encoding: %s" % ', '.join(encodings)))
+
+
+
+def gzipData(data, compressLevel=6):
+    """
+    Compress a string into the gzip format.
+    """
+    compressor = zlib.compressobj(compressLevel, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+
+def chooseEncoding(request):
+    """
+    Choose a content coding for a response from the request's
+    C{Accept-Encoding}.
+
+    @return: C{'gzip'} or C{'deflate'}, or C{None} if neither is
+             acceptable.
+    @rtype: C{str}
+    """
+    acceptEncoding = request.headers.getHeader('accept-encoding', {})
+    default = acceptEncoding.get('*', 0)
+
+    chosen, chosenQuality = None, 0
+    for encoding in ('gzip', 'deflate'):
+        quality = acceptEncoding.get(encoding, default)
+        if quality > chosenQuality:
+            chosen, chosenQuality = encoding, quality
+
+    return chosen
+
+
+
+def compressResponse(request, response, threshold=COMPRESS_THRESHOLD):
+    """
+    Response filter to compress the body of a response.
+
+    Only bodies of textual media types are compressed, and only if they
+    are not known to be smaller than C{threshold} bytes. The content coding
+    is negotiated with L{chooseEncoding}.
+    """
+    if (response.stream is None or
+        response.headers.hasHeader('content-encoding')):
+        return response
+
+    contentType = response.headers.getHeader('content-type')
+    if (contentType is None or
+        (contentType.mediaType != 'text' and
+         '%s/%s' % (contentType.mediaType, contentType.mediaSubtype)
+         not in COMPRESSIBLE_TYPES)):
+        return response
+
+    length = response.stream.length
+    if length is not None and length < threshold:
+        return response
+
+    response.headers.addRawHeader('Vary', 'Accept-Encoding')
+
+    encoding = chooseEncoding(request)
+    if encoding == 'gzip':
+        response.stream = gzipStream(response.stream)
+    elif encoding == 'deflate':
+        response.stream = deflateStream(response.stream)
+    else:
+        return response
+
+    response.headers.setHeader('content-encoding', [encoding])
+    response.headers.removeHeader('content-length')
+
+    # The compressed body is another representation, so that a strong
+    # entity tag of the identity body no longer applies.
+    etag = response.headers.getHeader('etag')
+    if etag is not None and not etag.weak:
+        response.headers.setHeader('etag',
+                                   http_headers.ETag(etag.tag, weak=True))
+    return response
+
+
+
+class CompressingResource(resource.WrapperResource):
+    """
+    Wraps a resource to compress the bodies of its responses.
+
+    See L{compressResponse}.
+
+    @ivar threshold: Bodies smaller than this number of bytes are not
+                     compressed.
+    @type threshold: C{int}
+    """
+
+    def __init__(self, wrapped, threshold=COMPRESS_THRESHOLD):
+        resource.WrapperResource.__init__(self, wrapped)
+        self.threshold = threshold
+
+
+    def hook(self, request):
+        def filterResponse(request, response):
+            return compressResponse(request, response, self.threshold)
+
+        request.addResponseFilter(filterResponse, atEnd=True)
+
+
+
 class CreateResource(resource.Resource):
     """
     A resource to create a publish-subscribe node.
@@ -217,6 +386,10 @@ class DeleteResource(resource.Resource):
 class PublishResource(resource.Resource):
     """
     A resource to publish to a publish-subscribe node.
+
+    A single Atom entry is published as the item with identifier
+    C{'current'}. The entries of an Atom feed are published together, each
+    as an item with the entry's C{<id/>} as item identifier.
     """
 
     def __init__(self, backend, serviceJID, owner):
@@ -229,6 +402,12 @@ class PublishResource(resource.Resource):
 
 
     def checkMediaType(self, request):
+        """
+        Check the media type of the request body.
+
+        @return: The type of Atom document, C{'entry'} or C{'feed'}.
+        @rtype: C{str}
+        """
         ctype = request.headers.getHeader('content-type')
 
         if not ctype:
@@ -239,7 +418,7 @@ class PublishResource(resource.Resource):
 
         if (ctype.mediaType != 'application' or
             ctype.mediaSubtype != 'atom+xml' or
-            ctype.params.get('type') != 'entry' or
+            ctype.params.get('type') not in ('entry', 'feed') or
             ctype.params.get('charset', 'utf-8') != 'utf-8'):
             raise http.HTTPError(
                 http.StatusResponse(
@@ -247,15 +426,55 @@ class PublishResource(resource.Resource):
                     "Unsupported Media Type: %s" %
                         http_headers.generateContentType(ctype)))
 
+        return ctype.params['type']
+
 
-    def parseXMLPayload(self, stream):
+    def itemsFromPayload(self, payload, documentType):
+        """
+        Create the items to publish from an Atom document.
+
+        @param payload: The parsed Atom document.
+        @type payload: L{domish.Element}
+        @param documentType: The type of Atom document, as returned by
+                             L{checkMediaType}.
+        @type documentType: C{str}
+        @rtype: C{list} of L{Item}
+        """
+        if documentType == 'entry':
+            return [Item(id='current', payload=payload)]
+
+        if payload.uri != NS_ATOM or payload.name != 'feed':
+            raise http.HTTPError(
+                http.StatusResponse(
+                    responsecode.BAD_REQUEST,
+                    "Payload is not an Atom feed"))
+
+        items = []
+        for entry in payload.elements():
+            if entry.uri == NS_ATOM and entry.name == 'entry':
+                # Entries without identifier get one from the backend.
+                entryIdentifier = _getAtomChildText(entry, 'id')
+                items.append(Item(id=entryIdentifier and
+                                     entryIdentifier.strip(),
+                                  payload=entry))
+
+        if not items:
+            raise http.HTTPError(
+                http.StatusResponse(
+                    responsecode.BAD_REQUEST,
+                    "No entries in Atom feed"))
+
+        return items
+
+
+    def parseXMLPayload(self, stream, encoding=None):
         p = WebStreamParser()
-        return p.parse(stream)
+        return p.parse(stream, encoding)
 
 
     def http_POST(self, request):
         """
-        Respond to a POST request to create a new item.
+        Respond to a POST request to create new items.
         """
 
         def toResponse(nodeIdentifier):
@@ -265,9 +484,8 @@ class PublishResource(resource.Resource):
             return http.Response(responsecode.OK, stream=stream,
                                  headers={'Content-Type': contentType})
 
-        def gotNode(nodeIdentifier, payload):
-            item = Item(id='current', payload=payload)
-            d = self.backend.publish(nodeIdentifier, [item], self.owner)
+        def gotNode(nodeIdentifier, items):
+            d = self.backend.publish(nodeIdentifier, items, self.owner)
             d.addCallback(lambda _: nodeIdentifier)
             return d
 
@@ -278,9 +496,9 @@ class PublishResource(resource.Resource):
             else:
                 return self.backend.createNode(None, self.owner)
 
-        def doPublish(payload):
+        def doPublish(items):
             d = getNode()
-            d.addCallback(gotNode, payload)
+            d.addCallback(gotNode, items)
             return d
 
         def trapNotFound(failure):
@@ -293,30 +511,103 @@ class PublishResource(resource.Resource):
             return http.StatusResponse(responsecode.BAD_REQUEST,
                     "Malformed XMPP URI: %s" % failure.value)
 
-        self.checkMediaType(request)
-        d = self.parseXMLPayload(request.stream)
+        def trapDecompressError(failure):
+            failure.trap(zlib.error)
+            return http.StatusResponse(responsecode.BAD_REQUEST,
+                    "Malformed compressed payload")
+
+        documentType = self.checkMediaType(request)
+        encoding = getContentEncoding(request)
+        d = self.parseXMLPayload(request.stream, encoding)
+        d.addCallback(self.itemsFromPayload, documentType)
         d.addCallback(doPublish)
         d.addCallback(toResponse)
         d.addErrback(trapNotFound)
         d.addErrback(trapXMPPURIParseError)
+        d.addErrback(trapDecompressError)
         return d
 
 
 
 class ListResource(resource.Resource):
+    """
+    Resource for listing the nodes of the backend.
+
+    Responses carry an entity tag, and a modification time if the storage
+    keeps one, that change when nodes are created or deleted, so that
+    clients can do conditional requests. Unchanged lists are then not
+    retrieved nor serialized.
+
+    The list can be retrieved in pages, ordered by node identifier, by
+    passing the C{max} argument and, for pages after the first one, the
+    last node identifier of the previous page as the C{after} argument. If
+    there are more nodes, the response has a C{Link} header with
+    C{rel="next"} pointing to the next page. Without these arguments, all
+    nodes are listed.
+
+    @ivar maxPageSize: The maximum number of nodes in a page.
+    @type maxPageSize: C{int}
+    """
+
+    maxPageSize = 1000
+
     def __init__(self, service):
         self.service = service
 
 
     def render(self, request):
-        def responseFromNodes(nodeIdentifiers):
+        after = request.args.get('after', [None])[0]
+        if after is not None:
+            after = after.decode('utf-8')
+
+        try:
+            maxNodes = int(request.args.get('max', [0])[0]) or None
+        except ValueError:
+            return http.StatusResponse(responsecode.BAD_REQUEST,
+                    "The argument max has an invalid value.")
+
+        if maxNodes is not None or after is not None:
+            maxNodes = min(maxNodes or self.maxPageSize, self.maxPageSize)
+
+        def getNodes(result):
+            version, lastModified = result
+            # The list may be sent compressed by CompressingResource, with
+            # the same tag.
+            etag = http_headers.ETag(version, weak=True)
+            http.checkPreconditions(request, etag=etag,
+                                    lastModified=lastModified)
+
+            headers = {'Content-Type':
+                           http_headers.MimeType.fromString(MIME_JSON),
+                       'ETag': etag}
+            if lastModified is not None:
+                headers['Last-Modified'] = lastModified
+
+            # Ask for one more node to find out if there is a next page.
+            d = self.service.getNodes(after, maxNodes and maxNodes + 1)
+            d.addCallback(responseFromNodes, headers)
+            return d
+
+        def responseFromNodes(nodeIdentifiers, headers):
+            more = maxNodes is not None and len(nodeIdentifiers) > maxNodes
+            if more:
+                del nodeIdentifiers[maxNodes:]
+
             stream = simplejson.dumps(nodeIdentifiers)
-            contentType = http_headers.MimeType.fromString(MIME_JSON)
-            return http.Response(responsecode.OK, stream=stream,
-                                 headers={'Content-Type': contentType})
+            response = http.Response(responsecode.OK, stream=stream,
+                                     headers=headers)
+
+            if more:
+                query = urllib.urlencode([
+                    ('after', nodeIdentifiers[-1].encode('utf-8')),
+                    ('max', maxNodes)])
+                response.headers.setRawHeaders('Link', [
+                    '<%s?%s>; rel="next"' % (request.path, query)])
 
-        d = self.service.getNodes()
-        d.addCallback(responseFromNodes)
+            return response
+
+        d = self.service.getNodesVersion()
+        d.addCallback(getNodes)
         return d
 
 
@@ -353,15 +644,130 @@ def extractAtomEntries(items):
 
 
 
-def constructFeed(service, nodeIdentifier, entries, title):
+def parseAtomDate(value):
+    """
+    Parse an RFC 3339 date-time, as used in Atom, into a POSIX timestamp.
+
+    Fractions of seconds are ignored.
+
+    @return: The number of seconds since the epoch, or C{None} if C{value}
+             could not be parsed.
+    @rtype: C{int}
+    """
+    value = value.strip()
+
+    try:
+        timestamp = calendar.timegm(strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+        offset = value[19:].lstrip('.0123456789')
+        if offset in ('Z', 'z'):
+            return timestamp
+
+        sign = {'+': -1, '-': 1}[offset[0]]
+        hours, minutes = offset[1:].split(':')
+        return timestamp + sign * (int(hours) * 3600 + int(minutes) * 60)
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+
+def _getAtomChildText(element, name):
+    for child in element.elements():
+        if child.uri == NS_ATOM and child.name == name:
+            return unicode(child)
+
+    return None
+
+
+
+def _getLatestUpdate(entries):
+    """
+    Find the most recent update time of a list of Atom entries.
+
+    @return: Tuple of the text of the latest C{<updated/>} and its POSIX
+             timestamp, both C{None} if no entry has a valid update time.
+    """
+    latest, lastModified = None, None
+
+    for entry in entries:
+        updated = _getAtomChildText(entry, 'updated')
+        timestamp = updated and parseAtomDate(updated)
+        if timestamp is not None and timestamp > lastModified:
+            latest, lastModified = updated, timestamp
+
+    return latest, lastModified
+
+
+
+def filterEntriesSince(entries, since):
+    """
+    Filter out Atom entries that were not updated after a given time.
+
+    Entries without a valid update time are kept.
+
+    @param since: POSIX timestamp.
+    @type since: C{int}
+    @rtype: C{list} of L{domish.Element}
+    """
+    result = []
+
+    for entry in entries:
+        updated = _getAtomChildText(entry, 'updated')
+        timestamp = updated and parseAtomDate(updated)
+        if timestamp is None or timestamp > since:
+            result.append(entry)
+
+    return result
+
+
+
+def getFeedValidators(entries):
+    """
+    Determine the entity tag and modification time for a feed of entries.
+
+    The entity tag is derived from the identifiers and update times of the
+    entries, so that it can be computed without serializing the feed. As
+    entries could change without a new update time, it is to be used as a
+    weak entity tag. The modification time is the most recent update time
+    of the entries.
+
+    @param entries: The Atom entries in the feed.
+    @type entries: C{list} of L{domish.Element}
+    @return: Tuple of the entity tag and the modification time as a POSIX
+             timestamp, or C{None} if none of the entries has a valid update
+             time.
+    @rtype: C{tuple}
+    """
+    digest = sha1()
+
+    for entry in entries:
+        entryIdentifier = _getAtomChildText(entry, 'id') or u''
+        updated = _getAtomChildText(entry, 'updated') or u''
+        digest.update((u'%s\n%s\n' % (entryIdentifier,
+                                       updated)).encode('utf-8'))
+
+    return digest.hexdigest(), _getLatestUpdate(entries)[1]
+
+
+
+def _constructFeedHeader(service, nodeIdentifier, entries, title):
     nodeURI = getXMPPURI(service, nodeIdentifier)
-    now = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
 
-    # Collect the received entries in a feed
+    # The feed was last updated when its most recent entry was. This keeps
+    # the feed the same as long as its entries are.
+    updated = (_getLatestUpdate(entries)[0] or
+               strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()))
+
     feed = domish.Element((NS_ATOM, 'feed'))
     feed.addElement('title', content=title)
     feed.addElement('id', content=nodeURI)
-    feed.addElement('updated', content=now)
+    feed.addElement('updated', content=updated)
+    return feed
+
+
+
+def constructFeed(service, nodeIdentifier, entries, title):
+    # Collect the received entries in a feed
+    feed = _constructFeedHeader(service, nodeIdentifier, entries, title)
 
     for entry in entries:
         feed.addChild(entry)
@@ -370,17 +776,220 @@ def constructFeed(service, nodeIdentifier, entries, title):
 
 
 
+def serializeFeed(service, nodeIdentifier, entries, title):
+    """
+    Serialize an Atom feed incrementally.
+
+    This yields the same document as serializing the result of
+    L{constructFeed}, but as a series of UTF-8 encoded chunks: the feed
+    header, one chunk per entry and the closing tag. This avoids having the
+    complete feed in memory, as a DOM tree and as a string, at once.
+
+    @param entries: The Atom entries to include in the feed.
+    @type entries: C{list} of L{domish.Element}
+    @rtype: iterator of C{str}
+    """
+    header = _constructFeedHeader(service, nodeIdentifier, entries, title)
+    yield header.toXml(closeElement=0).encode('utf-8')
+
+    for child in header.elements():
+        yield child.toXml(defaultUri=NS_ATOM).encode('utf-8')
+
+    for entry in entries:
+        yield entry.toXml(defaultUri=NS_ATOM).encode('utf-8')
+
+    yield '</feed>'
+
+
+
+class IteratorStream(SimpleStream):
+    """
+    Byte stream that pulls its data from an iterator of strings.
+
+    The next chunk is only produced when the consumer reads from the stream,
+    so that data is generated at the pace it can be written out.
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iter(iterator)
+
+
+    def read(self):
+        if self._iterator is None:
+            return None
+
+        try:
+            return self._iterator.next()
+        except StopIteration:
+            self._iterator = None
+            return None
+
+
+    def close(self):
+        self._iterator = None
+        SimpleStream.close(self)
+
+
+
+class ItemsCache(object):
+    """
+    Bounded cache of items retrieved from remote publish-subscribe nodes.
+
+    Entries are keyed by the service, the node identifier and the maximum
+    number of items requested, and expire after L{ttl} seconds. Cache misses
+    for the same key that occur while the items are still being retrieved
+    share that one outstanding request.
+
+    @ivar ttl: Number of seconds retrieved items are kept.
+    @type ttl: C{float}
+    @ivar maxEntries: Maximum number of cached results.
+    @type maxEntries: C{int}
+    @ivar clock: Provider of the current time, for expiration.
+    @type clock: L{IReactorTime<twisted.internet.interfaces.IReactorTime>}
+    """
+
+    def __init__(self, ttl=10, maxEntries=1000, clock=None):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.clock = clock or reactor
+        self._nodes = {}
+        self._size = 0
+        self._pending = {}
+        self._stale = set()
+
+
+    def _remove(self, node, maxItems):
+        entries = self._nodes[node]
+        del entries[maxItems]
+        self._size -= 1
+        if not entries:
+            del self._nodes[node]
+
+
+    def _store(self, node, maxItems, items):
+        if self.maxEntries < 1:
+            return
+
+        entries = self._nodes.get(node, {})
+        if maxItems not in entries and self._size >= self.maxEntries:
+            # Evict the entry that expires first.
+            oldest = None
+            for otherNode, otherEntries in self._nodes.iteritems():
+                for otherMaxItems, (expires, _) in otherEntries.iteritems():
+                    if oldest is None or expires < oldest[0]:
+                        oldest = (expires, otherNode, otherMaxItems)
+            self._remove(oldest[1], oldest[2])
+            entries = self._nodes.get(node, {})
+
+        if maxItems not in entries:
+            self._size += 1
+        entries[maxItems] = (self.clock.seconds() + self.ttl, items)
+        self._nodes[node] = entries
+
+
+    def get(self, service, nodeIdentifier, maxItems, fetch):
+        """
+        Get items from the cache, retrieving them on a miss.
+
+        @param fetch: Callable that retrieves the items, called with the
+                      service, node identifier and maximum number of items
+                      and returning a deferred.
+        @return: Deferred that fires with the list of items.
+        """
+        node = (service, nodeIdentifier)
+
+        try:
+            expires, items = self._nodes[node][maxItems]
+        except KeyError:
+            pass
+        else:
+            if expires > self.clock.seconds():
+                return defer.succeed(items)
+            self._remove(node, maxItems)
+
+        key = (service, nodeIdentifier, maxItems)
+        d = defer.Deferred()
+
+        if key in self._pending:
+            self._pending[key].append(d)
+            return d
+
+        def fetched(result):
+            waiters = self._pending.pop(key)
+            if key in self._stale:
+                self._stale.remove(key)
+            elif not isinstance(result, Failure):
+                self._store(node, maxItems, result)
+
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        self._pending[key] = [d]
+        fetchDeferred = fetch(service, nodeIdentifier, maxItems)
+        fetchDeferred.addBoth(fetched)
+        return d
+
+
+    def invalidate(self, service, nodeIdentifier):
+        """
+        Drop all cached results for a node.
+
+        Results of requests for this node that are still outstanding will be
+        passed on to their requestors, but not cached.
+        """
+        node = (service, nodeIdentifier)
+
+        for maxItems in self._nodes.get(node, {}).keys():
+            self._remove(node, maxItems)
+
+        for key in self._pending:
+            if key[:2] == node:
+                self._stale.add(key)
+
+
+
+class ItemsSinceRequest(PubSubRequest):
+    """
+    Items request with a C{Since} header, see
+    L{idavoll.protocol.PubSubService}.
+
+    @ivar since: The value of the header.
+    @type since: C{unicode}
+    """
+
+    since = None
+
+    def _render_maxItems(self, verbElement):
+        PubSubRequest._render_maxItems(self, verbElement)
+        verbElement.parent.addChild(shim.Headers([('Since', self.since)]))
+
+
+
 class RemoteSubscriptionService(service.Service, PubSubClient):
     """
     Service for subscribing to remote XMPP Publish-Subscribe nodes.
 
     Subscriptions are created with a callback HTTP URI that is POSTed
     to with the received items in notifications.
+
+    @ivar itemsCache: Cache for items retrieved with L{cachedItems}.
+    @type itemsCache: L{ItemsCache}
+    @ivar compressThreshold: Notifications smaller than this number of
+                             bytes are not compressed.
+    @type compressThreshold: C{int}
     """
 
-    def __init__(self, jid, storage):
+    compressThreshold = COMPRESS_THRESHOLD
+
+    def __init__(self, jid, storage, itemsCache=None):
         self.jid = jid
         self.storage = storage
+        if itemsCache is None:
+            itemsCache = ItemsCache()
+        self.itemsCache = itemsCache
 
 
     def trapNotFound(self, failure):
@@ -392,7 +1001,7 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
             return failure
 
 
-    def subscribeCallback(self, jid, nodeIdentifier, callback):
+    def subscribeCallback(self, jid, nodeIdentifier, callback, encoding=None):
         """
         Subscribe a callback URI.
 
@@ -403,16 +1012,27 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
         will subscribe to the node. Otherwise, the most recently published item
         for this node is retrieved and, if present, the newly registered
         callback will be called with that item.
+
+        @param encoding: The content coding to POST notifications to the
+                         callback with, one of L{CALLBACK_ENCODINGS}. It
+                         is stored with the callback.
+        @type encoding: C{str}
         """
 
+        if encoding not in CALLBACK_ENCODINGS:
+            return defer.fail(error.UnsupportedEncoding())
+
+        if encoding == 'identity':
+            encoding = None
+
         def callbackForLastItem(items):
             atomEntries = extractAtomEntries(items)
 
             if not atomEntries:
                 return
 
-            self._postTo([callback], jid, nodeIdentifier, atomEntries[0],
-                         'application/atom+xml;type=entry')
+            self._postTo({callback: encoding}, jid, nodeIdentifier,
+                         atomEntries[0], 'application/atom+xml;type=entry')
 
         def subscribeOrItems(hasCallbacks):
             if hasCallbacks:
@@ -429,7 +1049,7 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
         d = self.storage.hasCallbacks(jid, nodeIdentifier)
         d.addCallback(subscribeOrItems)
         d.addCallback(lambda _: self.storage.addCallback(jid, nodeIdentifier,
-                                                         callback))
+                                                         callback, encoding))
         return d
 
 
@@ -450,6 +1070,42 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
         return d
 
 
+    def itemsSince(self, service, nodeIdentifier, since, maxItems=None,
+                         sender=None):
+        """
+        Retrieve the items published to a remote node after a given time.
+
+        The time is sent in a C{Since} header. Services that don't support
+        it return the items as if it wasn't there.
+
+        @param since: POSIX timestamp.
+        @type since: C{int}
+        """
+        request = ItemsSinceRequest('items')
+        request.recipient = service
+        request.nodeIdentifier = nodeIdentifier
+        if maxItems:
+            request.maxItems = str(int(maxItems))
+        request.since = unicode(strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(since)))
+        request.sender = sender
+
+        def cb(iq):
+            return [element for element in iq.pubsub.items.elements()
+                    if element.uri == NS_PUBSUB and element.name == 'item']
+
+        d = request.send(self.xmlstream)
+        d.addCallback(cb)
+        return d
+
+
+    def cachedItems(self, service, nodeIdentifier, maxItems=None):
+        """
+        Retrieve items from a remote node, going through L{itemsCache}.
+        """
+        return self.itemsCache.get(service, nodeIdentifier, maxItems,
+                                   self.items)
+
+
     def itemsReceived(self, event):
         """
         Fire up HTTP client to do callback
@@ -460,15 +1116,19 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
         nodeIdentifier = event.nodeIdentifier
         headers = event.headers
 
+        self.itemsCache.invalidate(service, nodeIdentifier)
+        for collection in headers.get('Collection', []):
+            self.itemsCache.invalidate(service, collection or '')
+
         # Don't notify if there are no atom entries
         if not atomEntries:
             return
 
         if len(atomEntries) == 1:
-            contentType = 'application/atom+xml;type=entry'
+            contentType = MIME_ATOM_ENTRY
             payload = atomEntries[0]
         else:
-            contentType = 'application/atom+xml;type=feed'
+            contentType = MIME_ATOM_FEED
             payload = constructFeed(service, nodeIdentifier, atomEntries,
                                     title='Received item collection')
 
@@ -489,6 +1149,7 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
         service = event.sender
         nodeIdentifier = event.nodeIdentifier
         redirectURI = event.redirectURI
+        self.itemsCache.invalidate(service, nodeIdentifier)
         self.callCallbacks(service, nodeIdentifier, eventType='DELETED',
                            redirectURI=redirectURI)
 
@@ -496,6 +1157,13 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
     def _postTo(self, callbacks, service, nodeIdentifier,
                       payload=None, contentType=None, eventType=None,
                       redirectURI=None):
+        """
+        POST a notification to callbacks.
+
+        @param callbacks: The callback URIs, mapped to the content coding
+                          to POST with, or C{None}.
+        @type callbacks: C{dict}
+        """
 
         if not callbacks:
             return
@@ -518,16 +1186,32 @@ class RemoteSubscriptionService(service.Service, PubSubClient):
                               redirectURI.encode('utf-8'),
                               )
 
-        def postNotification(callbackURI):
+        compressed = []
+
+        def encodePostData(encoding):
+            if (encoding != 'gzip' or postdata is None or
+                len(postdata) < self.compressThreshold):
+                return postdata, headers
+
+            # Compress only once for all callbacks that want it.
+            if not compressed:
+                compressed.append(gzipData(postdata))
+
+            encodedHeaders = dict(headers)
+            encodedHeaders['Content-Encoding'] = encoding
+            return compressed[0], encodedHeaders
+
+        def postNotification(callbackURI, encoding):
+            data, dataHeaders = encodePostData(encoding)
             f = getPageWithFactory(str(callbackURI),
                                    method='POST',
-                                   postdata=postdata,
-                                   headers=headers)
+                                   postdata=data,
+                                   headers=dataHeaders)
             d = f.deferred
             d.addErrback(log.err)
 
-        for callbackURI in callbacks:
-            reactor.callLater(0, postNotification, callbackURI)
+        for callbackURI, encoding in callbacks.iteritems():
+            reactor.callLater(0, postNotification, callbackURI, encoding)
 
 
     def callCallbacks(self, service, nodeIdentifier,
@@ -561,8 +1245,12 @@ class RemoteSubscribeBaseResource(resource.Resource):
                          the JID of the pubsub service, the node identifier
                          and the callback URI as received in the HTTP POST
                          request to this resource.
+    @cvar serviceOptions: The names of optional keys in the JSON document
+                          that are passed on to L{serviceMethod} as keyword
+                          arguments.
     """
     serviceMethod = None
+    serviceOptions = ()
     errorMap = {
             error.NodeNotFound:
                 (responsecode.FORBIDDEN, "Node not found"),
@@ -570,6 +1258,8 @@ class RemoteSubscribeBaseResource(resource.Resource):
                 (responsecode.FORBIDDEN, "No such subscription found"),
             error.SubscriptionExists:
                 (responsecode.FORBIDDEN, "Subscription already exists"),
+            error.UnsupportedEncoding:
+                (responsecode.BAD_REQUEST, "Unsupported callback encoding"),
     }
 
     def __init__(self, service):
@@ -593,9 +1283,13 @@ class RemoteSubscribeBaseResource(resource.Resource):
             uri = self.params['uri']
             callback = self.params['callback']
 
+            options = dict((str(name), self.params[name])
+                           for name in self.serviceOptions
+                           if name in self.params)
+
             jid, nodeIdentifier = getServiceAndNode(uri)
             method = getattr(self.service, self.serviceMethod)
-            d = method(jid, nodeIdentifier, callback)
+            d = method(jid, nodeIdentifier, callback, **options)
             return d
 
         def storeParams(data):
@@ -621,9 +1315,12 @@ class RemoteSubscribeResource(RemoteSubscribeBaseResource):
 
     The passed C{uri} is the XMPP URI of the node to subscribe to and the
     C{callback} is the callback URI. Upon receiving notifications from the
-    node, a POST request will be perfomed on the callback URI.
+    node, a POST request will be perfomed on the callback URI. If the
+    optional C{encoding} is C{'gzip'}, larger notifications are POSTed
+    compressed.
     """
     serviceMethod = 'subscribeCallback'
+    serviceOptions = ('encoding',)
 
 
 
@@ -641,6 +1338,16 @@ class RemoteUnsubscribeResource(RemoteSubscribeBaseResource):
 class RemoteItemsResource(resource.Resource):
     """
     Resource for retrieving items from a remote pubsub node.
+
+    Responses carry a weak entity tag and modification time derived from
+    the retrieved entries, see L{getFeedValidators}, for conditional
+    requests.
+
+    With the C{since} argument, an RFC 3339 date-time, only entries that
+    were updated after that time are included in the feed. The items are
+    then retrieved with L{RemoteSubscriptionService.itemsSince}, bypassing
+    the cache, so that services that support it only return the items
+    published since.
     """
 
     def __init__(self, service):
@@ -654,6 +1361,13 @@ class RemoteItemsResource(resource.Resource):
             return http.StatusResponse(responsecode.BAD_REQUEST,
                     "The argument max_items has an invalid value.")
 
+        since = request.args.get('since', [None])[0]
+        if since is not None:
+            since = parseAtomDate(since)
+            if since is None:
+                return http.StatusResponse(responsecode.BAD_REQUEST,
+                        "The argument since has an invalid value.")
+
         try:
             uri = request.args['uri'][0]
         except KeyError:
@@ -667,16 +1381,29 @@ class RemoteItemsResource(resource.Resource):
                     "Malformed XMPP URI: %s" % uri)
 
         def respond(items):
-            """Create a feed out the retrieved items."""
+            """Stream a feed out of the retrieved items."""
+            atomEntries = extractAtomEntries(items)
+            if since is not None:
+                atomEntries = filterEntriesSince(atomEntries, since)
+
+            tag, lastModified = getFeedValidators(atomEntries)
+            etag = http_headers.ETag(tag, weak=True)
+            http.checkPreconditions(request, etag=etag,
+                                    lastModified=lastModified)
+
             contentType = http_headers.MimeType('application',
                                                 'atom+xml',
                                                 {'type': 'feed'})
-            atomEntries = extractAtomEntries(items)
-            feed = constructFeed(jid, nodeIdentifier, atomEntries,
-                                    "Retrieved item collection")
-            payload = feed.toXml().encode('utf-8')
-            return http.Response(responsecode.OK, stream=payload,
-                                 headers={'Content-Type': contentType})
+            headers = {'Content-Type': contentType,
+                       'ETag': etag}
+            if lastModified is not None:
+                headers['Last-Modified'] = lastModified
+
+            chunks = serializeFeed(jid, nodeIdentifier, atomEntries,
+                                   "Retrieved item collection")
+            return http.Response(responsecode.OK,
+                                 stream=IteratorStream(chunks),
+                                 headers=headers)
 
         def trapNotFound(failure):
             failure.trap(StanzaError)
@@ -685,7 +1412,10 @@ class RemoteItemsResource(resource.Resource):
             return http.StatusResponse(responsecode.NOT_FOUND,
                                        "Node not found")
 
-        d = self.service.items(jid, nodeIdentifier, maxItems)
+        if since is not None:
+            d = self.service.itemsSince(jid, nodeIdentifier, since, maxItems)
+        else:
+            d = self.service.cachedItems(jid, nodeIdentifier, maxItems)
         d.addCallback(respond)
         d.addErrback(trapNotFound)
         return d
@@ -734,7 +1464,7 @@ class CallbackResource(resource.Resource):
     def http_POST(self, request):
         p = WebStreamParser()
         if not request.headers.hasHeader('Event'):
-            d = p.parse(request.stream)
+            d = p.parse(request.stream, getContentEncoding(request))
         else:
             d = defer.succeed(None)
         d.addCallback(self.callback, request.headers)
@@ -817,27 +1547,43 @@ class GatewayClient(service.Service):
 
 
     def publish(self, entry, xmppURI=None):
+        """
+        Publish an Atom entry, or all entries of an Atom feed.
+        """
         query = xmppURI and {'uri': xmppURI}
 
+        if entry.name == 'feed':
+            contentType = MIME_ATOM_FEED
+        else:
+            contentType = MIME_ATOM_ENTRY
+
         f = getPageWithFactory(self._makeURI('publish', query),
                     method='POST',
                     postdata=entry.toXml().encode('utf-8'),
-                    headers={'Content-Type': MIME_ATOM_ENTRY},
+                    headers={'Content-Type': contentType},
                     agent=self.agent)
         return f.deferred.addCallback(simplejson.loads)
 
 
-    def listNodes(self):
-        f = getPageWithFactory(self._makeURI('list'),
+    def listNodes(self, after=None, maxNodes=None):
+        query = {}
+        if after is not None:
+            query['after'] = after.encode('utf-8')
+        if maxNodes:
+            query['max'] = int(maxNodes)
+
+        f = getPageWithFactory(self._makeURI('list', query),
                     method='GET',
                     agent=self.agent)
         return f.deferred.addCallback(simplejson.loads)
 
 
-    def subscribe(self, xmppURI):
+    def subscribe(self, xmppURI, encoding=None):
         params = {'uri': xmppURI,
                   'callback': 'http://%s:%s/callback' % (self.callbackHost,
                                                          self.callbackPort)}
+        if encoding:
+            params['encoding'] = encoding
         f = getPageWithFactory(self._makeURI('subscribe'),
                     method='POST',
                     postdata=simplejson.dumps(params),
@@ -858,10 +1604,12 @@ class GatewayClient(service.Service):
         return f.deferred
 
 
-    def items(self, xmppURI, maxItems=None):
+    def items(self, xmppURI, maxItems=None, since=None):
         query = {'uri': xmppURI}
         if maxItems:
              query['max_items'] = int(maxItems)
+        if since:
+            query['since'] = since
         f = getPageWithFactory(self._makeURI('items', query),
                     method='GET',
                     agent=self.agent)
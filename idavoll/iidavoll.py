@@ -45,13 +45,34 @@ class IBackendService(Interface):
         """
 
 
-    def getNodes():
-        """ Returns list of all nodes.
-
+    def getNodes(after=None, maxNodes=None):
+        """ Returns list of nodes.
+
+        Nodes are ordered by node id, so that the list can be retrieved in
+        pages by passing the last node id of a page as C{after} for the
+        next page.
+
+        @param after: only return nodes with an id greater than this one.
+        @type after: C{unicode}
+        @param maxNodes: the maximum number of nodes to return, or C{None}
+                         for all nodes.
+        @type maxNodes: C{int}
         @return: a deferred that returns a C{list} of node ids.
         """
 
 
+    def getNodesVersion():
+        """ Returns the version of the list of nodes.
+
+        The version is taken from the storage, see
+        L{IStorage.getNodesVersion}.
+
+        @return: a deferred that returns a C{tuple} of a version string and
+                 the time of the last change as a POSIX timestamp, or
+                 C{None}.
+        """
+
+
     def getNodeMetaData(nodeIdentifier):
         """ Return meta data for a node.
 
@@ -199,13 +220,17 @@ class IBackendService(Interface):
         """
 
 
-    def getItems(nodeIdentifier, requestor, maxItems=None, itemIdentifiers=[]):
+    def getItems(nodeIdentifier, requestor, maxItems=None, itemIdentifiers=[],
+                 after=None, before=None, since=None):
         """ Retrieve items from persistent storage
 
         If C{maxItems} is given, return the C{maxItems} last published
         items, else if C{itemIdentifiers} is not empty, return the items
         requested.  If neither is given, return all items.
 
+        Pages of items can be retrieved with C{after} and C{before}, and
+        only items published after C{since}, see L{ILeafNode.getItems}.
+
         @return: a deferred that returns the requested items
         """
 
@@ -231,14 +256,34 @@ class IStorage(Interface):
         """
 
 
-    def getNodeIds():
+    def getNodeIds(after=None, maxNodes=None):
         """
-        Return all NodeIDs.
+        Return NodeIDs, in order.
 
+        @param after: If not C{None}, only return NodeIDs that sort after
+                      this one.
+        @type after: C{unicode}
+        @param maxNodes: If not C{None}, the maximum number of NodeIDs to
+                         return.
+        @type maxNodes: C{int}
         @return: deferred that returns a list of NodeIDs (C{unicode}).
         """
 
 
+    def getNodesVersion():
+        """
+        Return the version of the list of nodes.
+
+        The version changes whenever a node is created or deleted, by any
+        user of the storage, and can be used as a validator for the node
+        list.
+
+        @return: deferred that returns a C{tuple} of a version string and
+                 the time of the last change as a POSIX timestamp, or
+                 C{None} if that time is not known.
+        """
+
+
     def createNode(nodeIdentifier, owner, config):
         """
         Create new node.
@@ -486,18 +531,46 @@ class ILeafNode(Interface):
         """
 
 
-    def getItems(maxItems=None):
+    def getItems(maxItems=None, after=None, before=None, since=None):
         """
         Get items.
 
+        Items are returned from most recently to least recently published.
         If C{maxItems} is not given, all items in the node are returned,
         just like C{getItemsById}. Otherwise, C{maxItems} limits
         the returned items to a maximum of that number of most recently
         published items.
 
+        The items can be retrieved in pages by passing the id of the last
+        item of a page as C{after}, to get the page with the items
+        published before it, or the id of the first item of a page as
+        C{before}, to get the page with the items published after it.
+        Passing an empty C{before} gets the page with the least recently
+        published items.
+
+        Clients that resynchronize can pass the time of, or the id of, the
+        most recent item they know of as C{since}, to only get the items
+        published after it.
+
+        Items are returned serialized, as
+        L{SerializedItem<idavoll.serialized.SerializedItem>}s, as they are
+        mostly passed on to entities without being inspected.
+
         @param maxItems: if given, a natural number (>0) that limits the
                           returned number of items.
-        @return: deferred that fires with a C{list} of found items.
+        @param after: if given, only return items published before the item
+                      with this id.
+        @type after: C{unicode}
+        @param before: if given, only return items published after the item
+                       with this id.
+        @type before: C{unicode}
+        @param since: if given, only return items published after this time,
+                      in UTC, or after the item with this id.
+        @type since: L{datetime.datetime} or C{unicode}
+        @return: deferred that fires with a C{list} of found items, as
+                 L{SerializedItem<idavoll.serialized.SerializedItem>}s.
+        @raise error.ItemNotFound: if the item given as C{after}, C{before}
+                                   or C{since} does not exist.
         """
 
 
@@ -505,9 +578,10 @@ class ILeafNode(Interface):
         """
         Get items by item id.
 
-        Each item in the returned list is a unicode string that
-        represent the XML of the item as it was published, including the
-        item wrapper with item id.
+        Each item in the returned list is a
+        L{SerializedItem<idavoll.serialized.SerializedItem>}, a unicode
+        string that represent the XML of the item as it was published,
+        including the item wrapper with item id.
 
         @param itemIdentifiers: C{list} of item ids.
         @return: deferred that fires with a C{list} of found items.
@@ -525,12 +599,13 @@ class ILeafNode(Interface):
 
 class IGatewayStorage(Interface):
 
-    def addCallback(service, nodeIdentifier, callback):
+    def addCallback(service, nodeIdentifier, callback, encoding=None):
         """
         Register a callback URI.
 
         The registered HTTP callback URI will have an Atom Entry documented
         POSTed to it upon receiving a notification for the given pubsub node.
+        Registering a callback URI again replaces its content coding.
 
         @param service: The XMPP entity that holds the node.
         @type service: L{JID<twisted.words.protocols.jabber.jid.JID>}
@@ -538,6 +613,8 @@ class IGatewayStorage(Interface):
         @type nodeIdentifier: C{unicode}.
         @param callback: The callback URI to be registered.
         @type callback: C{str}.
+        @param encoding: The content coding to POST with, or C{None}.
+        @type encoding: C{str}
         @rtype: L{Deferred<twisted.internet.defer.Deferred>}
         """
 
@@ -561,8 +638,9 @@ class IGatewayStorage(Interface):
         """
         Get the callbacks registered for this node.
 
-        Returns a deferred that fires with the set of HTTP callback URIs
-        registered for this node.
+        Returns a deferred that fires with a C{dict} of the HTTP callback
+        URIs registered for this node, mapped to their content coding, or
+        C{None}.
 
         @param service: The XMPP entity that holds the node.
         @type service: L{JID<twisted.words.protocols.jabber.jid.JID>}
@@ -0,0 +1,364 @@
+# -*- test-case-name: idavoll.test.test_journal -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Append-only journal of changes to the memory storage.
+
+Every change to a L{idavoll.memory_storage.Storage} with a journal set is
+appended to the journal file as a record. At startup, the storage is
+restored by loading the last snapshot and replaying the journal on top of
+it. Compaction writes a new snapshot and starts a new journal file.
+
+Journal files start with a header that holds their generation. A snapshot
+holds the generation of the first journal file with changes that are not
+in it, so that journal files that are already in a snapshot are never
+replayed twice. Journal files that were moved aside by compaction are kept,
+with their generation appended to their path, until a snapshot with their
+changes has been written.
+"""
+
+import cPickle
+import os
+
+from twisted.application import service
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, log
+
+from idavoll import memory_storage
+
+JOURNAL_VERSION = 1
+
+def replay(path, applyRecord, minGeneration=0):
+    """
+    Replay the records of a journal file.
+
+    Reading stops at the first record that can't be read, which is
+    normally one that was only partly written when the process stopped.
+
+    @param applyRecord: Callable that is called with each record.
+    @param minGeneration: The records of journal files of an older
+                          generation are not replayed.
+    @type minGeneration: C{int}
+    @return: The generation of the journal file, and the length of the
+             part of the file that could be read.
+    @rtype: C{tuple}
+    """
+    f = open(path, 'rb')
+    try:
+        try:
+            version, generation = cPickle.load(f)
+        except Exception:
+            log.err(None, "Could not read journal header of %s" % path)
+            return None, 0
+
+        if version != JOURNAL_VERSION:
+            raise ValueError("Unsupported journal version %r" % version)
+
+        length = f.tell()
+        if generation < minGeneration:
+            return generation, length
+
+        while True:
+            try:
+                record = cPickle.load(f)
+            except EOFError:
+                break
+            except Exception:
+                log.err(None, "Truncating journal %s at %d" % (path, length))
+                break
+
+            applyRecord(record)
+            length = f.tell()
+
+        return generation, length
+    finally:
+        f.close()
+
+
+
+class Journal(object):
+    """
+    Journal file, appended to with every change.
+
+    @ivar path: The path of the journal file.
+    @type path: C{str}
+    @ivar fsync: When to synchronize the file to disk: C{'always'} before
+                 a record is acknowledged, C{'never'}, leaving it to the
+                 operating system, or a number of seconds between
+                 synchronizations.
+    @type fsync: C{str} or C{float}
+    @ivar generation: The generation of the current journal file.
+    @type generation: C{int}
+    """
+
+    def __init__(self, path, fsync='always', clock=None):
+        self.path = path
+        self.fsync = fsync
+        self.clock = clock or reactor
+        self.generation = None
+        self._file = None
+        self._dirty = False
+        self._waiters = []
+        self._syncCall = None
+        self._syncing = None
+
+
+    def open(self, generation, length=None):
+        """
+        Open the journal file to append to.
+
+        @param generation: The generation of a new journal file.
+        @param length: The length of the readable part of an existing
+                       journal file, or C{None} to start a new journal file.
+        """
+        if length:
+            self._file = open(self.path, 'r+b')
+            self._file.truncate(length)
+            self._file.seek(length)
+        else:
+            self._file = open(self.path, 'wb')
+            cPickle.dump((JOURNAL_VERSION, generation), self._file,
+                         cPickle.HIGHEST_PROTOCOL)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+        self.generation = generation
+
+
+    def write(self, record):
+        """
+        Append a record.
+
+        With C{'always'} as the fsync policy, the records written in one
+        iteration of the reactor are synchronized to disk together, by
+        L{sync}.
+
+        @return: Deferred that fires when the record is acknowledged.
+        """
+        cPickle.dump(record, self._file, cPickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+
+        if self.fsync == 'never':
+            return defer.succeed(None)
+
+        self._dirty = True
+        if self.fsync != 'always':
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if self._syncCall is None and self._syncing is None:
+            self._syncCall = self.clock.callLater(0, self.sync)
+        return d
+
+
+    def sync(self):
+        """
+        Synchronize all written records to disk, in a thread.
+
+        If a synchronization is already running, the records written since
+        it started are left to the next one.
+
+        @return: Deferred that fires when the records are synchronized.
+        """
+        def done(result):
+            self._syncing = None
+            for d in waiters:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(None)
+
+            if isinstance(result, failure.Failure) and not waiters:
+                log.err(result, "Synchronizing the journal failed")
+            if self._waiters:
+                self.sync()
+
+        self._syncCall = None
+        if self._syncing is not None or not self._dirty:
+            return defer.succeed(None)
+
+        waiters, self._waiters = self._waiters, []
+        self._dirty = False
+        d = threads.deferToThread(os.fsync, self._file.fileno())
+        d.addBoth(done)
+        self._syncing = d
+        return d
+
+
+    def _syncNow(self):
+        """
+        Synchronize all written records to disk, and acknowledge them.
+        """
+        if self._syncCall is not None:
+            self._syncCall.cancel()
+            self._syncCall = None
+
+        if self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+
+    def _closeFile(self):
+        """
+        Close the journal file, once a running synchronization is done.
+        """
+        f, self._file = self._file, None
+        if self._syncing is None:
+            f.close()
+        else:
+            self._syncing.addBoth(lambda result: f.close())
+
+
+    def rotate(self):
+        """
+        Move the journal file aside, and start a new one.
+
+        The current journal file is renamed by appending its generation to
+        its path.
+
+        @return: The generation of the new journal file.
+        @rtype: C{int}
+        """
+        self._syncNow()
+        self._closeFile()
+        os.rename(self.path, '%s.%d' % (self.path, self.generation))
+        self.open(self.generation + 1)
+        return self.generation
+
+
+    def getOldFiles(self):
+        """
+        Get the journal files that were moved aside by L{rotate}.
+
+        @return: The generation and path of each file, oldest first.
+        @rtype: C{list}
+        """
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        prefix += '.'
+
+        oldFiles = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                oldFiles.append((int(name[len(prefix):]),
+                                 os.path.join(directory, name)))
+
+        oldFiles.sort()
+        return oldFiles
+
+
+    def close(self):
+        self._syncNow()
+        self._closeFile()
+
+
+
+class JournalService(service.Service):
+    """
+    Service that keeps a journal of changes to a memory storage.
+
+    At startup, the storage is restored from the snapshot and the journal.
+    The journal is compacted into a new snapshot periodically and at
+    shutdown.
+
+    @ivar storage: The storage to keep a journal for.
+    @type storage: L{memory_storage.Storage}
+    @ivar journal: The journal.
+    @type journal: L{Journal}
+    @ivar snapshotPath: The path of the snapshot file.
+    @type snapshotPath: C{str}
+    @ivar compactInterval: Seconds between compactions.
+    @type compactInterval: C{float}
+    """
+
+    def __init__(self, storage, journalPath, snapshotPath, fsync='always',
+                       compactInterval=3600):
+        self.storage = storage
+        self.journal = Journal(journalPath, fsync)
+        self.snapshotPath = snapshotPath
+        self.compactInterval = compactInterval
+        self._syncLoop = None
+        self._compactLoop = None
+        self._compacting = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        snapshotGeneration = 0
+        if os.path.exists(self.snapshotPath):
+            snapshotGeneration = self.storage.loadSnapshot(self.snapshotPath)
+
+        generation = snapshotGeneration
+        for oldGeneration, oldPath in self.journal.getOldFiles():
+            replay(oldPath, self.storage.applyRecord, snapshotGeneration)
+            generation = max(generation, oldGeneration + 1)
+
+        length = 0
+        if os.path.exists(self.journal.path):
+            journalGeneration, length = replay(self.journal.path,
+                                               self.storage.applyRecord,
+                                               snapshotGeneration)
+            if journalGeneration is None or journalGeneration < generation:
+                length = 0
+            else:
+                generation = journalGeneration
+
+        self.journal.open(generation, length)
+        self.storage.setJournal(self.journal)
+
+        if self.journal.fsync not in ('always', 'never'):
+            self._syncLoop = task.LoopingCall(self.journal.sync)
+            self._syncLoop.start(self.journal.fsync, now=False)
+
+        self._compactLoop = task.LoopingCall(self.compact)
+        self._compactLoop.start(self.compactInterval, now=False)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        for loop in (self._syncLoop, self._compactLoop):
+            if loop is not None and loop.running:
+                loop.stop()
+
+        d = self._compacting or defer.succeed(None)
+        d.addCallback(lambda _: self.compact())
+        d.addCallback(lambda _: self.journal.close())
+        return d
+
+
+    def compact(self):
+        """
+        Write a snapshot and start a new journal file.
+
+        The snapshot is taken, and the journal file rotated, at the same
+        time. Once the snapshot has been written, the journal files with
+        the changes in it are removed.
+
+        @return: Deferred that fires when the snapshot has been written.
+        """
+        def removeOld(_):
+            for oldGeneration, oldPath in self.journal.getOldFiles():
+                if oldGeneration < generation:
+                    os.remove(oldPath)
+
+        def done(result):
+            self._compacting = None
+
+        snapshot = self.storage._getSnapshot()
+        generation = self.journal.rotate()
+
+        d = threads.deferToThread(memory_storage._writeSnapshotFile,
+                                  self.snapshotPath, snapshot, generation)
+        d.addCallback(removeOld)
+        d.addErrback(log.err, "Compacting the journal failed")
+        d.addCallback(done)
+        self._compacting = d
+        return d
@@ -1,14 +1,27 @@
 # Copyright (c) Ralph Meijer.
 # See LICENSE for details.
 
+import bisect
 import copy
+import cPickle
+import datetime
+import os
+import time
+import uuid
+
 from zope.interface import implements
-from twisted.internet import defer
+from twisted.application import service
+from twisted.internet import defer, task, threads
+from twisted.python import log
 from twisted.words.protocols.jabber import jid
 
+from wokkel.generic import parseXml
 from wokkel.pubsub import Subscription
 
 from idavoll import error, iidavoll
+from idavoll.serialized import SerializedItem
+
+SNAPSHOT_VERSION = 2
 
 class Storage:
 
@@ -30,6 +43,11 @@ class Storage:
         rootNode = CollectionNode('', jid.JID('localhost'),
                                   copy.copy(self.defaultConfig['collection']))
         self._nodes = {'': rootNode}
+        self._nodeIds = None
+        self._nodesInstance = uuid.uuid4().hex[:8]
+        self._nodesVersion = 0
+        self._nodesModified = int(time.time())
+        self.journal = None
 
 
     def getNode(self, nodeIdentifier):
@@ -41,8 +59,31 @@ class Storage:
         return defer.succeed(node)
 
 
-    def getNodeIds(self):
-        return defer.succeed(self._nodes.keys())
+    def getNodeIds(self, after=None, maxNodes=None):
+        if self._nodeIds is None:
+            self._nodeIds = sorted(self._nodes)
+
+        if after is None:
+            start = 0
+        else:
+            start = bisect.bisect_right(self._nodeIds, after)
+
+        if maxNodes is None:
+            end = None
+        else:
+            end = start + maxNodes
+
+        return defer.succeed(self._nodeIds[start:end])
+
+
+    def getNodesVersion(self):
+        version = '%s-%d' % (self._nodesInstance, self._nodesVersion)
+        return defer.succeed((version, self._nodesModified))
+
+
+    def _nodesChanged(self):
+        self._nodesVersion += 1
+        self._nodesModified = int(time.time())
 
 
     def createNode(self, nodeIdentifier, owner, config):
@@ -52,18 +93,39 @@ class Storage:
         if config['pubsub#node_type'] != 'leaf':
             raise error.NoCollections()
 
-        node = LeafNode(nodeIdentifier, owner, config)
+        node = self._makeLeafNode(nodeIdentifier, owner, config)
+        node.journal = self.journal
         self._nodes[nodeIdentifier] = node
 
+        if self._nodeIds is not None:
+            bisect.insort(self._nodeIds, nodeIdentifier)
+        self._nodesChanged()
+
+        if self.journal is not None:
+            return self.journal.write(('createNode', nodeIdentifier, owner,
+                                       copy.copy(config)))
+
         return defer.succeed(None)
 
 
+    def _makeLeafNode(self, nodeIdentifier, owner, config):
+        return LeafNode(nodeIdentifier, owner, config)
+
+
     def deleteNode(self, nodeIdentifier):
         try:
             del self._nodes[nodeIdentifier]
         except KeyError:
             return defer.fail(error.NodeNotFound())
 
+        if self._nodeIds is not None:
+            del self._nodeIds[bisect.bisect_left(self._nodeIds,
+                                                 nodeIdentifier)]
+        self._nodesChanged()
+
+        if self.journal is not None:
+            return self.journal.write(('deleteNode', nodeIdentifier))
+
         return defer.succeed(None)
 
 
@@ -92,10 +154,147 @@ class Storage:
         return self.defaultConfig[nodeType]
 
 
+    def _getSnapshot(self):
+        # Only references to the items are taken here, as published items
+        # don't change. Serializing them is left to _writeSnapshotFile.
+        nodes = []
+        for node in self._nodes.itervalues():
+            subscriptions = [(subscription.subscriber, subscription.state,
+                              dict(subscription.options))
+                             for subscription
+                             in node._subscriptions.itervalues()]
+            nodes.append((node.nodeIdentifier, node.nodeType,
+                          copy.copy(node._config), dict(node._affiliations),
+                          subscriptions,
+                          list(getattr(node, '_itemlist', ()))))
+
+        return nodes
+
+
+    def writeSnapshot(self, path, generation=0):
+        """
+        Write a snapshot of all nodes, with their affiliations,
+        subscriptions and items, to a file.
+
+        The snapshot is taken right away, and serialized and written in a
+        thread, first to a temporary file that then replaces the file at
+        C{path}. This ensures that there is always a complete snapshot at
+        C{path}.
+
+        @param generation: The generation of the first journal file with
+                           changes that are not in the snapshot.
+        @type generation: C{int}
+        @return: Deferred that fires when the snapshot has been written.
+        """
+        return threads.deferToThread(_writeSnapshotFile, path,
+                                     self._getSnapshot(), generation)
+
+
+    def loadSnapshot(self, path):
+        """
+        Replace all nodes with those in a snapshot file.
+
+        @return: The generation of the first journal file with changes that
+                 are not in the snapshot.
+        @rtype: C{int}
+        @raise ValueError: if the file is not a snapshot of a supported
+                           version.
+        """
+        f = open(path, 'rb')
+        try:
+            version, snapshot, generation = cPickle.load(f)
+        finally:
+            f.close()
+
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version %r" % version)
+
+        placeholder = jid.internJID('localhost')
+        nodes = {}
+        for (nodeIdentifier, nodeType, config, affiliations, subscriptions,
+             items) in snapshot:
+            if nodeType == 'leaf':
+                node = self._makeLeafNode(nodeIdentifier, placeholder, config)
+            else:
+                node = CollectionNode(nodeIdentifier, placeholder, config)
+            node._affiliations = affiliations
+
+            for subscriber, state, options in subscriptions:
+                node._subscriptions[subscriber.full()] = Subscription(
+                        nodeIdentifier, subscriber, state, options)
+
+            for itemIdentifier, data, publisher, date in items:
+                item = PublishedItem.fromData(itemIdentifier, data,
+                                            publisher, date)
+                node._items[itemIdentifier] = item
+                node._itemlist.append(item)
+
+            nodes[nodeIdentifier] = node
+
+        self._nodes = nodes
+        self._nodeIds = None
+        self._nodesChanged()
+        return generation
+
+
+    def setJournal(self, journal):
+        """
+        Record all further changes in a journal.
+
+        @type journal: L{idavoll.journal.Journal}
+        """
+        self.journal = journal
+        for node in self._nodes.itervalues():
+            node.journal = journal
+
+
+    def applyRecord(self, record):
+        """
+        Apply a change recorded in a journal.
+        """
+        operation, nodeIdentifier, args = record[0], record[1], record[2:]
+
+        if operation == 'createNode':
+            owner, config = args
+            self.createNode(nodeIdentifier, owner, config)
+        elif operation == 'deleteNode':
+            self.deleteNode(nodeIdentifier)
+        elif nodeIdentifier in self._nodes:
+            self._nodes[nodeIdentifier].applyRecord(operation, args)
+
+
+
+def _writeSnapshotFile(path, snapshot, generation=0):
+    # JIDs are pickled as objects, so that they don't need to be prepared
+    # again when loading. Items are kept serialized, and written as is.
+    nodes = []
+    for (nodeIdentifier, nodeType, config, affiliations, subscriptions,
+         itemList) in snapshot:
+        items = [(item.itemIdentifier, item.data, item.publisher, item.date)
+                 for item in itemList]
+        nodes.append((nodeIdentifier, nodeType, config, affiliations,
+                      subscriptions, items))
+
+    temporaryPath = path + '.tmp'
+    f = open(temporaryPath, 'wb')
+    try:
+        cPickle.dump((SNAPSHOT_VERSION, nodes, generation), f,
+                     cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+    os.rename(temporaryPath, path)
+
+
+
 class Node:
 
     implements(iidavoll.INode)
 
+    journal = None
+
     def __init__(self, nodeIdentifier, owner, config):
         self.nodeIdentifier = nodeIdentifier
         self._affiliations = {owner.userhost(): 'owner'}
@@ -103,6 +302,25 @@ class Node:
         self._config = copy.copy(config)
 
 
+    def _record(self, operation, *args):
+        if self.journal is None:
+            return defer.succeed(None)
+
+        return self.journal.write((operation, self.nodeIdentifier) + args)
+
+
+    def applyRecord(self, operation, args):
+        """
+        Apply a change to this node recorded in a journal.
+        """
+        if operation == 'setConfiguration':
+            self.setConfiguration(*args)
+        elif operation == 'addSubscription':
+            self.addSubscription(*args)
+        elif operation == 'removeSubscription':
+            self.removeSubscription(*args)
+
+
     def getType(self):
         return self.nodeType
 
@@ -122,7 +340,7 @@ class Node:
             if option in self._config:
                 self._config[option] = options[option]
 
-        return defer.succeed(None)
+        return self._record('setConfiguration', copy.copy(options))
 
 
     def getAffiliation(self, entity):
@@ -153,7 +371,8 @@ class Node:
         subscription = Subscription(self.nodeIdentifier, subscriber, state,
                                     options)
         self._subscriptions[subscriber.full()] = subscription
-        return defer.succeed(None)
+        return self._record('addSubscription', subscriber, state,
+                            copy.copy(options))
 
 
     def removeSubscription(self, subscriber):
@@ -162,7 +381,7 @@ class Node:
         except KeyError:
             return defer.fail(error.NotSubscribed())
 
-        return defer.succeed(None)
+        return self._record('removeSubscription', subscriber)
 
 
     def isSubscribed(self, entity):
@@ -186,17 +405,66 @@ class PublishedItem(object):
     """
     A published item.
 
-    This represent an item as it was published by an entity.
+    This represent an item as it was published by an entity. To keep
+    retained items small, the item is held serialized, and only parsed when
+    its L{element} is asked for. Publishers are interned, so that all items
+    of a publisher share a single JID.
 
-    @ivar element: The DOM representation of the item that was published.
-    @type element: L{Element<twisted.words.xish.domish.Element>}
+    @ivar itemIdentifier: The identifier of the item.
+    @type itemIdentifier: C{unicode}
+    @ivar data: The serialized item, in UTF-8.
+    @type data: C{str}
     @ivar publisher: The entity that published the item.
     @type publisher: L{JID<twisted.words.protocols.jabber.jid.JID>}
+    @ivar date: The time of publication, in UTC.
+    @type date: L{datetime.datetime}
     """
 
-    def __init__(self, element, publisher):
-        self.element = element
-        self.publisher = publisher
+    __slots__ = ('itemIdentifier', 'data', 'publisher', 'date')
+
+    def __init__(self, element, publisher, date=None):
+        self.itemIdentifier = element["id"]
+        self.data = element.toXml().encode('utf-8')
+        self.publisher = jid.internJID(publisher.full())
+        self.date = date or datetime.datetime.utcnow()
+
+
+    @classmethod
+    def fromData(cls, itemIdentifier, data, publisher, date):
+        """
+        Create a published item from its serialized form.
+
+        @param data: The serialized item, in UTF-8.
+        @type data: C{str}
+        """
+        item = cls.__new__(cls)
+        item.itemIdentifier = itemIdentifier
+        item.data = data
+        item.publisher = jid.internJID(publisher.full())
+        item.date = date
+        return item
+
+
+    def _getElement(self):
+        return parseXml(self.data)
+
+    element = property(_getElement, doc="""
+        The DOM representation of the item that was published, parsed
+        anew each time.
+
+        @type: L{Element<twisted.words.xish.domish.Element>}
+        """)
+
+
+
+def _serializeItems(items):
+    """
+    Get published items as they are returned by storages.
+
+    @type items: C{list} of L{PublishedItem}
+    @rtype: C{list} of L{SerializedItem}
+    """
+    return [SerializedItem(item.data, item.itemIdentifier) for item in items]
 
 
 
@@ -212,18 +480,47 @@ class LeafNode(Node):
         self._itemlist = []
 
 
+    def applyRecord(self, operation, args):
+        if operation == 'storeItems':
+            publisher, items = args
+            for data, date in items:
+                self._storeItem(parseXml(data), publisher, date)
+        elif operation == 'removeItems':
+            self.removeItems(*args)
+        elif operation == 'purge':
+            self.purge()
+        else:
+            Node.applyRecord(self, operation, args)
+
+
     def storeItems(self, items, publisher):
-        for element in items:
-            item = PublishedItem(element, publisher)
-            itemIdentifier = element["id"]
-            if itemIdentifier in self._items:
-                self._itemlist.remove(self._items[itemIdentifier])
-            self._items[itemIdentifier] = item
-            self._itemlist.append(item)
+        stored = [self._storeItem(element, publisher) for element in items]
+
+        if self.journal is not None:
+            return self._record('storeItems', publisher,
+                                [(item.data, item.date) for item in stored])
 
         return defer.succeed(None)
 
 
+    def _storeItem(self, element, publisher, date=None):
+        item = PublishedItem(element, publisher, date)
+        itemIdentifier = item.itemIdentifier
+
+        # Keep the item list ordered by distinct dates, even if the clock
+        # is set back, for _getDateIndex.
+        if self._itemlist and self._itemlist[-1].date >= item.date:
+            item.date = (self._itemlist[-1].date +
+                         datetime.timedelta(microseconds=1))
+
+        if itemIdentifier in self._items:
+            self._itemlist.remove(self._items[itemIdentifier])
+        self._items[itemIdentifier] = item
+        self._itemlist.append(item)
+
+        return item
+
+
     def removeItems(self, itemIdentifiers):
         deleted = []
 
@@ -237,15 +534,101 @@ class LeafNode(Node):
                 del self._items[itemIdentifier]
                 deleted.append(itemIdentifier)
 
-        return defer.succeed(deleted)
+        if not deleted:
+            return defer.succeed(deleted)
+
+        d = self._record('removeItems', deleted)
+        d.addCallback(lambda _: deleted)
+        return d
+
+
+    def _getDateIndex(self, date, after=False):
+        """
+        Find the index of the first item published at C{date} or later, or,
+        with C{after}, later than C{date}.
+        """
+        # Binary search on the item list, which is ordered by date.
+        low, high = 0, len(self._itemlist)
+        while low < high:
+            middle = (low + high) // 2
+            itemDate = self._itemlist[middle].date
+            if itemDate < date or (after and itemDate == date):
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+    def _getItemIndex(self, itemIdentifier):
+        try:
+            item = self._items[itemIdentifier]
+        except KeyError:
+            raise error.ItemNotFound()
+
+        # Items loaded from a snapshot or database may share their date.
+        index = self._getDateIndex(item.date)
+        while self._itemlist[index] is not item:
+            index += 1
+
+        return index
 
 
-    def getItems(self, maxItems=None):
-        if maxItems:
-            itemList = self._itemlist[-maxItems:]
+    def _getSinceIndex(self, since):
+        """
+        Find the index of the first item published after C{since}.
+        """
+        if not isinstance(since, datetime.datetime):
+            return self._getItemIndex(since) + 1
+
+        return self._getDateIndex(since, after=True)
+
+
+    def _getItemList(self, maxItems, after, before, since):
+        # The item list is ordered from oldest to newest, the result is
+        # ordered from newest to oldest.
+        if since is not None:
+            first = self._getSinceIndex(since)
         else:
-            itemList = self._itemlist
-        return defer.succeed([item.element for item in itemList])
+            first = 0
+
+        if before is not None:
+            if before:
+                start = self._getItemIndex(before) + 1
+            else:
+                start = 0
+
+            start = max(start, first)
+
+            if maxItems is not None:
+                end = start + maxItems
+            else:
+                end = None
+        else:
+            if after is not None:
+                end = self._getItemIndex(after)
+            else:
+                end = len(self._itemlist)
+
+            if maxItems is not None:
+                start = max(0, end - maxItems)
+            else:
+                start = 0
+
+            start = max(start, first)
+
+        itemList = self._itemlist[start:end]
+        itemList.reverse()
+        return itemList
+
+
+    def getItems(self, maxItems=None, after=None, before=None, since=None):
+        try:
+            itemList = self._getItemList(maxItems, after, before, since)
+        except error.ItemNotFound:
+            return defer.fail()
+
+        return defer.succeed(_serializeItems(itemList))
 
 
     def getItemsById(self, itemIdentifiers):
@@ -256,15 +639,15 @@ class LeafNode(Node):
             except KeyError:
                 pass
             else:
-                items.append(item.element)
-        return defer.succeed(items)
+                items.append(item)
+        return defer.succeed(_serializeItems(items))
 
 
     def purge(self):
         self._items = {}
         self._itemlist = []
 
-        return defer.succeed(None)
+        return self._record('purge')
 
 
 class CollectionNode(Node):
@@ -272,6 +655,60 @@ class CollectionNode(Node):
 
 
 
+class SnapshotService(service.Service):
+    """
+    Service that restores a memory storage from a snapshot at startup, and
+    writes snapshots periodically and at shutdown.
+
+    @ivar storage: The storage to snapshot.
+    @type storage: L{Storage}
+    @ivar path: The path of the snapshot file.
+    @type path: C{str}
+    @ivar interval: Seconds between snapshots.
+    @type interval: C{float}
+    """
+
+    def __init__(self, storage, path, interval=60):
+        self.storage = storage
+        self.path = path
+        self.interval = interval
+        self._loop = None
+        self._writing = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        if os.path.exists(self.path):
+            self.storage.loadSnapshot(self.path)
+
+        self._loop = task.LoopingCall(self.writeSnapshot)
+        self._loop.start(self.interval, now=False)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+        d = self._writing or defer.succeed(None)
+        d.addCallback(lambda _: self.writeSnapshot())
+        return d
+
+
+    def writeSnapshot(self):
+        def done(result):
+            self._writing = None
+
+        d = self.storage.writeSnapshot(self.path)
+        d.addErrback(log.err, "Writing the snapshot failed")
+        d.addCallback(done)
+        self._writing = d
+        return d
+
+
+
 class GatewayStorage(object):
     """
     Memory based storage facility for the XMPP-HTTP gateway.
@@ -281,23 +718,16 @@ class GatewayStorage(object):
         self.callbacks = {}
 
 
-    def addCallback(self, service, nodeIdentifier, callback):
-        try:
-            callbacks = self.callbacks[service, nodeIdentifier]
-        except KeyError:
-            callbacks = set([callback])
-            self.callbacks[service, nodeIdentifier] = callbacks
-        else:
-            callbacks.add(callback)
-            pass
-
+    def addCallback(self, service, nodeIdentifier, callback, encoding=None):
+        callbacks = self.callbacks.setdefault((service, nodeIdentifier), {})
+        callbacks[callback] = encoding
         return defer.succeed(None)
 
 
     def removeCallback(self, service, nodeIdentifier, callback):
         try:
             callbacks = self.callbacks[service, nodeIdentifier]
-            callbacks.remove(callback)
+            del callbacks[callback]
         except KeyError:
             return defer.fail(error.NotSubscribed())
         else:
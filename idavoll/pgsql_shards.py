@@ -0,0 +1,409 @@
+# -*- test-case-name: idavoll.test.test_pgsql_shards -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+PostgreSQL storage sharded over several databases by node.
+
+Each node is kept in one of the databases, picked by consistent hashing of
+its identifier, see L{HashRing}. A node and everything about it, its
+affiliations, subscriptions and items, is kept in the same database, so
+that the operations on a node are handled by the storage of that database.
+Operations over all nodes, like retrieving the subscriptions of an entity,
+are run on all databases in parallel, and their results combined.
+
+When databases are added or removed, the nodes that then belong to
+another database are moved with the rebalancing tool in this module, which
+is run as::
+
+    python -m idavoll.pgsql_shards [--dry-run] [--retire=name=dsn] \\
+                                   name=dsn [name=dsn ...]
+
+The databases that nodes are placed on are given as arguments, with their
+name, that is used for hashing, and their pyPgSQL DSN, like
+C{host:port:database:user:password}. Databases that are taken out are given
+with C{--retire}, so that their nodes are moved off them.
+
+The service must be stopped while nodes are moved, as it would otherwise
+look for them in either database, depending on the list of databases it
+was started with.
+"""
+
+import bisect
+import hashlib
+import sys
+from optparse import OptionParser
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+from idavoll import iidavoll, pgsql_storage
+
+class MoveError(Exception):
+    """
+    A node could not be moved to another database.
+    """
+
+
+
+def parseShards(value):
+    """
+    Parse a comma separated list of shards, given as C{name=dsn}.
+
+    @rtype: C{list} of (C{str}, C{str})
+    """
+    shards = []
+    for shard in value.split(','):
+        name, sep, dsn = shard.partition('=')
+        if not sep or not name:
+            raise ValueError("Invalid shard %r, expected name=dsn" % shard)
+        shards.append((name, dsn))
+    return shards
+
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys to shards.
+
+    Each shard is placed on a ring at C{replicas} points, hashed from its
+    name. A key belongs to the shard of the first point on the ring at or
+    after the hash of the key. Adding or removing a shard only moves the
+    keys between that shard and the others, about one in the number of
+    shards.
+
+    @ivar names: The names of the shards.
+    @type names: C{list} of C{str}
+    """
+
+    replicas = 100
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._points = []
+        self._shards = []
+
+        ring = []
+        for name in self.names:
+            for replica in xrange(self.replicas):
+                ring.append((self._hash('%s-%d' % (name, replica)), name))
+        ring.sort()
+
+        self._points = [point for point, name in ring]
+        self._shards = [name for point, name in ring]
+
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+    def getShard(self, key):
+        """
+        Get the name of the shard a key belongs to.
+
+        @type key: C{unicode}
+        @rtype: C{str}
+        """
+        index = bisect.bisect_left(self._points, self._hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._shards[index]
+
+
+
+class Storage(object):
+    """
+    Storage sharded over several PostgreSQL databases by node.
+
+    The root node is in every database, and is taken from the one it
+    hashes to.
+
+    @ivar storages: The storage of each database, by name.
+    @type storages: C{dict}
+    @ivar ring: The hash ring that places nodes on the databases.
+    @type ring: L{HashRing}
+    """
+
+    implements(iidavoll.IStorage)
+
+    def __init__(self, shards):
+        """
+        @param shards: The name and storage of each database.
+        @type shards: C{list} of (C{str},
+                      L{Storage<idavoll.pgsql_storage.Storage>})
+        """
+        self.storages = dict(shards)
+        self.ring = HashRing([name for name, storage in shards])
+        self._default = shards[0][1]
+
+
+    def getStorage(self, nodeIdentifier):
+        """
+        Get the storage of the database a node is kept in.
+        """
+        return self.storages[self.ring.getShard(nodeIdentifier)]
+
+
+    def _gather(self, method, *args):
+        d = defer.gatherResults([getattr(storage, method)(*args)
+                                 for name, storage
+                                 in sorted(self.storages.iteritems())],
+                                consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+
+    def getNode(self, nodeIdentifier):
+        return self.getStorage(nodeIdentifier).getNode(nodeIdentifier)
+
+
+    def getNodeIds(self, after=None, maxNodes=None):
+        def merge(results):
+            nodeIdentifiers = set()
+            for result in results:
+                nodeIdentifiers.update(result)
+            nodeIdentifiers = sorted(nodeIdentifiers)
+            if maxNodes is not None:
+                nodeIdentifiers = nodeIdentifiers[:maxNodes]
+            return nodeIdentifiers
+
+        d = self._gather('getNodeIds', after, maxNodes)
+        d.addCallback(merge)
+        return d
+
+
+    def getNodesVersion(self):
+        def merge(results):
+            versions = [version for version, lastModified in results]
+            modified = [lastModified for version, lastModified in results]
+            if None in modified:
+                return '.'.join(versions), None
+            else:
+                return '.'.join(versions), max(modified)
+
+        d = self._gather('getNodesVersion')
+        d.addCallback(merge)
+        return d
+
+
+    def createNode(self, nodeIdentifier, owner, config):
+        storage = self.getStorage(nodeIdentifier)
+        return storage.createNode(nodeIdentifier, owner, config)
+
+
+    def deleteNode(self, nodeIdentifier):
+        return self.getStorage(nodeIdentifier).deleteNode(nodeIdentifier)
+
+
+    def getAffiliations(self, entity):
+        d = self._gather('getAffiliations', entity)
+        d.addCallback(lambda results: sum(results, []))
+        return d
+
+
+    def getSubscriptions(self, entity):
+        d = self._gather('getSubscriptions', entity)
+        d.addCallback(lambda results: sum(results, []))
+        return d
+
+
+    def getDefaultConfiguration(self, nodeType):
+        return self._default.getDefaultConfiguration(nodeType)
+
+
+
+def _getEntityId(cursor, jid):
+    cursor.execute("""SELECT entity_id FROM entities WHERE jid=%s""",
+                   (jid,))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+
+    cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""", (jid,))
+    cursor.execute("""SELECT entity_id FROM entities WHERE jid=%s""",
+                   (jid,))
+    return cursor.fetchone()[0]
+
+
+
+def _countItems(cursor, nodeIdentifier):
+    cursor.execute("""SELECT count(*) FROM items
+                      NATURAL JOIN nodes
+                      WHERE node=%s""",
+                   (nodeIdentifier,))
+    return cursor.fetchone()[0]
+
+
+
+def moveNode(source, target, nodeIdentifier, batchSize=1000):
+    """
+    Move a node, with everything about it, from one database to another.
+
+    The node is locked in the source database, so that it can not be
+    changed while it is moved. It is copied to the target in a single
+    transaction, and then deleted from the source. If the node is already
+    in the target, the copy of an earlier move that was interrupted is
+    kept, if it has as many items as the node in the source.
+
+    @param source: Connection to the database the node is in.
+    @param target: Connection to the database to move the node to.
+    @param batchSize: Number of items to copy at a time.
+    @raise MoveError: if the node is already in the target, with another
+                      number of items.
+    """
+    src = source.cursor()
+    dst = target.cursor()
+
+    src.execute("""SELECT node_type, persist_items, deliver_payloads,
+                          send_last_published_item
+                   FROM nodes WHERE node=%s
+                   FOR UPDATE""",
+                (nodeIdentifier,))
+    row = src.fetchone()
+    if not row:
+        source.rollback()
+        return
+
+    dst.execute("""SELECT 1 FROM nodes WHERE node=%s""", (nodeIdentifier,))
+    if dst.fetchone():
+        sourceItems = _countItems(src, nodeIdentifier)
+        targetItems = _countItems(dst, nodeIdentifier)
+        if sourceItems != targetItems:
+            source.rollback()
+            target.rollback()
+            raise MoveError("Node %r has %d items, but %d in the target" %
+                            (nodeIdentifier, sourceItems, targetItems))
+    else:
+        dst.execute("""INSERT INTO nodes
+                       (node, node_type, persist_items, deliver_payloads,
+                        send_last_published_item)
+                       VALUES (%s, %s, %s, %s, %s)""",
+                    (nodeIdentifier,) + tuple(row))
+        dst.execute("""SELECT node_id FROM nodes WHERE node=%s""",
+                    (nodeIdentifier,))
+        nodeId = dst.fetchone()[0]
+
+        src.execute("""SELECT jid, affiliation FROM affiliations
+                       NATURAL JOIN nodes
+                       NATURAL JOIN entities
+                       WHERE node=%s""",
+                    (nodeIdentifier,))
+        for jid, affiliation in src.fetchall():
+            dst.execute("""INSERT INTO affiliations
+                           (node_id, entity_id, affiliation)
+                           VALUES (%s, %s, %s)""",
+                        (nodeId, _getEntityId(dst, jid), affiliation))
+
+        src.execute("""SELECT jid, resource, state, subscription_type,
+                              subscription_depth
+                       FROM subscriptions
+                       NATURAL JOIN nodes
+                       NATURAL JOIN entities
+                       WHERE node=%s""",
+                    (nodeIdentifier,))
+        for row in src.fetchall():
+            dst.execute("""INSERT INTO subscriptions
+                           (node_id, entity_id, resource, state,
+                            subscription_type, subscription_depth)
+                           VALUES (%s, %s, %s, %s, %s, %s)""",
+                        (nodeId, _getEntityId(dst, row[0])) + tuple(row[1:]))
+
+        src.execute("""SELECT item, publisher, data, date FROM items
+                       NATURAL JOIN nodes
+                       WHERE node=%s
+                       ORDER BY item_id""",
+                    (nodeIdentifier,))
+        while True:
+            rows = src.fetchmany(batchSize)
+            if not rows:
+                break
+            for row in rows:
+                dst.execute("""INSERT INTO items
+                               (node_id, item, publisher, data, date)
+                               VALUES (%s, %s, %s, %s, %s)""",
+                            (nodeId,) + tuple(row))
+
+        pgsql_storage._recordChange(dst, nodeIdentifier)
+        target.commit()
+
+    src.execute("""DELETE FROM nodes WHERE node=%s""", (nodeIdentifier,))
+    pgsql_storage._recordChange(src, nodeIdentifier)
+    source.commit()
+
+
+
+def rebalance(connections, ring, out=sys.stdout, dryRun=False):
+    """
+    Move the nodes that are not in the database they hash to.
+
+    @param connections: Connection to each database, by name. Databases
+                        that are not on the ring have all their nodes moved
+                        off them.
+    @type connections: C{dict}
+    @param ring: The placement of nodes on the databases.
+    @type ring: L{HashRing}
+    @return: The number of nodes moved.
+    @rtype: C{int}
+    """
+    moved = 0
+    for name, connection in sorted(connections.iteritems()):
+        cursor = connection.cursor()
+        cursor.execute("""SELECT node FROM nodes WHERE node != ''
+                          ORDER BY node""")
+        nodeIdentifiers = [row[0] for row in cursor.fetchall()]
+        connection.commit()
+
+        for nodeIdentifier in nodeIdentifiers:
+            targetName = ring.getShard(nodeIdentifier)
+            if targetName == name:
+                continue
+
+            out.write("%s: %s -> %s\n" % (nodeIdentifier.encode('utf-8'),
+                                          name, targetName))
+            if not dryRun:
+                try:
+                    moveNode(connection, connections[targetName],
+                             nodeIdentifier)
+                except MoveError, e:
+                    out.write("  not moved: %s\n" % e)
+                    continue
+            moved += 1
+
+    return moved
+
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m idavoll.pgsql_shards [options] "
+                                "name=dsn [name=dsn ...]")
+    parser.add_option('--retire', action='append', default=[],
+                      help="name=dsn of a database to move all nodes off")
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="only show the nodes that would be moved")
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("No databases given")
+
+    try:
+        shards = parseShards(','.join(args))
+        retired = options.retire and parseShards(','.join(options.retire))
+    except ValueError, e:
+        parser.error(str(e))
+
+    from pyPgSQL import PgSQL
+    connections = dict((name, PgSQL.connect(dsn, client_encoding='utf-8',
+                                            unicode_results=True))
+                       for name, dsn in shards + (retired or []))
+
+    ring = HashRing([name for name, dsn in shards])
+    moved = rebalance(connections, ring, dryRun=options.dry_run)
+    print "%d nodes %s" % (moved, options.dry_run and "to move" or "moved")
+
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,93 @@
 # See LICENSE for details.
 
 import copy
+import datetime
+import select
+import time
+from collections import OrderedDict
 
 from zope.interface import implements
 
+from twisted.application import service
 from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, log
 from twisted.words.protocols.jabber import jid
 
-from wokkel.generic import parseXml, stripNamespace
 from wokkel.pubsub import Subscription
 
 from idavoll import error, iidavoll
+from idavoll.serialized import SerializedItem
+
+def _recordChange(cursor, nodeIdentifier):
+    """
+    Record a change to a node, for the L{ChangeListener}s of all processes.
+    """
+    cursor.execute("""INSERT INTO node_changes (node) VALUES (%s)""",
+                   (nodeIdentifier,))
+    cursor.execute("""NOTIFY node_changes""")
+
+
+
+def _runChange(owner, nodeIdentifier, interaction, *args):
+    """
+    Run an interaction that changes a node.
+
+    If the storage or node C{owner} notifies changes, the change is
+    recorded in the C{node_changes} table. With a cache, the node is
+    invalidated in it once the transaction has ended.
+    """
+    def recordChange(cursor):
+        result = interaction(cursor, *args)
+        _recordChange(cursor, nodeIdentifier)
+        return result
+
+    def invalidate(result):
+        owner.cache.invalidate(nodeIdentifier)
+        return result
+
+    if owner.notifyChanges:
+        d = owner.dbpool.runInteraction(recordChange)
+    else:
+        d = owner.dbpool.runInteraction(interaction, *args)
+
+    if owner.cache is not None:
+        d.addBoth(invalidate)
+    return d
+
+
+
+def _recordWrite(d, recentWrites, *keys):
+    """
+    Record a write, once it has ended, in L{RecentWrites}, if given.
+    """
+    if recentWrites is None:
+        return d
+
+    def record(result):
+        recentWrites.add(*keys)
+        return result
+
+    d.addBoth(record)
+    return d
+
+
+
+def _readpoolFor(owner, *keys):
+    """
+    Get the pool to read from, given what the read is about.
+
+    Reads about something that has recently been written to are made from
+    the primary database, instead of from a replica that might not have
+    the write yet.
+    """
+    recentWrites = owner.recentWrites
+    if recentWrites is not None and recentWrites.isRecent(*keys):
+        return owner.dbpool
+    else:
+        return owner.readpool
+
+
 
 class Storage:
 
@@ -29,12 +106,37 @@ class Storage:
             }
     }
 
-    def __init__(self, dbpool):
+    def __init__(self, dbpool, batcher=None, readpool=None, cache=None,
+                       recentWrites=None, notifyChanges=False):
         self.dbpool = dbpool
+        self.batcher = batcher
+        self.readpool = readpool or dbpool
+        self.cache = cache
+        self.recentWrites = recentWrites
+        self.notifyChanges = notifyChanges or cache is not None
 
 
     def getNode(self, nodeIdentifier):
-        return self.dbpool.runInteraction(self._getNode, nodeIdentifier)
+        if self.cache is None:
+            readpool = _readpoolFor(self, ('node', nodeIdentifier))
+            return readpool.runInteraction(self._getNode, nodeIdentifier)
+
+        def makeNode(result):
+            nodeType, configuration = result
+            return self._makeNode(nodeIdentifier, nodeType,
+                                  copy.copy(configuration))
+
+        d = self.cache.get(nodeIdentifier, 'node', self._loadNode,
+                           nodeIdentifier)
+        d.addCallback(makeNode)
+        return d
+
+
+    def _loadNode(self, nodeIdentifier):
+        readpool = _readpoolFor(self, ('node', nodeIdentifier))
+        d = readpool.runInteraction(self._getNode, nodeIdentifier)
+        d.addCallback(lambda node: (node.nodeType, node.getConfiguration()))
+        return d
 
 
     def _getNode(self, cursor, nodeIdentifier):
@@ -57,29 +159,79 @@ class Storage:
                     'pubsub#deliver_payloads': row.deliver_payloads,
                     'pubsub#send_last_published_item':
                         row.send_last_published_item}
-            node = LeafNode(nodeIdentifier, configuration)
-            node.dbpool = self.dbpool
-            return node
         elif row.node_type == 'collection':
             configuration = {
                     'pubsub#deliver_payloads': row.deliver_payloads,
                     'pubsub#send_last_published_item':
                         row.send_last_published_item}
-            node = CollectionNode(nodeIdentifier, configuration)
-            node.dbpool = self.dbpool
-            return node
+
+        return self._makeNode(nodeIdentifier, row.node_type, configuration)
 
 
+    def _makeNode(self, nodeIdentifier, nodeType, configuration):
+        if nodeType == 'leaf':
+            node = self._makeLeafNode(nodeIdentifier, configuration)
+            node.batcher = self.batcher
+        else:
+            node = self._makeCollectionNode(nodeIdentifier, configuration)
+
+        node.dbpool = self.dbpool
+        node.readpool = self.readpool
+        node.cache = self.cache
+        node.recentWrites = self.recentWrites
+        node.notifyChanges = self.notifyChanges
+        return node
+
+
+    def _makeLeafNode(self, nodeIdentifier, config):
+        return LeafNode(nodeIdentifier, config)
+
+
+    def _makeCollectionNode(self, nodeIdentifier, config):
+        return CollectionNode(nodeIdentifier, config)
 
-    def getNodeIds(self):
-        d = self.dbpool.runQuery("""SELECT node from nodes""")
+
+    def getNodeIds(self, after=None, maxNodes=None):
+        # Pages are selected on the node key, instead of with an OFFSET, so
+        # that the unique index on node is used to find the start of a page.
+        query = """SELECT node FROM nodes"""
+        args = []
+
+        if after is not None:
+            query += """ WHERE node > %s"""
+            args.append(after)
+
+        query += """ ORDER BY node"""
+
+        if maxNodes is not None:
+            query += """ LIMIT %s"""
+            args.append(maxNodes)
+
+        # Listings are not about a single node, and always come from the
+        # replica, if any.
+        d = self.readpool.runQuery(query, args)
         d.addCallback(lambda results: [r[0] for r in results])
         return d
 
 
+    def getNodesVersion(self):
+        # Every node created takes a new node id from the sequence, and
+        # every node deleted lowers the number of nodes, so that they
+        # never return to an earlier combination.
+        d = self.readpool.runQuery("""SELECT
+                                      (SELECT last_value
+                                       FROM nodes_node_id_seq),
+                                      count(*)
+                                      FROM nodes""")
+        d.addCallback(lambda results: ('%d-%d' % tuple(results[0]), None))
+        return d
+
+
     def createNode(self, nodeIdentifier, owner, config):
-        return self.dbpool.runInteraction(self._createNode, nodeIdentifier,
-                                           owner, config)
+        d = _runChange(self, nodeIdentifier, self._createNode,
+                       nodeIdentifier, owner, config)
+        return _recordWrite(d, self.recentWrites, ('node', nodeIdentifier),
+                            ('entity', owner.userhost()))
 
 
     def _createNode(self, cursor, nodeIdentifier, owner, config):
@@ -119,7 +271,9 @@ class Storage:
 
 
     def deleteNode(self, nodeIdentifier):
-        return self.dbpool.runInteraction(self._deleteNode, nodeIdentifier)
+        d = _runChange(self, nodeIdentifier, self._deleteNode,
+                       nodeIdentifier)
+        return _recordWrite(d, self.recentWrites, ('node', nodeIdentifier))
 
 
     def _deleteNode(self, cursor, nodeIdentifier):
@@ -131,11 +285,12 @@ class Storage:
 
 
     def getAffiliations(self, entity):
-        d = self.dbpool.runQuery("""SELECT node, affiliation FROM entities
-                                        NATURAL JOIN affiliations
-                                        NATURAL JOIN nodes
-                                        WHERE jid=%s""",
-                                     (entity.userhost(),))
+        readpool = _readpoolFor(self, ('entity', entity.userhost()))
+        d = readpool.runQuery("""SELECT node, affiliation FROM entities
+                                 NATURAL JOIN affiliations
+                                 NATURAL JOIN nodes
+                                 WHERE jid=%s""",
+                              (entity.userhost(),))
         d.addCallback(lambda results: [tuple(r) for r in results])
         return d
 
@@ -150,12 +305,13 @@ class Storage:
                 subscriptions.append(subscription)
             return subscriptions
 
-        d = self.dbpool.runQuery("""SELECT node, jid, resource, state
-                                     FROM entities
-                                     NATURAL JOIN subscriptions
-                                     NATURAL JOIN nodes
-                                     WHERE jid=%s""",
-                                  (entity.userhost(),))
+        readpool = _readpoolFor(self, ('entity', entity.userhost()))
+        d = readpool.runQuery("""SELECT node, jid, resource, state
+                                 FROM entities
+                                 NATURAL JOIN subscriptions
+                                 NATURAL JOIN nodes
+                                 WHERE jid=%s""",
+                              (entity.userhost(),))
         d.addCallback(toSubscriptions)
         return d
 
@@ -169,11 +325,25 @@ class Node:
 
     implements(iidavoll.INode)
 
+    batcher = None
+    cache = None
+    recentWrites = None
+    notifyChanges = False
+
     def __init__(self, nodeIdentifier, config):
         self.nodeIdentifier = nodeIdentifier
         self._config = config
 
 
+    def _readpool(self, *keys):
+        return _readpoolFor(self, ('node', self.nodeIdentifier), *keys)
+
+
+    def _recordWrite(self, d, *keys):
+        return _recordWrite(d, self.recentWrites,
+                            ('node', self.nodeIdentifier), *keys)
+
+
     def _checkNodeExists(self, cursor):
         cursor.execute("""SELECT node_id FROM nodes WHERE node=%s""",
                        (self.nodeIdentifier))
@@ -196,7 +366,9 @@ class Node:
             if option in config:
                 config[option] = options[option]
 
-        d = self.dbpool.runInteraction(self._setConfiguration, config)
+        d = _runChange(self, self.nodeIdentifier,
+                       self._setConfiguration, config)
+        self._recordWrite(d)
         d.addCallback(self._setCachedConfiguration, config)
         return d
 
@@ -207,7 +379,7 @@ class Node:
                                            deliver_payloads=%s,
                                            send_last_published_item=%s
                           WHERE node=%s""",
-                       (config["pubsub#persist_items"],
+                       (config.get("pubsub#persist_items"),
                         config["pubsub#deliver_payloads"],
                         config["pubsub#send_last_published_item"],
                         self.nodeIdentifier))
@@ -224,7 +396,23 @@ class Node:
 
 
     def getAffiliation(self, entity):
-        return self.dbpool.runInteraction(self._getAffiliation, entity)
+        if self.cache is None:
+            readpool = self._readpool(('entity', entity.userhost()))
+            return readpool.runInteraction(self._getAffiliation, entity)
+
+        d = self.cache.get(self.nodeIdentifier, 'affiliations',
+                           self._loadAffiliations)
+        d.addCallback(lambda affiliations:
+                          affiliations.get(entity.userhost()))
+        return d
+
+
+    def _loadAffiliations(self):
+        d = self.getAffiliations()
+        d.addCallback(lambda affiliations:
+                          dict((entity.userhost(), affiliation)
+                               for entity, affiliation in affiliations))
+        return d
 
 
     def _getAffiliation(self, cursor, entity):
@@ -243,7 +431,8 @@ class Node:
 
 
     def getSubscription(self, subscriber):
-        return self.dbpool.runInteraction(self._getSubscription, subscriber)
+        readpool = self._readpool(('entity', subscriber.userhost()))
+        return readpool.runInteraction(self._getSubscription, subscriber)
 
 
     def _getSubscription(self, cursor, subscriber):
@@ -267,7 +456,20 @@ class Node:
 
 
     def getSubscriptions(self, state=None):
-        return self.dbpool.runInteraction(self._getSubscriptions, state)
+        if self.cache is None:
+            return self._readpool().runInteraction(self._getSubscriptions,
+                                                   state)
+
+        d = self.cache.get(self.nodeIdentifier, 'subscriptions',
+                           self._loadSubscriptions)
+        d.addCallback(lambda subscriptions:
+                          [subscription for subscription in subscriptions
+                           if state is None or subscription.state == state])
+        return d
+
+
+    def _loadSubscriptions(self):
+        return self._readpool().runInteraction(self._getSubscriptions, None)
 
 
     def _getSubscriptions(self, cursor, state):
@@ -305,8 +507,9 @@ class Node:
 
 
     def addSubscription(self, subscriber, state, config):
-        return self.dbpool.runInteraction(self._addSubscription, subscriber,
-                                          state, config)
+        d = _runChange(self, self.nodeIdentifier,
+                       self._addSubscription, subscriber, state, config)
+        return self._recordWrite(d, ('entity', subscriber.userhost()))
 
 
     def _addSubscription(self, cursor, subscriber, state, config):
@@ -345,8 +548,9 @@ class Node:
 
 
     def removeSubscription(self, subscriber):
-        return self.dbpool.runInteraction(self._removeSubscription,
-                                           subscriber)
+        d = _runChange(self, self.nodeIdentifier,
+                       self._removeSubscription, subscriber)
+        return self._recordWrite(d, ('entity', subscriber.userhost()))
 
 
     def _removeSubscription(self, cursor, subscriber):
@@ -371,7 +575,8 @@ class Node:
 
 
     def isSubscribed(self, entity):
-        return self.dbpool.runInteraction(self._isSubscribed, entity)
+        readpool = self._readpool(('entity', entity.userhost()))
+        return readpool.runInteraction(self._isSubscribed, entity)
 
 
     def _isSubscribed(self, cursor, entity):
@@ -389,7 +594,7 @@ class Node:
 
 
     def getAffiliations(self):
-        return self.dbpool.runInteraction(self._getAffiliations)
+        return self._readpool().runInteraction(self._getAffiliations)
 
 
     def _getAffiliations(self, cursor):
@@ -413,7 +618,9 @@ class LeafNode(Node):
     nodeType = 'leaf'
 
     def storeItems(self, items, publisher):
-        return self.dbpool.runInteraction(self._storeItems, items, publisher)
+        runner = self.batcher or self.dbpool
+        d = runner.runInteraction(self._storeItems, items, publisher)
+        return self._recordWrite(d)
 
 
     def _storeItems(self, cursor, items, publisher):
@@ -422,30 +629,46 @@ class LeafNode(Node):
             self._storeItem(cursor, item, publisher)
 
 
-    def _storeItem(self, cursor, item, publisher):
+    def _storeItem(self, cursor, item, publisher, date=None):
+        """
+        Store an item.
+
+        @param date: The time of publication, in UTC, or C{None} for the
+                     current time of the database server.
+        @type date: L{datetime.datetime}
+        """
         data = item.toXml()
-        cursor.execute("""UPDATE items SET date=now(), publisher=%s, data=%s
+        if date is not None:
+            date = date.isoformat() + '+00:00'
+
+        cursor.execute("""UPDATE items SET date=COALESCE(%s, now()),
+                                           publisher=%s, data=%s
                           FROM nodes
                           WHERE nodes.node_id = items.node_id AND
                                 nodes.node = %s and items.item=%s""",
-                       (publisher.full(),
+                       (date,
+                        publisher.full(),
                         data,
                         self.nodeIdentifier,
                         item["id"]))
         if cursor.rowcount == 1:
             return
 
-        cursor.execute("""INSERT INTO items (node_id, item, publisher, data)
-                          SELECT node_id, %s, %s, %s FROM nodes
-                                                     WHERE node=%s""",
+        cursor.execute("""INSERT INTO items
+                          (node_id, item, publisher, data, date)
+                          SELECT node_id, %s, %s, %s, COALESCE(%s, now())
+                          FROM nodes
+                          WHERE node=%s""",
                        (item["id"],
                         publisher.full(),
                         data,
+                        date,
                         self.nodeIdentifier))
 
 
     def removeItems(self, itemIdentifiers):
-        return self.dbpool.runInteraction(self._removeItems, itemIdentifiers)
+        d = self.dbpool.runInteraction(self._removeItems, itemIdentifiers)
+        return self._recordWrite(d)
 
 
     def _removeItems(self, cursor, itemIdentifiers):
@@ -467,29 +690,80 @@ class LeafNode(Node):
         return deleted
 
 
-    def getItems(self, maxItems=None):
-        return self.dbpool.runInteraction(self._getItems, maxItems)
+    def getItems(self, maxItems=None, after=None, before=None, since=None):
+        return self._readpool().runInteraction(self._getItems, maxItems,
+                                               after, before, since)
 
 
-    def _getItems(self, cursor, maxItems):
-        self._checkNodeExists(cursor)
-        query = """SELECT data FROM nodes
+    def _getItemId(self, cursor, itemIdentifier):
+        cursor.execute("""SELECT item_id FROM nodes
+                          NATURAL JOIN items
+                          WHERE node=%s AND item=%s""",
+                       (self.nodeIdentifier,
+                        itemIdentifier))
+        row = cursor.fetchone()
+        if not row:
+            raise error.ItemNotFound()
+        return row[0]
+
+
+    def _getItemsQuery(self, cursor, maxItems, after, before, since):
+        # Items are ordered, and paged, on (date, item_id), using the index
+        # on (node_id, date, item_id). Pages before an item are selected in
+        # ascending order and reversed afterwards.
+        query = """SELECT item, data FROM nodes
                    NATURAL JOIN items
-                   WHERE node=%s ORDER BY date DESC"""
-        if maxItems:
-            cursor.execute(query + " LIMIT %s",
-                           (self.nodeIdentifier,
-                            maxItems))
+                   WHERE node=%s"""
+        args = [self.nodeIdentifier]
+
+        if isinstance(since, datetime.datetime):
+            query += """ AND date > %s"""
+            args.append(since.isoformat() + '+00:00')
+        elif since is not None:
+            query += """ AND (date, item_id) >
+                             (SELECT date, item_id FROM items
+                              WHERE item_id=%s)"""
+            args.append(self._getItemId(cursor, since))
+
+        if before is not None:
+            if before:
+                query += """ AND (date, item_id) >
+                                 (SELECT date, item_id FROM items
+                                  WHERE item_id=%s)"""
+                args.append(self._getItemId(cursor, before))
+            query += """ ORDER BY date ASC, item_id ASC"""
         else:
-            cursor.execute(query, (self.nodeIdentifier))
+            if after is not None:
+                query += """ AND (date, item_id) <
+                                 (SELECT date, item_id FROM items
+                                  WHERE item_id=%s)"""
+                args.append(self._getItemId(cursor, after))
+            query += """ ORDER BY date DESC, item_id DESC"""
+
+        if maxItems is not None:
+            query += """ LIMIT %s"""
+            args.append(maxItems)
+
+        return query, args
+
+
+    def _getItems(self, cursor, maxItems, after, before, since):
+        self._checkNodeExists(cursor)
+
+        query, args = self._getItemsQuery(cursor, maxItems, after, before,
+                                          since)
+        cursor.execute(query, args)
 
         result = cursor.fetchall()
-        items = [stripNamespace(parseXml(r[0])) for r in result]
+        if before is not None:
+            result = result[::-1]
+        items = [SerializedItem(r[1], r[0]) for r in result]
         return items
 
 
     def getItemsById(self, itemIdentifiers):
-        return self.dbpool.runInteraction(self._getItemsById, itemIdentifiers)
+        return self._readpool().runInteraction(self._getItemsById,
+                                               itemIdentifiers)
 
 
     def _getItemsById(self, cursor, itemIdentifiers):
@@ -503,12 +777,13 @@ class LeafNode(Node):
                             itemIdentifier))
             result = cursor.fetchone()
             if result:
-                items.append(parseXml(result[0]))
+                items.append(SerializedItem(result[0], itemIdentifier))
         return items
 
 
     def purge(self):
-        return self.dbpool.runInteraction(self._purge)
+        d = self.dbpool.runInteraction(self._purge)
+        return self._recordWrite(d)
 
 
     def _purge(self, cursor):
@@ -525,6 +800,395 @@ class CollectionNode(Node):
 
 
 
+class CommitBatcher(object):
+    """
+    Run interactions from concurrent callers in shared transactions.
+
+    Interactions passed to L{runInteraction} within C{window} seconds of
+    each other, up to C{maxBatch} of them, are run one after the other in a
+    single transaction, so that they share a single commit. Each interaction
+    runs under its own savepoint, so that one that fails is rolled back
+    without affecting the others. The Deferred for each interaction fires
+    with its own result, once the shared transaction has been committed.
+
+    @ivar dbpool: The database connection pool.
+    @type dbpool: L{adbapi.ConnectionPool}
+    @ivar window: Seconds to wait for more interactions before running
+                  a batch.
+    @type window: C{float}
+    @ivar maxBatch: Maximum number of interactions in a batch.
+    @type maxBatch: C{int}
+    @ivar clock: Provider of delayed calls, for running batches.
+    @type clock: L{IReactorTime<twisted.internet.interfaces.IReactorTime>}
+    """
+
+    def __init__(self, dbpool, window=0.0005, maxBatch=100, clock=None):
+        self.dbpool = dbpool
+        self.window = window
+        self.maxBatch = maxBatch
+        self.clock = clock or reactor
+        self._pending = []
+        self._call = None
+
+
+    def runInteraction(self, interaction, *args, **kw):
+        """
+        Run an interaction in the next shared transaction.
+
+        @return: Deferred that fires with the result of the interaction,
+                 after the transaction has been committed.
+        """
+        d = defer.Deferred()
+        self._pending.append((interaction, args, kw, d))
+
+        if len(self._pending) >= self.maxBatch:
+            self._runBatch()
+        elif self._call is None:
+            self._call = self.clock.callLater(self.window, self._runBatch)
+
+        return d
+
+
+    def _runBatch(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        batch, self._pending = self._pending, []
+        interactions = [(interaction, args, kw)
+                        for interaction, args, kw, d in batch]
+        deferreds = [d for interaction, args, kw, d in batch]
+
+        def committed(results):
+            for d, (success, result) in zip(deferreds, results):
+                if success:
+                    d.callback(result)
+                else:
+                    d.errback(result)
+
+        def failed(reason):
+            for d in deferreds:
+                d.errback(reason)
+
+        d = self.dbpool.runInteraction(self._runInteractions, interactions)
+        d.addCallbacks(committed, failed)
+
+
+    def _runInteractions(self, cursor, interactions):
+        results = []
+        for interaction, args, kw in interactions:
+            cursor.execute("""SAVEPOINT batched""")
+            try:
+                result = interaction(cursor, *args, **kw)
+            except Exception:
+                cursor.execute("""ROLLBACK TO SAVEPOINT batched""")
+                results.append((False, failure.Failure()))
+            else:
+                cursor.execute("""RELEASE SAVEPOINT batched""")
+                results.append((True, result))
+        return results
+
+
+
+class RecentWrites(object):
+    """
+    Nodes and entities that have recently been written to.
+
+    Reads about these are made from the primary database, until C{window}
+    seconds after the write, as a replica might not have the write yet.
+    Keys are C{('node', nodeIdentifier)} and C{('entity', userhost)}.
+
+    @ivar window: Seconds after a write during which reads are made from
+                  the primary database.
+    @type window: C{float}
+    @ivar clock: Provider of the current time.
+    @type clock: L{IReactorTime<twisted.internet.interfaces.IReactorTime>}
+    """
+
+    def __init__(self, window=1, clock=None):
+        self.window = window
+        self.clock = clock or reactor
+        self._written = {}
+        self._pruned = 0
+
+
+    def add(self, *keys):
+        """
+        Record a write about the given keys.
+        """
+        now = self.clock.seconds()
+        for key in keys:
+            self._written[key] = now
+
+        if now - self._pruned > self.window:
+            self._written = dict((key, written)
+                                 for key, written in self._written.iteritems()
+                                 if now - written < self.window)
+            self._pruned = now
+
+
+    def isRecent(self, *keys):
+        """
+        Return whether any of the keys have recently been written to.
+        """
+        now = self.clock.seconds()
+        for key in keys:
+            written = self._written.get(key)
+            if written is not None and now - written < self.window:
+                return True
+        return False
+
+
+
+class NodeCache(object):
+    """
+    Cache of the configuration, affiliations and subscriptions of nodes.
+
+    Values loaded while a node is invalidated are not kept, as they might
+    have been read before the change. When more than C{maxNodes} nodes are
+    cached, the least recently used are dropped.
+
+    @ivar maxNodes: The maximum number of nodes to cache.
+    @type maxNodes: C{int}
+    """
+
+    def __init__(self, maxNodes=10000):
+        self.maxNodes = maxNodes
+        self._nodes = OrderedDict()
+        self._generation = 0
+
+
+    def get(self, nodeIdentifier, key, load, *args):
+        """
+        Get a cached value of a node, loading it if it is not cached.
+
+        @param key: The kind of value, like C{'subscriptions'}.
+        @type key: C{str}
+        @param load: Callable that returns a Deferred that fires with the
+                     value, called with C{args}.
+        @return: Deferred that fires with the value. It is shared with
+                 other callers, and must not be changed.
+        @rtype: L{Deferred<twisted.internet.defer.Deferred>}
+        """
+        values = self._nodes.pop(nodeIdentifier, None)
+        if values is not None:
+            self._nodes[nodeIdentifier] = values
+            if key in values:
+                return defer.succeed(values[key])
+
+        d = load(*args)
+        d.addCallback(self._loaded, nodeIdentifier, key, self._generation)
+        return d
+
+
+    def _loaded(self, value, nodeIdentifier, key, generation):
+        if generation == self._generation:
+            self._nodes.setdefault(nodeIdentifier, {})[key] = value
+            while len(self._nodes) > self.maxNodes:
+                self._nodes.popitem(last=False)
+        return value
+
+
+    def invalidate(self, nodeIdentifier):
+        """
+        Drop the cached values of a node.
+        """
+        self._generation += 1
+        self._nodes.pop(nodeIdentifier, None)
+
+
+    def clear(self):
+        """
+        Drop the cached values of all nodes.
+        """
+        self._generation += 1
+        self._nodes = OrderedDict()
+
+
+
+class ChangeListener(service.Service):
+    """
+    Invalidates nodes changed by other processes in a cache.
+
+    Changes are recorded in the C{node_changes} table by the process that
+    makes them, which then sends a notification with C{NOTIFY
+    node_changes}. The listener does a C{LISTEN} on a connection of its
+    own, made with the parameters of the connection pool, and reads the
+    changes after the last one it has seen when it is notified.
+
+    As transactions might commit in another order than that of their
+    change identifiers, gaps in them are read again until they are filled,
+    or are older than C{gapTimeout} seconds, for transactions that have
+    been rolled back. When the connection is made again, the whole cache
+    is cleared, as changes might have been missed.
+
+    @ivar cache: The cache to invalidate nodes in.
+    @type cache: L{NodeCache}
+    @ivar dbpool: The connection pool of the storage.
+    @type dbpool: L{adbapi.ConnectionPool}
+    @ivar recentWrites: If given, changed nodes are recorded as recently
+                        written to, so that they are loaded into the cache
+                        from the primary database instead of a replica.
+    @type recentWrites: L{RecentWrites}
+    @ivar timeout: Seconds to wait for a notification, before checking if
+                   the service is still running.
+    @ivar retryDelay: Seconds to wait before connecting again after an
+                      error.
+    @ivar gapTimeout: Seconds after which a gap in the change identifiers
+                      is skipped.
+    @ivar pruneAge: Seconds after which recorded changes are removed.
+    """
+
+    timeout = 1
+    retryDelay = 5
+    gapTimeout = 60
+    pruneAge = 3600
+
+    def __init__(self, cache, dbpool, recentWrites=None):
+        self.cache = cache
+        self.dbpool = dbpool
+        self.recentWrites = recentWrites
+        self._connection = None
+        self._call = None
+        self._low = 0
+        self._seen = set()
+        self._gaps = {}
+        self._lastPruned = 0
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self._poll()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+
+    def _poll(self):
+        self._call = None
+        d = threads.deferToThread(self._waitForChanges)
+        d.addCallbacks(self._changesReceived, self._pollFailed)
+
+
+    def _changesReceived(self, nodeIdentifiers):
+        if nodeIdentifiers is None:
+            self.cache.clear()
+        else:
+            for nodeIdentifier in nodeIdentifiers:
+                if self.recentWrites is not None:
+                    self.recentWrites.add(('node', nodeIdentifier))
+                self.cache.invalidate(nodeIdentifier)
+
+        if self.running:
+            self._poll()
+        else:
+            threads.deferToThread(self._close)
+
+
+    def _pollFailed(self, reason):
+        log.err(reason, "Error while listening for node changes")
+        self._close()
+        if self.running:
+            self._call = reactor.callLater(self.retryDelay, self._poll)
+
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except self.dbpool.dbapi.Error:
+                pass
+            self._connection = None
+
+
+    def _connect(self):
+        self._connection = self.dbpool.dbapi.connect(*self.dbpool.connargs,
+                                                     **self.dbpool.connkw)
+        cursor = self._connection.cursor()
+        cursor.execute("""LISTEN node_changes""")
+        cursor.execute("""SELECT COALESCE(MAX(change_id), 0)
+                          FROM node_changes""")
+        self._low = cursor.fetchone()[0]
+        self._seen = set()
+        self._gaps = {}
+        self._connection.commit()
+
+
+    def _wait(self, timeout):
+        """
+        Wait for notifications on the connection.
+
+        @return: Whether notifications have been received.
+        @rtype: C{bool}
+        """
+        conn = self._connection.conn
+        select.select([conn.socket], [], [], timeout)
+        conn.consumeInput()
+
+        notified = False
+        while conn.notifies() is not None:
+            notified = True
+        return notified
+
+
+    def _waitForChanges(self):
+        """
+        Wait for changes, in a thread.
+
+        @return: The identifiers of the changed nodes, or C{None} if the
+                 connection has been made again.
+        """
+        if self._connection is None:
+            self._connect()
+            return None
+
+        if not self._wait(self.timeout):
+            return []
+
+        cursor = self._connection.cursor()
+        cursor.execute("""SELECT change_id, node FROM node_changes
+                          WHERE change_id > %s
+                          ORDER BY change_id""",
+                       (self._low,))
+        rows = cursor.fetchall()
+
+        now = time.time()
+        if now - self._lastPruned > self.pruneAge / 10:
+            cursor.execute("""DELETE FROM node_changes
+                              WHERE date < now() - %s * interval '1 second'""",
+                           (self.pruneAge,))
+            self._lastPruned = now
+
+        self._connection.commit()
+        return self._processChanges(rows, now)
+
+
+    def _processChanges(self, rows, now):
+        nodeIdentifiers = set()
+        for changeId, nodeIdentifier in rows:
+            if changeId not in self._seen:
+                self._seen.add(changeId)
+                nodeIdentifiers.add(nodeIdentifier)
+
+        # Move past the changes that have been seen, and gaps that are
+        # expected to stay.
+        while self._seen:
+            nextId = self._low + 1
+            if nextId in self._seen:
+                self._seen.remove(nextId)
+            elif now - self._gaps.setdefault(nextId, now) < self.gapTimeout:
+                break
+            self._gaps.pop(nextId, None)
+            self._low = nextId
+
+        return nodeIdentifiers
+
+
+
 class GatewayStorage(object):
     """
     Memory based storage facility for the XMPP-HTTP gateway.
@@ -546,7 +1210,7 @@ class GatewayStorage(object):
         return results[0][0]
 
 
-    def addCallback(self, service, nodeIdentifier, callback):
+    def addCallback(self, service, nodeIdentifier, callback, encoding=None):
         def interaction(cursor):
             cursor.execute("""SELECT 1 FROM callbacks
                               WHERE service=%s and node=%s and uri=%s""",
@@ -554,14 +1218,21 @@ class GatewayStorage(object):
                            nodeIdentifier,
                            callback)
             if cursor.fetchall():
+                cursor.execute("""UPDATE callbacks SET encoding=%s
+                                  WHERE service=%s and node=%s and uri=%s""",
+                               encoding,
+                               service.full(),
+                               nodeIdentifier,
+                               callback)
                 return
 
             cursor.execute("""INSERT INTO callbacks
-                              (service, node, uri) VALUES
-                              (%s, %s, %s)""",
+                              (service, node, uri, encoding) VALUES
+                              (%s, %s, %s, %s)""",
                            service.full(),
                            nodeIdentifier,
-                           callback)
+                           callback,
+                           encoding)
 
         return self.dbpool.runInteraction(interaction)
 
@@ -584,7 +1255,7 @@ class GatewayStorage(object):
 
     def getCallbacks(self, service, nodeIdentifier):
         def interaction(cursor):
-            cursor.execute("""SELECT uri FROM callbacks
+            cursor.execute("""SELECT uri, encoding FROM callbacks
                               WHERE service=%s and node=%s""",
                            service.full(),
                            nodeIdentifier)
@@ -593,7 +1264,7 @@ class GatewayStorage(object):
             if not results:
                 raise error.NoCallbacks()
 
-            return [result[0] for result in results]
+            return dict(results)
 
         return self.dbpool.runInteraction(interaction)
 
@@ -0,0 +1,370 @@
+# -*- test-case-name: idavoll.test.test_protocol -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+XMPP protocol handlers extending those of Wokkel.
+"""
+
+import datetime
+import re
+
+from twisted.internet import defer, reactor
+from twisted.words.protocols.jabber import jid
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.xish import domish
+
+from wokkel import disco, shim
+from wokkel.iwokkel import IDisco
+from wokkel.pubsub import PubSubRequest, PubSubService as BasePubSubService
+
+from idavoll import rsm
+from idavoll.serialized import SerializedItem
+
+def _getItemIdentifier(item):
+    """
+    Get the identifier of an item, parsed or as returned by a storage.
+    """
+    if isinstance(item, SerializedItem):
+        return item.itemIdentifier
+    else:
+        return item.getAttribute('id')
+
+
+
+_DATETIME = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?'
+                       r'(?:[Zz]|([+-])(\d\d):(\d\d))$')
+
+def parseSince(value):
+    """
+    Parse the value of a C{Since} header of an items request.
+
+    A value in the date-time format of
+    U{XEP-0082<http://www.xmpp.org/extensions/xep-0082.html>} is taken as a
+    time, any other value as the identifier of an item.
+
+    @return: The time, in UTC, or the item identifier.
+    @rtype: L{datetime.datetime} or C{unicode}
+    """
+    match = _DATETIME.match(value.strip())
+    if match is None:
+        return value
+
+    dateTime, fraction, sign, hours, minutes = match.groups()
+    try:
+        since = datetime.datetime.strptime(dateTime, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return value
+
+    if fraction:
+        since += datetime.timedelta(
+                microseconds=int(fraction[:6].ljust(6, '0')))
+    if sign:
+        offset = datetime.timedelta(hours=int(hours), minutes=int(minutes))
+        if sign == '+':
+            since -= offset
+        else:
+            since += offset
+
+    return since
+
+
+
+class DiscoHandler(disco.DiscoHandler):
+    """
+    Service Discovery handler with Result Set Management for items.
+
+    Disco items requests that include a C{<set/>} element, as per
+    U{XEP-0059<http://www.xmpp.org/extensions/xep-0059.html>}, are answered
+    with a single page of items, followed by a C{<set/>} element describing
+    that page. Items are paged on their node identifier.
+
+    Sibling handlers can provide pages of items by implementing
+    C{getDiscoItemsPage}, see L{PubSubService.getDiscoItemsPage}. The items
+    of handlers that don't are only included in the first page.
+
+    @ivar maxPageSize: The maximum number of items in a page.
+    @type maxPageSize: C{int}
+    """
+
+    maxPageSize = 1000
+
+    def _onDiscoItems(self, iq):
+        rsmRequest = rsm.RSMRequest.fromElement(iq.query)
+        if rsmRequest is None:
+            return disco.DiscoHandler._onDiscoItems(self, iq)
+
+        if rsmRequest.before is not None:
+            raise StanzaError('feature-not-implemented')
+
+        requestor = jid.internJID(iq["from"])
+        target = jid.internJID(iq["to"])
+        nodeIdentifier = iq.query.getAttribute("node", '')
+
+        maxItems = self.maxPageSize
+        if rsmRequest.max is not None:
+            maxItems = min(rsmRequest.max, maxItems)
+
+        def toResponse(items):
+            items = items[:maxItems]
+
+            response = disco.DiscoItems()
+            response.nodeIdentifier = nodeIdentifier
+
+            for item in items:
+                response.append(item)
+
+            element = response.toElement()
+            keys = [item.nodeIdentifier for item in items]
+            element.addChild(rsm.RSMResponse.fromKeys(keys).toElement())
+            return element
+
+        d = self.itemsPage(requestor, target, nodeIdentifier,
+                           rsmRequest.after, maxItems)
+        d.addCallback(toResponse)
+        return d
+
+
+    def itemsPage(self, requestor, target, nodeIdentifier, after, maxItems):
+        """
+        Inspect all sibling protocol handlers for a page of disco items.
+
+        @param after: The node identifier of the item after which the page
+                      starts, or C{None} for the first page.
+        @type after: C{unicode}
+        @param maxItems: The maximum number of items in the page.
+        @type maxItems: C{int}
+        @return: Deferred with the gathered results from sibling handlers.
+        @rtype: L{defer.Deferred}
+        """
+        dl = []
+        for handler in self.parent:
+            if not IDisco.providedBy(handler):
+                continue
+
+            if hasattr(handler, 'getDiscoItemsPage'):
+                d = defer.maybeDeferred(handler.getDiscoItemsPage,
+                                        requestor, target, nodeIdentifier,
+                                        after, maxItems)
+            elif after is None:
+                d = defer.maybeDeferred(handler.getDiscoItems,
+                                        requestor, target, nodeIdentifier)
+            else:
+                continue
+
+            dl.append(d)
+
+        return self._gatherResults(dl)
+
+
+
+class SendBuffer(object):
+    """
+    Buffer for stanzas, to send them in large chunks.
+
+    Stanzas passed to L{send} are serialized right away, and sent on
+    together as a single string once C{maxSize} bytes have been buffered,
+    or at the end of the current reactor iteration. This saves the
+    overhead of each write to the stream and its transport when sending
+    many stanzas at once.
+
+    @ivar maxSize: Number of buffered bytes at which the buffer is flushed.
+    @type maxSize: C{int}
+    @ivar clock: Provider of delayed calls, for flushing the buffer.
+    @type clock: L{IReactorTime<twisted.internet.interfaces.IReactorTime>}
+    """
+
+    def __init__(self, send, maxSize=65536, clock=None):
+        """
+        @param send: Callable that sends the buffered data, as a C{str}.
+        """
+        self._send = send
+        self.maxSize = maxSize
+        self.clock = clock or reactor
+        self._buffer = []
+        self._size = 0
+        self._call = None
+
+
+    def send(self, stanza):
+        """
+        Buffer a stanza to be sent.
+
+        @type stanza: L{domish.Element}
+        """
+        data = stanza.toXml().encode('utf-8')
+        self._buffer.append(data)
+        self._size += len(data)
+
+        if self._size >= self.maxSize:
+            self.flush()
+        elif self._call is None:
+            self._call = self.clock.callLater(0, self.flush)
+
+
+    def flush(self):
+        """
+        Send all buffered stanzas.
+        """
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._send(data)
+
+
+
+class PubSubService(BasePubSubService):
+    """
+    Publish-subscribe service that can list its nodes and items in pages.
+
+    Items requests that include a C{<set/>} element, as per
+    U{XEP-0059<http://www.xmpp.org/extensions/xep-0059.html>}, get the
+    parsed L{rsm.RSMRequest} as the C{rsm} attribute of the request passed
+    to the resource. Items are paged on their item identifier, from most
+    recently to least recently published. The response then includes a
+    C{<set/>} element describing the returned page.
+
+    Items requests can also include a C{Since} header, as per
+    U{XEP-0131<http://www.xmpp.org/extensions/xep-0131.html>}, in the
+    C{<pubsub/>} element, to only get the items published after the given
+    time or item, see L{parseSince}. The parsed value is passed as the
+    C{since} attribute of the request, or C{None} without the header.
+
+    Notifications are sent through a L{SendBuffer}, so that those for a
+    single publish are written to the stream in a few large chunks. If the
+    parent of this handler has a C{sendBuffer}, like
+    L{ComponentPool<idavoll.component.ComponentPool>}, that is used
+    instead.
+
+    @ivar maxPageSize: The maximum number of items in a page.
+    @type maxPageSize: C{int}
+    @ivar sendBuffer: The buffer for notifications.
+    @type sendBuffer: L{SendBuffer}
+    @ivar workers: The worker processes that send notifications, or
+                   C{None} to send them from this process.
+    @type workers: L{WorkerPool<idavoll.workers.WorkerPool>}
+    """
+
+    maxPageSize = 1000
+    workers = None
+
+    def __init__(self, resource=None):
+        BasePubSubService.__init__(self, resource)
+        self.sendBuffer = SendBuffer(self._sendBuffered)
+
+
+    def _sendBuffered(self, data):
+        self.send(data)
+
+
+    def getDiscoInfo(self, requestor, target, nodeIdentifier):
+        def addFeatures(info):
+            if not nodeIdentifier:
+                info.append(disco.DiscoFeature(rsm.NS_RSM))
+                info.append(disco.DiscoFeature(shim.NS_SHIM))
+                info.append(disco.DiscoFeature(shim.NS_SHIM + '#Since'))
+            return info
+
+        d = BasePubSubService.getDiscoInfo(self, requestor, target,
+                                           nodeIdentifier)
+        d.addCallback(addFeatures)
+        return d
+
+
+    def getDiscoItemsPage(self, requestor, target, nodeIdentifier, after,
+                                maxItems):
+        """
+        Get a page of disco items for the nodes of this service.
+
+        This requires the resource to accept the C{after} and C{maxNodes}
+        arguments to C{getNodes}, like
+        L{idavoll.backend.PubSubResourceFromBackend} does.
+        """
+        if self.hideNodes or self.resource is None:
+            return defer.succeed([])
+
+        request = PubSubRequest('discoInfo')
+        resource = self.resource.locateResource(request)
+        if getattr(resource, 'hideNodes', False):
+            return defer.succeed([])
+
+        d = resource.getNodes(requestor, target, nodeIdentifier,
+                              after=after, maxNodes=maxItems)
+        d.addCallback(lambda nodes: [disco.DiscoItem(target, node)
+                                     for node in nodes])
+        return d
+
+
+    def _preProcess_items(self, resource, request):
+        request.rsm = rsm.RSMRequest.fromElement(request.element.pubsub)
+
+        if request.rsm is not None:
+            maxItems = self.maxPageSize
+            if request.rsm.max is not None:
+                maxItems = min(request.rsm.max, maxItems)
+            if request.maxItems is not None:
+                maxItems = min(request.maxItems, maxItems)
+            request.maxItems = maxItems
+
+        request.since = None
+        since = shim.extractHeaders(request.element.pubsub).get('Since')
+        if since:
+            request.since = parseSince(since[0])
+
+        return request
+
+
+    def _toResponse_items(self, result, resource, request):
+        response = BasePubSubService._toResponse_items(self, result,
+                                                       resource, request)
+
+        if getattr(request, 'rsm', None) is not None:
+            keys = [_getItemIdentifier(item) for item in result]
+            response.addChild(rsm.RSMResponse.fromKeys(keys).toElement())
+
+        return response
+
+
+    def notifyPublish(self, service, nodeIdentifier, notifications):
+        """
+        Send notifications of published items.
+
+        The event with the items is serialized once for all subscribers
+        that are notified of the same list of items, and inserted as is
+        in the message to each of them. Only the message envelopes, with
+        the addressing and collection headers, are serialized for each
+        subscriber. The messages are sent through L{sendBuffer}, or that
+        of the parent.
+
+        If there are L{workers}, the notifications are passed on to them
+        instead.
+        """
+        if self.workers is not None:
+            self.workers.notifyPublish(service, nodeIdentifier,
+                                       notifications)
+            return
+
+        parent = getattr(self, 'parent', None)
+        sendBuffer = getattr(parent, 'sendBuffer', self.sendBuffer)
+        events = {}
+        for subscriber, subscriptions, items in notifications:
+            message = self._createNotification('items', service,
+                                               nodeIdentifier, subscriber,
+                                               subscriptions)
+            event = message.event
+            try:
+                serialized = events[id(items)]
+            except KeyError:
+                event.items.children = items
+                serialized = domish.SerializedXML(event.toXml())
+                events[id(items)] = serialized
+
+            message.children[message.children.index(event)] = serialized
+            sendBuffer.send(message)
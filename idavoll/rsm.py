@@ -0,0 +1,133 @@
+# -*- test-case-name: idavoll.test.test_rsm -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+XMPP Result Set Management.
+
+This module implements the parts of
+U{XEP-0059<http://www.xmpp.org/extensions/xep-0059.html>} used to page
+through potentially large results, like the list of nodes in service
+discovery.
+"""
+
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.xish import domish
+
+NS_RSM = 'http://jabber.org/protocol/rsm'
+
+class RSMRequest(object):
+    """
+    A request for a page of a result set.
+
+    @ivar max: The maximum number of results in the page, or C{None} if the
+               requesting entity did not limit it.
+    @type max: C{int}
+    @ivar after: The key of the result after which the page starts, or
+                 C{None} to start at the beginning.
+    @type after: C{unicode}
+    @ivar before: The key of the result before which the page ends, C{''}
+                  for the last page, or C{None} if not paging backwards.
+    @type before: C{unicode}
+    """
+
+    def __init__(self, max=None, after=None, before=None):
+        self.max = max
+        self.after = after
+        self.before = before
+
+
+    @classmethod
+    def fromElement(cls, element):
+        """
+        Parse a request from the C{<set/>} child of C{element}.
+
+        @return: The request, or C{None} if there is no C{<set/>} element.
+        @rtype: L{RSMRequest}
+        @raise StanzaError: C{bad-request} if the request is malformed.
+        """
+        for setElement in element.elements():
+            if setElement.uri == NS_RSM and setElement.name == 'set':
+                break
+        else:
+            return None
+
+        request = cls()
+
+        for child in setElement.elements():
+            if child.uri != NS_RSM:
+                continue
+
+            if child.name == 'max':
+                try:
+                    request.max = int(unicode(child))
+                except ValueError:
+                    raise StanzaError('bad-request')
+
+                if request.max < 0:
+                    raise StanzaError('bad-request')
+            elif child.name == 'after':
+                request.after = unicode(child)
+            elif child.name == 'before':
+                request.before = unicode(child)
+
+        return request
+
+
+    def toElement(self):
+        set = domish.Element((NS_RSM, 'set'))
+
+        if self.max is not None:
+            set.addElement('max', content=unicode(self.max))
+        if self.after is not None:
+            set.addElement('after', content=self.after)
+        if self.before is not None:
+            set.addElement('before', content=self.before)
+
+        return set
+
+
+
+class RSMResponse(object):
+    """
+    The description of a page of a result set.
+
+    @ivar first: The key of the first result in the page, or C{None} if the
+                 page is empty.
+    @type first: C{unicode}
+    @ivar last: The key of the last result in the page, or C{None} if the
+                page is empty.
+    @type last: C{unicode}
+    @ivar count: The total number of results, or C{None} if unknown.
+    @type count: C{int}
+    """
+
+    def __init__(self, first=None, last=None, count=None):
+        self.first = first
+        self.last = last
+        self.count = count
+
+
+    @classmethod
+    def fromKeys(cls, keys, count=None):
+        """
+        Describe a page of results from the ordered keys of its results.
+        """
+        if keys:
+            return cls(keys[0], keys[-1], count)
+        else:
+            return cls(count=count)
+
+
+    def toElement(self):
+        set = domish.Element((NS_RSM, 'set'))
+
+        if self.first is not None:
+            set.addElement('first', content=self.first)
+        if self.last is not None:
+            set.addElement('last', content=self.last)
+        if self.count is not None:
+            set.addElement('count', content=unicode(self.count))
+
+        return set
@@ -0,0 +1,60 @@
+# -*- test-case-name: idavoll.test.test_storage -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Items kept in their serialized form.
+"""
+
+from twisted.words.xish import domish
+
+from wokkel.generic import parseXml
+
+class SerializedItem(domish.SerializedXML):
+    """
+    A stored item, in its serialized form.
+
+    Storages return items as they were stored, without parsing them. Added
+    as a child to a DOM element, the item is written verbatim when that
+    element is serialized, so an item that is only passed on to an entity
+    is never parsed and serialized again. L{toElement} parses the item for
+    when its payload needs to be inspected.
+
+    @ivar itemIdentifier: The identifier of the item.
+    @type itemIdentifier: C{unicode}
+    """
+
+    def __new__(cls, data, itemIdentifier):
+        """
+        @param data: The serialized item, as C{unicode} or encoded in UTF-8.
+        @type data: C{unicode} or C{str}
+        @param itemIdentifier: The identifier of the item.
+        @type itemIdentifier: C{unicode} or C{str}
+        """
+        if isinstance(data, str):
+            data = data.decode('utf-8')
+        if isinstance(itemIdentifier, str):
+            itemIdentifier = itemIdentifier.decode('utf-8')
+
+        item = domish.SerializedXML.__new__(cls, data)
+        item.itemIdentifier = itemIdentifier
+        return item
+
+
+    def toXml(self):
+        """
+        Return the serialized item.
+
+        @rtype: C{unicode}
+        """
+        return unicode(self)
+
+
+    def toElement(self):
+        """
+        Parse the item.
+
+        @rtype: L{domish.Element}
+        """
+        return parseXml(self.encode('utf-8'))
@@ -0,0 +1,649 @@
+# -*- test-case-name: idavoll.test.test_sharding -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Backend sharded over several processes by node.
+
+Each shard is a process with a L{BackendService<idavoll.backend.
+BackendService>} of its own, over a storage of its own, that owns the nodes
+whose identifier hashes to it, see L{getNodeShard}. A shard serves its
+backend on a UNIX socket with L{ShardServerFactory}.
+
+The process that is connected to the Jabber server uses a L{ShardRouter} as
+its backend. Operations on a node are forwarded to the shard that owns it.
+Operations on all nodes of an entity, like retrieving its subscriptions and
+affiliations, and listing the nodes, are sent to all shards, and their
+results combined.
+
+Calls and their results are encoded as JSON, and passed as netstrings.
+Only plain values, JIDs, subscriptions, elements, serialized items and
+errors can be passed, tagged with their type, so that a connection to the
+socket of a shard can not make it run code. The socket is only accessible
+by its owner, see C{--shard-socket}.
+"""
+
+import uuid
+import zlib
+
+import simplejson
+
+from zope.interface import implements
+
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.error import ConnectionLost
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.words.protocols.jabber.jid import internJID, JID
+from twisted.words.xish import domish, utility
+
+from wokkel.generic import parseXml
+from wokkel.pubsub import Subscription
+
+from idavoll import error, iidavoll
+from idavoll.backend import BackendService
+from idavoll.serialized import SerializedItem
+
+def getNodeShard(nodeIdentifier, count):
+    """
+    Get the shard that owns a node.
+
+    @param nodeIdentifier: The identifier of the node.
+    @type nodeIdentifier: C{unicode}
+    @param count: The number of shards.
+    @type count: C{int}
+    @return: The index of the shard.
+    @rtype: C{int}
+    """
+    if isinstance(nodeIdentifier, unicode):
+        nodeIdentifier = nodeIdentifier.encode('utf-8')
+    return (zlib.crc32(nodeIdentifier) & 0xffffffff) % count
+
+
+
+def _encode(obj):
+    """
+    Encode a value as JSON compatible data.
+
+    Dictionaries, tuples and the values that JSON does not have are encoded
+    as a dictionary with a single key, the name of their type.
+    """
+    if obj is None or isinstance(obj, (bool, int, long, float)):
+        return obj
+    elif isinstance(obj, SerializedItem):
+        return {'item': [unicode(obj), obj.itemIdentifier]}
+    elif isinstance(obj, domish.SerializedXML):
+        return {'serialized': unicode(obj)}
+    elif isinstance(obj, basestring):
+        return obj
+    elif isinstance(obj, list):
+        return [_encode(value) for value in obj]
+    elif isinstance(obj, tuple):
+        return {'tuple': [_encode(value) for value in obj]}
+    elif isinstance(obj, (set, frozenset)):
+        return {'set': [_encode(value) for value in obj]}
+    elif isinstance(obj, dict):
+        return {'dict': [[_encode(key), _encode(value)]
+                         for key, value in obj.iteritems()]}
+    elif isinstance(obj, JID):
+        return {'jid': obj.full()}
+    elif isinstance(obj, Subscription):
+        return {'subscription': [obj.nodeIdentifier, obj.subscriber.full(),
+                                 obj.state, _encode(obj.options)]}
+    elif isinstance(obj, domish.Element):
+        return {'element': obj.toXml()}
+    elif isinstance(obj, error.Error):
+        return {'error': [obj.__class__.__name__, obj.msg]}
+    else:
+        raise TypeError("Can not pass %r to or from a shard" % (obj,))
+
+
+
+def _decodeError(name, msg):
+    cls = getattr(error, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, error.Error)):
+        cls = error.Error
+    return cls(msg)
+
+
+
+def _decodeElement(data):
+    element = parseXml(data.encode('utf-8'))
+    if not element.uri:
+        element.uri = element.defaultUri = None
+    return element
+
+
+
+def _decode(obj):
+    """
+    Decode a value encoded with L{_encode}.
+    """
+    if isinstance(obj, list):
+        return [_decode(value) for value in obj]
+    elif not isinstance(obj, dict):
+        return obj
+
+    (kind, value), = obj.items()
+    if kind == 'tuple':
+        return tuple([_decode(v) for v in value])
+    elif kind == 'set':
+        return set([_decode(v) for v in value])
+    elif kind == 'dict':
+        return dict([(_decode(k), _decode(v)) for k, v in value])
+    elif kind == 'jid':
+        return internJID(value)
+    elif kind == 'subscription':
+        nodeIdentifier, subscriber, state, options = value
+        return Subscription(nodeIdentifier, internJID(subscriber), state,
+                            _decode(options))
+    elif kind == 'item':
+        return SerializedItem(value[0], value[1])
+    elif kind == 'serialized':
+        return domish.SerializedXML(value)
+    elif kind == 'element':
+        return _decodeElement(value)
+    elif kind == 'error':
+        return _decodeError(*value)
+    else:
+        raise ValueError("Unknown type %r" % kind)
+
+
+
+def _dumps(obj):
+    return simplejson.dumps(_encode(obj), separators=(',', ':'))
+
+
+
+def _loads(data):
+    return _decode(simplejson.loads(data))
+
+
+
+class ShardServerProtocol(NetstringReceiver):
+    """
+    Connection of a router with a shard, at the side of the shard.
+    """
+
+    MAX_LENGTH = 2 ** 30
+
+    methods = frozenset([
+        'getNodeType', 'getNodes', 'getNodesVersion', 'getNodeMetaData',
+        'createNode', 'deleteNode', 'purgeNode', 'subscribe', 'unsubscribe',
+        'getSubscribers', 'getSubscriptions', 'getAffiliations', 'publish',
+        'getNotifications', 'getDefaultConfiguration',
+        'getNodeConfiguration', 'setNodeConfiguration', 'getItems',
+        'retractItem',
+        ])
+
+    def connectionMade(self):
+        NetstringReceiver.connectionMade(self)
+        self._eventId = 0
+        self._preDeletes = {}
+        self.factory.routers.add(self)
+
+
+    def connectionLost(self, reason):
+        self.factory.routers.discard(self)
+        preDeletes, self._preDeletes = self._preDeletes, {}
+        for d in preDeletes.itervalues():
+            d.callback(None)
+
+
+    def stringReceived(self, data):
+        message = _loads(data)
+        if message[0] == 'ack':
+            d = self._preDeletes.pop(message[1], None)
+            if d is not None:
+                d.callback(None)
+            return
+
+        callId, method, args, kwargs = message[1:]
+
+        if method in self.methods:
+            d = defer.maybeDeferred(getattr(self.factory.backend, method),
+                                    *args, **kwargs)
+        else:
+            d = defer.fail(error.Error("Unknown method %r" % method))
+
+        d.addCallbacks(self._sendResult, self._sendFailure,
+                       callbackArgs=(callId,), errbackArgs=(callId,))
+
+
+    def _sendResult(self, result, callId):
+        try:
+            data = _dumps(('result', callId, result))
+        except TypeError:
+            self._sendFailure(Failure(), callId)
+        else:
+            self.sendString(data)
+
+
+    def _sendFailure(self, failure, callId):
+        if not failure.check(error.Error):
+            log.err(failure)
+            exc = error.Error("Internal error")
+        else:
+            exc = failure.value
+        self.sendString(_dumps(('failure', callId, exc)))
+
+
+    def sendEvent(self, event, data):
+        self.sendString(_dumps(('event', event, data)))
+
+
+    def sendPreDelete(self, data):
+        """
+        Pass the data of a node that is about to be deleted to the router.
+
+        @return: Deferred that fires when the router has handled it, or the
+                 connection is lost.
+        @rtype: L{Deferred<twisted.internet.defer.Deferred>}
+        """
+        self._eventId += 1
+        d = defer.Deferred()
+        self._preDeletes[self._eventId] = d
+        self.sendString(_dumps(('preDelete', self._eventId, data)))
+        return d
+
+
+
+class ShardServerFactory(protocol.ServerFactory):
+    """
+    Serves a backend as a shard.
+
+    Notifications of publishes, and the data of nodes that are about to be
+    deleted, are passed on to all connected routers. Nodes are deleted once
+    the routers have handled their data.
+
+    @ivar backend: The backend of this shard.
+    @type backend: L{BackendService<idavoll.backend.BackendService>}
+    @ivar routers: The connections with routers.
+    @type routers: C{set} of L{ShardServerProtocol}
+    """
+
+    protocol = ShardServerProtocol
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.routers = set()
+        self.backend.registerNotifier(self._notify)
+        self.backend.registerPreDelete(self._preDelete)
+
+
+    def _sendEvent(self, event, data):
+        for router in self.routers:
+            router.sendEvent(event, data)
+
+
+    def _notify(self, data):
+        self._sendEvent('notify', data)
+
+
+    def _preDelete(self, data):
+        d = defer.gatherResults([router.sendPreDelete(data)
+                                 for router in self.routers])
+        d.addCallback(lambda _: None)
+        return d
+
+
+
+class ShardClientProtocol(NetstringReceiver):
+    """
+    Connection of a router with a shard, at the side of the router.
+    """
+
+    MAX_LENGTH = 2 ** 30
+
+    def connectionMade(self):
+        NetstringReceiver.connectionMade(self)
+        self.factory.shardConnected(self)
+
+
+    def connectionLost(self, reason):
+        self.factory.shardDisconnected(self, reason)
+
+
+    def stringReceived(self, data):
+        message = _loads(data)
+        if message[0] == 'event':
+            self.factory.router.eventReceived(message[1], message[2])
+        elif message[0] == 'preDelete':
+            eventId = message[1]
+            d = self.factory.router.preDeleteReceived(message[2])
+            d.addCallback(lambda _: self.sendString(_dumps(('ack',
+                                                            eventId))))
+        else:
+            self.factory.resultReceived(*message)
+
+
+
+class ShardClient(protocol.ReconnectingClientFactory):
+    """
+    Connection of a router with a shard.
+
+    Calls made while the shard is not connected are queued until it is.
+    Calls in progress when the connection is lost fail with
+    L{ConnectionLost}.
+
+    @ivar router: The router this shard belongs to.
+    @type router: L{ShardRouter}
+    @ivar path: The path of the UNIX socket of the shard.
+    @type path: C{str}
+    """
+
+    protocol = ShardClientProtocol
+    maxDelay = 5
+
+    def __init__(self, router, path):
+        self.router = router
+        self.path = path
+        self.connector = None
+        self.connection = None
+        self._callId = 0
+        self._queue = []
+        self._calls = {}
+
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
+
+    def shardConnected(self, connection):
+        self.connection = connection
+        for data in self._queue:
+            connection.sendString(data)
+        self._queue = []
+
+
+    def shardDisconnected(self, connection, reason):
+        self.connection = None
+        calls, self._calls = self._calls, {}
+        for d in calls.itervalues():
+            d.errback(ConnectionLost("Connection to shard %s lost" %
+                                     self.path))
+
+
+    def callRemote(self, method, *args, **kwargs):
+        """
+        Call a method of the backend of the shard.
+
+        @return: Deferred that fires with the result of the call.
+        @rtype: L{Deferred<twisted.internet.defer.Deferred>}
+        """
+        self._callId += 1
+        d = defer.Deferred()
+        self._calls[self._callId] = d
+        data = _dumps(('call', self._callId, method, args, kwargs))
+
+        if self.connection is not None:
+            self.connection.sendString(data)
+        else:
+            self._queue.append(data)
+
+        return d
+
+
+    def resultReceived(self, kind, callId, result):
+        d = self._calls.pop(callId, None)
+        if d is None:
+            return
+
+        if kind == 'result':
+            d.callback(result)
+        else:
+            d.errback(result)
+
+
+
+class ShardRouter(service.Service, utility.EventDispatcher):
+    """
+    Backend that forwards operations to the shards that own the nodes.
+
+    Notifications of publishes by the shards are dispatched as if published
+    through this backend. Before a node is deleted, the callbacks registered
+    with L{registerPreDelete} are called, and the shard waits for them.
+
+    @ivar shards: The connections with the shards, in order of their index.
+    @type shards: C{list} of L{ShardClient}
+    """
+
+    implements(iidavoll.IBackendService)
+
+    nodeOptions = BackendService.nodeOptions
+    subscriptionOptions = BackendService.subscriptionOptions
+
+    def __init__(self, paths):
+        utility.EventDispatcher.__init__(self)
+        self.shards = [ShardClient(self, path) for path in paths]
+        self._callbackList = []
+
+
+    def startService(self):
+        service.Service.startService(self)
+        for shard in self.shards:
+            shard.connector = reactor.connectUNIX(shard.path, shard)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for shard in self.shards:
+            shard.stopTrying()
+            shard.connector.disconnect()
+
+
+    def getShard(self, nodeIdentifier):
+        """
+        Get the shard that owns a node.
+
+        @rtype: L{ShardClient}
+        """
+        return self.shards[getNodeShard(nodeIdentifier, len(self.shards))]
+
+
+    def _callNode(self, nodeIdentifier, method, *args):
+        shard = self.getShard(nodeIdentifier)
+        return shard.callRemote(method, nodeIdentifier, *args)
+
+
+    def _callAll(self, method, *args):
+        d = defer.gatherResults([shard.callRemote(method, *args)
+                                 for shard in self.shards],
+                                consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+
+    def eventReceived(self, event, data):
+        """
+        Handle an event passed on by a shard.
+        """
+        if event == 'notify':
+            self.dispatch(data, '//event/pubsub/notify')
+
+
+    def preDeleteReceived(self, data):
+        """
+        Call the callbacks registered with L{registerPreDelete} for a node
+        that a shard is about to delete.
+
+        @return: Deferred that fires when all callbacks are done.
+        @rtype: L{Deferred<twisted.internet.defer.Deferred>}
+        """
+        dl = []
+        for preDeleteFn in self._callbackList:
+            d = defer.maybeDeferred(preDeleteFn, data)
+            d.addErrback(log.err)
+            dl.append(d)
+        return defer.gatherResults(dl)
+
+
+    def supportsPublisherAffiliation(self):
+        return True
+
+
+    def supportsOutcastAffiliation(self):
+        return True
+
+
+    def supportsPersistentItems(self):
+        return True
+
+
+    def supportsInstantNodes(self):
+        return True
+
+
+    def getNodeType(self, nodeIdentifier):
+        return self._callNode(nodeIdentifier, 'getNodeType')
+
+
+    def getNodes(self, after=None, maxNodes=None):
+        def merge(results):
+            # Each shard has a root node of its own.
+            nodeIdentifiers = set()
+            for result in results:
+                nodeIdentifiers.update(result)
+            nodeIdentifiers = sorted(nodeIdentifiers)
+            if maxNodes is not None:
+                nodeIdentifiers = nodeIdentifiers[:maxNodes]
+            return nodeIdentifiers
+
+        d = self._callAll('getNodes', after, maxNodes)
+        d.addCallback(merge)
+        return d
+
+
+    def getNodesVersion(self):
+        def merge(results):
+            versions = [version for version, lastModified in results]
+            modified = [lastModified for version, lastModified in results]
+            if None in modified:
+                return '.'.join(versions), None
+            else:
+                return '.'.join(versions), max(modified)
+
+        d = self._callAll('getNodesVersion')
+        d.addCallback(merge)
+        return d
+
+
+    def getNodeMetaData(self, nodeIdentifier):
+        return self._callNode(nodeIdentifier, 'getNodeMetaData')
+
+
+    def createNode(self, nodeIdentifier, requestor):
+        # Instant nodes get their identifier here, to pick their shard.
+        if not nodeIdentifier:
+            nodeIdentifier = 'generic/%s' % uuid.uuid4()
+
+        return self._callNode(nodeIdentifier, 'createNode', requestor)
+
+
+    def registerPreDelete(self, preDeleteFn):
+        self._callbackList.append(preDeleteFn)
+
+
+    def deleteNode(self, nodeIdentifier, requestor, redirectURI=None):
+        return self._callNode(nodeIdentifier, 'deleteNode', requestor,
+                              redirectURI)
+
+
+    def purgeNode(self, nodeIdentifier, requestor):
+        return self._callNode(nodeIdentifier, 'purgeNode', requestor)
+
+
+    def subscribe(self, nodeIdentifier, subscriber, requestor):
+        return self._callNode(nodeIdentifier, 'subscribe', subscriber,
+                              requestor)
+
+
+    def unsubscribe(self, nodeIdentifier, subscriber, requestor):
+        return self._callNode(nodeIdentifier, 'unsubscribe', subscriber,
+                              requestor)
+
+
+    def getSubscribers(self, nodeIdentifier):
+        return self._callNode(nodeIdentifier, 'getSubscribers')
+
+
+    def getSubscriptions(self, entity):
+        d = self._callAll('getSubscriptions', entity)
+        d.addCallback(lambda results: sum(results, []))
+        return d
+
+
+    def getAffiliations(self, entity):
+        d = self._callAll('getAffiliations', entity)
+        d.addCallback(lambda results: sum(results, []))
+        return d
+
+
+    def publish(self, nodeIdentifier, items, requestor):
+        return self._callNode(nodeIdentifier, 'publish', items, requestor)
+
+
+    def registerNotifier(self, observerfn, *args, **kwargs):
+        self.addObserver('//event/pubsub/notify', observerfn, *args, **kwargs)
+
+
+    def getNotifications(self, nodeIdentifier, items):
+        """
+        Get the notifications of a publish.
+
+        The items are not passed to the shards, but put into the
+        notifications here. The subscriptions to the root node are
+        retrieved from the shard that owns it, if it doesn't own the node
+        itself.
+        """
+        def merge(results):
+            subsBySubscriber = {}
+            for notifications in results:
+                for subscriber, subscriptions, ignored in notifications:
+                    subs = subsBySubscriber.setdefault(subscriber, {})
+                    for subscription in subscriptions:
+                        subs[subscription.nodeIdentifier] = subscription
+
+            return [(subscriber, subs.values(), items)
+                    for subscriber, subs in subsBySubscriber.iteritems()]
+
+        shard = self.getShard(nodeIdentifier)
+        dl = [shard.callRemote('getNotifications', nodeIdentifier, [])]
+
+        rootShard = self.getShard('')
+        if rootShard is not shard:
+            dl.append(rootShard.callRemote('getNotifications', '', []))
+
+        d = defer.gatherResults(dl, consumeErrors=True)
+        d.addCallbacks(merge, lambda failure: failure.value.subFailure)
+        return d
+
+
+    def getDefaultConfiguration(self, nodeType):
+        return self.shards[0].callRemote('getDefaultConfiguration', nodeType)
+
+
+    def getNodeConfiguration(self, nodeIdentifier):
+        return self._callNode(nodeIdentifier, 'getNodeConfiguration')
+
+
+    def setNodeConfiguration(self, nodeIdentifier, options, requestor):
+        return self._callNode(nodeIdentifier, 'setNodeConfiguration',
+                              options, requestor)
+
+
+    def getItems(self, nodeIdentifier, requestor, maxItems=None,
+                       itemIdentifiers=None, after=None, before=None,
+                       since=None):
+        return self._callNode(nodeIdentifier, 'getItems', requestor,
+                              maxItems, itemIdentifiers, after, before,
+                              since)
+
+
+    def retractItem(self, nodeIdentifier, itemIdentifiers, requestor):
+        return self._callNode(nodeIdentifier, 'retractItem',
+                              itemIdentifiers, requestor)
@@ -0,0 +1,300 @@
+# -*- test-case-name: idavoll.test.test_storage -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Storage on an embedded SQLite database.
+
+The database uses the same tables as L{idavoll.pgsql_storage}, and the
+storage classes here reuse its queries. The database is opened in WAL mode,
+so that readers don't block the writer or each other. All changes go
+through a single writer connection, in its own thread, while retrievals are
+spread over a pool of reader connections.
+"""
+
+import datetime
+import sqlite3
+
+from twisted.enterprise import adbapi
+
+from idavoll import pgsql_storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    entity_id integer PRIMARY KEY,
+    jid text NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id integer PRIMARY KEY AUTOINCREMENT,
+    node text NOT NULL UNIQUE,
+    node_type text NOT NULL DEFAULT 'leaf'
+        CHECK (node_type IN ('leaf', 'collection')),
+    persist_items boolean,
+    deliver_payloads boolean NOT NULL DEFAULT 1,
+    send_last_published_item text NOT NULL DEFAULT 'on_sub'
+        CHECK (send_last_published_item IN ('never', 'on_sub'))
+);
+
+INSERT OR IGNORE INTO nodes (node, node_type) VALUES ('', 'collection');
+
+CREATE TABLE IF NOT EXISTS affiliations (
+    affiliation_id integer PRIMARY KEY,
+    entity_id integer NOT NULL REFERENCES entities ON DELETE CASCADE,
+    node_id integer NOT NULL REFERENCES nodes ON DELETE CASCADE,
+    affiliation text NOT NULL
+        CHECK (affiliation IN ('outcast', 'publisher', 'owner')),
+    UNIQUE (entity_id, node_id)
+);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    subscription_id integer PRIMARY KEY,
+    entity_id integer NOT NULL REFERENCES entities ON DELETE CASCADE,
+    resource text,
+    node_id integer NOT NULL REFERENCES nodes ON DELETE CASCADE,
+    state text NOT NULL DEFAULT 'subscribed'
+        CHECK (state IN ('subscribed', 'pending', 'unconfigured')),
+    subscription_type text
+        CHECK (subscription_type IN (NULL, 'items', 'nodes')),
+    subscription_depth text
+        CHECK (subscription_depth IN (NULL, '1', 'all')),
+    UNIQUE (entity_id, resource, node_id)
+);
+
+CREATE TABLE IF NOT EXISTS items (
+    item_id integer PRIMARY KEY,
+    node_id integer NOT NULL REFERENCES nodes ON DELETE CASCADE,
+    item text NOT NULL,
+    publisher text NOT NULL,
+    data text,
+    date text NOT NULL,
+    UNIQUE (node_id, item)
+);
+
+CREATE INDEX IF NOT EXISTS items_node_id_date_item_id
+    ON items (node_id, date, item_id);
+
+CREATE TABLE IF NOT EXISTS callbacks (
+    service text NOT NULL,
+    node text NOT NULL,
+    uri text NOT NULL,
+    encoding text,
+    PRIMARY KEY (service, node, uri)
+);
+"""
+
+sqlite3.register_converter('boolean', lambda value: bool(int(value)))
+
+class Row(tuple):
+    """
+    Result row with its columns also available as attributes.
+    """
+
+    def __new__(cls, cursor, values):
+        row = tuple.__new__(cls, values)
+        row._names = [description[0] for description in cursor.description]
+        return row
+
+
+    def __getattr__(self, name):
+        try:
+            return self[self._names.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+
+
+class Transaction(adbapi.Transaction):
+    """
+    Transaction that runs queries written for L{pgsql_storage} on SQLite.
+
+    Parameters are passed in the C{format} style of pyPgSQL, and a single
+    parameter may be passed on its own. A violated constraint raises
+    C{OperationalError}, as it does with pyPgSQL.
+    """
+
+    def execute(self, query, *args):
+        if not args:
+            params = ()
+        elif len(args) > 1:
+            params = args
+        elif isinstance(args[0], (tuple, list)):
+            params = args[0]
+        else:
+            params = (args[0],)
+
+        try:
+            return self._cursor.execute(query.replace('%s', '?'), params)
+        except sqlite3.IntegrityError, e:
+            raise sqlite3.OperationalError(*e.args)
+
+
+
+class WriteTransaction(Transaction):
+    """
+    Transaction on the writer connection.
+
+    The transaction is started explicitly, instead of by the SQLite module
+    before the first change, as that commits before statements like
+    C{SAVEPOINT}, as used by L{pgsql_storage.CommitBatcher}.
+    """
+
+    def __init__(self, pool, connection):
+        Transaction.__init__(self, pool, connection)
+        self.execute("""BEGIN IMMEDIATE""")
+
+
+
+class _ReaderPool(adbapi.ConnectionPool):
+
+    transactionFactory = Transaction
+
+
+
+class _WriterPool(adbapi.ConnectionPool):
+
+    transactionFactory = WriteTransaction
+
+
+
+def _openWriter(connection):
+    connection.row_factory = Row
+    connection.text_factory = str
+    connection.isolation_level = None
+    connection.execute("""PRAGMA journal_mode=WAL""")
+    connection.execute("""PRAGMA synchronous=NORMAL""")
+    connection.execute("""PRAGMA foreign_keys=ON""")
+    connection.executescript(SCHEMA)
+
+
+
+def _openReader(connection):
+    connection.row_factory = Row
+    connection.text_factory = str
+    connection.execute("""PRAGMA query_only=ON""")
+
+
+
+class ConnectionPool(object):
+    """
+    Connections to an SQLite database: one writer and a pool of readers.
+
+    Interactions and queries are run on the writer connection, in a
+    dedicated thread, so that changes are never held up waiting for the
+    database lock. The pool of reader connections, in L{readers}, is for
+    retrievals. The database, and its tables, are created if they don't
+    exist yet.
+
+    @ivar path: The path of the database file.
+    @type path: C{str}
+    @ivar writer: The pool with the writer connection.
+    @type writer: L{adbapi.ConnectionPool}
+    @ivar readers: The pool with the reader connections.
+    @type readers: L{adbapi.ConnectionPool}
+    """
+
+    def __init__(self, path, readers=4):
+        self.path = path
+        connkw = {'check_same_thread': False,
+                  'detect_types': sqlite3.PARSE_DECLTYPES}
+        self.writer = _WriterPool('sqlite3', path,
+                                  cp_min=1, cp_max=1,
+                                  cp_openfun=_openWriter, **connkw)
+        self.readers = _ReaderPool('sqlite3', path,
+                                   cp_min=readers, cp_max=readers,
+                                   cp_openfun=_openReader, **connkw)
+
+
+    def start(self):
+        self.writer.start()
+        self.readers.start()
+
+
+    def close(self):
+        self.readers.close()
+        self.writer.close()
+
+
+    def runInteraction(self, interaction, *args, **kw):
+        return self.writer.runInteraction(interaction, *args, **kw)
+
+
+    def runQuery(self, *args, **kw):
+        return self.writer.runQuery(*args, **kw)
+
+
+    def runOperation(self, *args, **kw):
+        return self.writer.runOperation(*args, **kw)
+
+
+
+class Storage(pgsql_storage.Storage):
+    """
+    Storage on SQLite.
+
+    Changes are written through the writer connection of C{dbpool}, and
+    retrievals are done on its reader connections.
+
+    @ivar dbpool: The database connection pool.
+    @type dbpool: L{ConnectionPool}
+    """
+
+    def __init__(self, dbpool, batcher=None):
+        pgsql_storage.Storage.__init__(self, dbpool, batcher, dbpool.readers)
+
+
+    def getNodesVersion(self):
+        # The nodes table uses AUTOINCREMENT, so that its highest node id
+        # ever taken is kept in sqlite_sequence.
+        d = self.readpool.runQuery("""SELECT
+                                      (SELECT seq FROM sqlite_sequence
+                                       WHERE name='nodes'),
+                                      count(*)
+                                      FROM nodes""")
+        d.addCallback(lambda results: ('%d-%d' % tuple(results[0]), None))
+        return d
+
+
+    def _makeLeafNode(self, nodeIdentifier, config):
+        return LeafNode(nodeIdentifier, config)
+
+
+
+class LeafNode(pgsql_storage.LeafNode):
+
+    def _storeItem(self, cursor, item, publisher, date=None):
+        """
+        Store an item.
+
+        @param date: The time of publication, in UTC, or C{None} for the
+                     current time.
+        @type date: L{datetime.datetime}
+        """
+        # Dates are stored in the format they are compared with in
+        # _getItemsQuery, which sorts in the order of time.
+        data = item.toXml()
+        date = (date or datetime.datetime.utcnow()).isoformat() + '+00:00'
+
+        cursor.execute("""UPDATE items SET date=%s, publisher=%s, data=%s
+                          WHERE node_id=(SELECT node_id FROM nodes
+                                                    WHERE node=%s) AND
+                                item=%s""",
+                       (date,
+                        publisher.full(),
+                        data,
+                        self.nodeIdentifier,
+                        item["id"]))
+        if cursor.rowcount == 1:
+            return
+
+        cursor.execute("""INSERT INTO items
+                          (node_id, item, publisher, data, date)
+                          SELECT node_id, %s, %s, %s, %s
+                          FROM nodes
+                          WHERE node=%s""",
+                       (item["id"],
+                        publisher.full(),
+                        data,
+                        date,
+                        self.nodeIdentifier))
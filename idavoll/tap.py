@@ -6,13 +6,12 @@ from twisted.python import usage
 from twisted.words.protocols.jabber.jid import JID
 
 from wokkel.component import Component
-from wokkel.disco import DiscoHandler
 from wokkel.generic import FallbackHandler, VersionHandler
 from wokkel.iwokkel import IPubSubResource
-from wokkel.pubsub import PubSubService
 
 from idavoll import __version__
 from idavoll.backend import BackendService
+from idavoll.protocol import DiscoHandler, PubSubService
 
 class Options(usage.Options):
     optParameters = [
@@ -20,35 +19,135 @@ class Options(usage.Options):
         ('secret', None, 'secret', 'Jabber server component secret'),
         ('rhost', None, '127.0.0.1', 'Jabber server host'),
         ('rport', None, '5347', 'Jabber server port'),
+        ('connections', None, '1',
+         'Number of connections to the Jabber server, if it allows more '
+         'than one for a component'),
+        ('workers', None, '0',
+         'Number of worker processes, each with a connection of its own, '
+         'that send notifications'),
         ('backend', None, 'memory', 'Choice of storage backend'),
         ('dbuser', None, None, 'Database user (pgsql backend)'),
         ('dbname', None, 'pubsub', 'Database name (pgsql backend)'),
         ('dbpass', None, None, 'Database password (pgsql backend)'),
         ('dbhost', None, None, 'Database host (pgsql backend)'),
         ('dbport', None, None, 'Database port (pgsql backend)'),
+        ('dbshards', None, None,
+         'Comma separated name=dsn of databases to shard nodes over, with '
+         'DSNs like host:port:database:user:password (pgsql backend)'),
+        ('dbreplica-host', None, None,
+         'Host of a read-only replica of the database to read from '
+         '(pgsql backend)'),
+        ('dbreplica-port', None, None,
+         'Port of the read-only replica (pgsql backend)'),
+        ('replica-window', None, '1000',
+         'Milliseconds after a write to a node or by an entity during which '
+         'reads about it are made from the primary database (pgsql backend)'),
+        ('cache-size', None, '10000',
+         'Maximum number of nodes to cache, with --cache (pgsql backend)'),
+        ('dbfile', None, 'pubsub.db', 'Database file (sqlite backend)'),
+        ('dbreaders', None, '4',
+         'Number of reader connections (sqlite backend)'),
+        ('datadir', None, 'pubsub',
+         'Directory to keep nodes and items in (file backend)'),
+        ('commit-window', None, '0.5',
+         'Milliseconds to gather publishes into one transaction '
+         '(pgsql and sqlite backends), 0 to disable'),
+        ('commit-batch', None, '100',
+         'Maximum number of publishes in one transaction '
+         '(pgsql and sqlite backends)'),
+        ('snapshot', None, None,
+         'File to keep snapshots of the storage in (memory backend)'),
+        ('snapshot-interval', None, '60',
+         'Seconds between snapshots (memory backend)'),
+        ('journal', None, None,
+         'File to keep a journal of changes in (memory backend)'),
+        ('journal-fsync', None, 'always',
+         'When to write the journal to disk: always, never, or every '
+         'given number of milliseconds'),
+        ('compact-interval', None, '3600',
+         'Seconds between compactions of the journal into a snapshot'),
+        ('flush-interval', None, '1',
+         'Seconds between writes to the database (tiered backend)'),
+        ('max-dirty', None, '1000',
+         'Maximum number of pending database writes (tiered backend)'),
+        ('shards', None, None,
+         'Comma separated paths of the UNIX sockets of the shards to '
+         'forward operations to, instead of using a storage backend'),
+        ('shard-socket', None, None,
+         'Path of a UNIX socket to serve the backend on as a shard, '
+         'instead of connecting to the Jabber server'),
     ]
 
     optFlags = [
         ('verbose', 'v', 'Show traffic'),
+        ('cache', None, 'Cache nodes, invalidated on changes made by other '
+                        'instances (pgsql backend)'),
+        ('notify-changes', None, 'Record changes to nodes for instances '
+                                 'that cache them, implied by --cache '
+                                 '(pgsql and tiered backends)'),
         ('hide-nodes', None, 'Hide all nodes for disco')
     ]
 
     def postOptions(self):
-        if self['backend'] not in ['pgsql', 'memory']:
+        if self['backend'] not in ['pgsql', 'memory', 'tiered', 'sqlite',
+                                   'file']:
             raise usage.UsageError, "Unknown backend!"
 
-        self['jid'] = JID(self['jid'])
+        if self['journal-fsync'] not in ('always', 'never'):
+            try:
+                self['journal-fsync'] = float(self['journal-fsync']) / 1000
+            except ValueError:
+                raise usage.UsageError, "Invalid journal fsync policy!"
 
+        if self['shards']:
+            self['shards'] = self['shards'].split(',')
 
+        if self['dbshards']:
+            if self['backend'] != 'pgsql':
+                raise usage.UsageError, "Database shards need pgsql backend!"
+            # One replica can't mirror the databases of several shards.
+            if self['dbreplica-host']:
+                raise usage.UsageError, "Database shards can't use a replica!"
+            from idavoll.pgsql_shards import parseShards
+            try:
+                self['dbshards'] = parseShards(self['dbshards'])
+            except ValueError, e:
+                raise usage.UsageError, str(e)
 
-def makeService(config):
-    s = service.MultiService()
+        self['jid'] = JID(self['jid'])
 
-    # Create backend service with storage
 
-    if config['backend'] == 'pgsql':
+
+def makeStorage(config, s):
+    """
+    Create the storage backend, adding the services it needs to C{s}.
+    """
+    if config['dbshards']:
+        from twisted.enterprise import adbapi
+        from idavoll import pgsql_shards, pgsql_storage
+        shards = []
+        for name, dsn in config['dbshards']:
+            dbpool = adbapi.ConnectionPool('pyPgSQL.PgSQL', dsn,
+                                           cp_reconnect=True,
+                                           client_encoding='utf-8',
+                                           )
+            batcher = None
+            if float(config['commit-window']):
+                batcher = pgsql_storage.CommitBatcher(
+                        dbpool,
+                        float(config['commit-window']) / 1000,
+                        int(config['commit-batch']))
+            cache = None
+            if config['cache']:
+                cache = pgsql_storage.NodeCache(int(config['cache-size']))
+                pgsql_storage.ChangeListener(cache, dbpool).setServiceParent(s)
+            shards.append((name, pgsql_storage.Storage(
+                dbpool, batcher, cache=cache,
+                notifyChanges=config['notify-changes'])))
+        return pgsql_shards.Storage(shards)
+
+    if config['backend'] in ('pgsql', 'tiered'):
         from twisted.enterprise import adbapi
-        from idavoll.pgsql_storage import Storage
         dbpool = adbapi.ConnectionPool('pyPgSQL.PgSQL',
                                        user=config['dbuser'],
                                        password=config['dbpass'],
@@ -58,26 +157,115 @@ def makeService(config):
                                        cp_reconnect=True,
                                        client_encoding='utf-8',
                                        )
-        st = Storage(dbpool)
+    elif config['backend'] == 'sqlite':
+        from idavoll.sqlite_storage import ConnectionPool
+        dbpool = ConnectionPool(config['dbfile'], int(config['dbreaders']))
+
+    if config['backend'] in ('pgsql', 'sqlite'):
+        from idavoll.pgsql_storage import CommitBatcher
+        batcher = None
+        if float(config['commit-window']):
+            batcher = CommitBatcher(dbpool,
+                                    float(config['commit-window']) / 1000,
+                                    int(config['commit-batch']))
+
+    if config['backend'] == 'pgsql':
+        from idavoll.pgsql_storage import Storage
+        readpool = recentWrites = None
+        if config['dbreplica-host']:
+            from idavoll.pgsql_storage import RecentWrites
+            readpool = adbapi.ConnectionPool('pyPgSQL.PgSQL',
+                                             user=config['dbuser'],
+                                             password=config['dbpass'],
+                                             database=config['dbname'],
+                                             host=config['dbreplica-host'],
+                                             port=config['dbreplica-port'],
+                                             cp_reconnect=True,
+                                             client_encoding='utf-8',
+                                             )
+            recentWrites = RecentWrites(
+                    float(config['replica-window']) / 1000)
+
+        cache = None
+        if config['cache']:
+            from idavoll.pgsql_storage import ChangeListener, NodeCache
+            cache = NodeCache(int(config['cache-size']))
+            ChangeListener(cache, dbpool, recentWrites).setServiceParent(s)
+        st = Storage(dbpool, batcher, readpool, cache, recentWrites,
+                     config['notify-changes'])
+    elif config['backend'] == 'sqlite':
+        from idavoll.sqlite_storage import Storage
+        st = Storage(dbpool, batcher)
+    elif config['backend'] == 'tiered':
+        from idavoll.tiered_storage import Storage, StorageService
+        st = Storage(dbpool, float(config['flush-interval']),
+                     int(config['max-dirty']),
+                     notifyChanges=config['notify-changes'])
+        StorageService(st).setServiceParent(s)
+    elif config['backend'] == 'file':
+        from idavoll.file_storage import Storage
+        st = Storage(config['datadir'])
     elif config['backend'] == 'memory':
-        from idavoll.memory_storage import Storage
+        from idavoll.memory_storage import Storage, SnapshotService
         st = Storage()
+        if config['journal']:
+            from idavoll.journal import JournalService
+            snapshotPath = (config['snapshot'] or
+                            config['journal'] + '.snapshot')
+            JournalService(st, config['journal'], snapshotPath,
+                           config['journal-fsync'],
+                           float(config['compact-interval'])
+                           ).setServiceParent(s)
+        elif config['snapshot']:
+            SnapshotService(st, config['snapshot'],
+                            float(config['snapshot-interval'])
+                            ).setServiceParent(s)
+
+    return st
 
-    bs = BackendService(st)
+
+
+def makeService(config):
+    s = service.MultiService()
+
+    # Create backend service with storage, or a router to the shards that
+    # have the storage.
+
+    if config['shards']:
+        from idavoll.sharding import ShardRouter
+        bs = ShardRouter(config['shards'])
+    else:
+        bs = BackendService(makeStorage(config, s))
     bs.setName('backend')
     bs.setServiceParent(s)
 
+    if config['shard-socket']:
+        from twisted.application import internet
+        from idavoll.sharding import ShardServerFactory
+        internet.UNIXServer(config['shard-socket'], ShardServerFactory(bs),
+                            mode=0600, wantPID=True).setServiceParent(s)
+        return s
+
     # Set up XMPP server-side component with publish-subscribe capabilities
 
-    cs = Component(config["rhost"], int(config["rport"]),
-                   config["jid"].full(), config["secret"])
+    if int(config['connections']) > 1:
+        from idavoll.component import ComponentPool
+        cs = ComponentPool(config["rhost"], int(config["rport"]),
+                           config["jid"].full(), config["secret"],
+                           int(config['connections']))
+        connections = cs.connections
+    else:
+        cs = Component(config["rhost"], int(config["rport"]),
+                       config["jid"].full(), config["secret"])
+        connections = [cs]
     cs.setName('component')
     cs.setServiceParent(s)
 
-    cs.factory.maxDelay = 900
+    for connection in connections:
+        connection.factory.maxDelay = 900
 
-    if config["verbose"]:
-        cs.logTraffic = True
+        if config["verbose"]:
+            connection.logTraffic = True
 
     FallbackHandler().setHandlerParent(cs)
     VersionHandler('Idavoll', __version__).setHandlerParent(cs)
@@ -91,4 +279,12 @@ def makeService(config):
     ps.setHandlerParent(cs)
     resource.pubsubService = ps
 
+    if int(config['workers']):
+        from idavoll.workers import WorkerPool
+        workers = WorkerPool(cs, config["rhost"], int(config["rport"]),
+                             config["jid"].full(), config["secret"],
+                             int(config['workers']))
+        workers.setServiceParent(s)
+        ps.workers = workers
+
     return s
@@ -4,6 +4,7 @@
 from twisted.application import internet, service, strports
 from twisted.conch import manhole, manhole_ssh
 from twisted.cred import portal, checkers
+from twisted.python import usage
 from twisted.web2 import channel, log, resource, server
 from twisted.web2.tap import Web2Service
 
@@ -13,8 +14,27 @@ from idavoll.gateway import RemoteSubscriptionService
 class Options(tap.Options):
     optParameters = [
             ('webport', None, '8086', 'Web port'),
+            ('items-cache-ttl', None, '10',
+             'Seconds to cache items retrieved from remote nodes'),
+            ('items-cache-size', None, '1000',
+             'Maximum number of cached remote items results'),
+            ('compress-threshold', None, str(gateway.COMPRESS_THRESHOLD),
+             'Minimum size in bytes of compressed responses and callbacks'),
     ]
 
+    def postOptions(self):
+        tap.Options.postOptions(self)
+
+        # A shard doesn't connect to the Jabber server, which the gateway
+        # needs.
+        if self['shard-socket']:
+            raise usage.UsageError, "A shard can't run the HTTP gateway!"
+
+        # A router has no storage of its own to keep the callbacks in.
+        if self['shards'] and self['backend'] not in ('memory', 'file'):
+            raise usage.UsageError, ("Gateway callbacks can only be kept "
+                                     "in memory with shards!")
+
 
 
 def getManholeFactory(namespace, **passwords):
@@ -39,14 +59,22 @@ def makeService(config):
 
     # Set up XMPP service for subscribing to remote nodes
 
-    if config['backend'] == 'pgsql':
+    if config['dbshards']:
+        # Callbacks are kept in the first database.
+        from idavoll.pgsql_storage import GatewayStorage
+        name = config['dbshards'][0][0]
+        gst = GatewayStorage(bs.storage.storages[name].dbpool)
+    elif config['backend'] in ('pgsql', 'tiered', 'sqlite'):
         from idavoll.pgsql_storage import GatewayStorage
         gst = GatewayStorage(bs.storage.dbpool)
-    elif config['backend'] == 'memory':
+    elif config['backend'] in ('memory', 'file'):
         from idavoll.memory_storage import GatewayStorage
         gst = GatewayStorage()
 
-    ss = RemoteSubscriptionService(config['jid'], gst)
+    itemsCache = gateway.ItemsCache(float(config['items-cache-ttl']),
+                                    int(config['items-cache-size']))
+    ss = RemoteSubscriptionService(config['jid'], gst, itemsCache)
+    ss.compressThreshold = int(config['compress-threshold'])
     ss.setHandlerParent(cs)
     ss.startService()
 
@@ -68,6 +96,8 @@ def makeService(config):
     root.child_unsubscribe = gateway.RemoteUnsubscribeResource(ss)
     root.child_items = gateway.RemoteItemsResource(ss)
 
+    root = gateway.CompressingResource(root, int(config['compress-threshold']))
+
     if config["verbose"]:
         root = log.LogWrapperResource(root)
 
@@ -142,6 +142,20 @@ class BackendTest(unittest.TestCase):
         d.addCallback(checkID)
         return d
 
+
+    def test_getNodesVersion(self):
+        """
+        The version of the list of nodes is taken from the storage.
+        """
+        class TestStorage:
+            def getNodesVersion(self):
+                return defer.succeed(('test-1', 1252324800))
+
+        self.backend = backend.BackendService(TestStorage())
+        d = self.backend.getNodesVersion()
+        d.addCallback(self.assertEqual, ('test-1', 1252324800))
+        return d
+
     class NodeStore:
         """
         I just store nodes to pose as an L{IStorage} implementation.
@@ -525,6 +539,30 @@ class PubSubResourceFromBackendTest(unittest.TestCase):
         return defer.DeferredList([d1, d2], fireOnOneErrback=1)
 
 
+    def test_itemsSince(self):
+        """
+        The C{since} of an items request is passed on to the backend.
+        """
+        class TestBackend(BaseTestBackend):
+            def getItems(self, nodeIdentifier, requestor, maxItems,
+                               itemIdentifiers, after, before, since):
+                self.since = since
+                return defer.succeed([])
+
+        def cb(result):
+            self.assertEqual(u'item1', resource.backend.since)
+
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        request = pubsub.PubSubRequest('items')
+        request.sender = OWNER
+        request.recipient = SERVICE
+        request.nodeIdentifier = 'test'
+        request.since = u'item1'
+        d = resource.items(request)
+        d.addCallback(cb)
+        return d
+
+
     def test_unsubscribeNotSubscribed(self):
         """
         Test unsubscription request when not subscribed.
@@ -0,0 +1,145 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.component}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish import domish
+
+from wokkel.subprotocols import XMPPHandler
+
+from idavoll import component, protocol
+
+SERVICE = JID('pubsub.example.org')
+
+class FakeConnector(object):
+    """
+    Connector that doesn't connect.
+    """
+
+    def disconnect(self):
+        pass
+
+
+
+class ComponentPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = component.ComponentPool('127.0.0.1', 5347,
+                                            SERVICE.full(), 'secret', 4)
+        self.sent = []
+        for connection in self.pool.connections:
+            connection.send = self.makeSend(connection)
+
+
+    def makeSend(self, connection):
+        return lambda obj: self.sent.append((connection, obj))
+
+
+    def makeMessage(self, recipient):
+        message = domish.Element((None, 'message'))
+        message['to'] = recipient
+        return message
+
+
+    def test_getConnection(self):
+        """
+        Stanzas to a single entity go over the same connection.
+        """
+        connection = self.pool.getConnection(u'user@example.org/home')
+        self.assertIdentical(connection,
+                             self.pool.getConnection(u'user@example.org'))
+        self.assertIdentical(connection,
+                             self.pool.getConnection(u'user@example.org/work'))
+        self.assertIdentical(self.pool.connections[0],
+                             self.pool.getConnection(None))
+
+
+    def test_getConnectionSpread(self):
+        """
+        Recipients are spread over all connections.
+        """
+        connections = set([self.pool.getConnection(u'user%d@example.org' % i)
+                           for i in xrange(100)])
+        self.assertEqual(4, len(connections))
+
+
+    def test_send(self):
+        """
+        Stanzas are sent over the connection for their recipient.
+        """
+        message = self.makeMessage(u'user@example.org/home')
+        self.pool.send(message)
+        self.assertEqual([(self.pool.getConnection(u'user@example.org'),
+                           message)], self.sent)
+
+
+    def test_sendBuffer(self):
+        """
+        Buffered stanzas are buffered for the connection of their recipient.
+        """
+        clock = task.Clock()
+        for connection in self.pool.connections:
+            connection.sendBuffer.clock = clock
+
+        recipients = [u'user%d@example.org' % i for i in xrange(10)]
+        for recipient in recipients:
+            self.pool.sendBuffer.send(self.makeMessage(recipient))
+        self.assertEqual([], self.sent)
+
+        clock.advance(0)
+        self.assertEqual(4, len(self.sent))
+        for connection, data in self.sent:
+            for recipient in recipients:
+                if self.pool.getConnection(recipient) is connection:
+                    self.assertIn(recipient, data)
+                else:
+                    self.assertNotIn(recipient, data)
+
+
+    def test_notifyPublish(self):
+        """
+        The publish-subscribe service sends notifications through the send
+        buffer of the pool.
+        """
+        service = protocol.PubSubService()
+        service.setHandlerParent(self.pool)
+
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item1'
+        notifications = [(JID('user%d@example.org' % i), [], [item])
+                         for i in xrange(10)]
+        service.notifyPublish(SERVICE, 'test', notifications)
+        self.pool.sendBuffer.flush()
+        self.assertEqual(4, len(self.sent))
+
+
+    def test_receive(self):
+        """
+        Stanzas received on any connection are passed to the handlers.
+        """
+        received = []
+
+        class Handler(XMPPHandler):
+            def connectionInitialized(self):
+                self.xmlstream.addObserver('/message',
+                                           lambda message:
+                                               received.append(message))
+
+        Handler().setHandlerParent(self.pool)
+        for connection in self.pool.connections:
+            connection._getConnection = FakeConnector
+        self.pool.startService()
+        self.addCleanup(self.pool.stopService)
+
+        for connection in self.pool.connections[:2]:
+            xs = xmlstream.XmlStream(xmlstream.Authenticator())
+            connection._authd(xs)
+            xs.dispatch(self.makeMessage(SERVICE.full()))
+
+        self.assertEqual(2, len(received))
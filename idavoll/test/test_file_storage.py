@@ -0,0 +1,217 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.file_storage}.
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from idavoll import file_storage
+
+OWNER = jid.JID('owner@example.com')
+PUBLISHER = jid.JID('publisher@example.com')
+SUBSCRIBER = jid.JID('subscriber@example.com/Home')
+
+def makeItem(itemIdentifier, content=u'Test \u2083 item'):
+    item = domish.Element((None, 'item'))
+    item['id'] = itemIdentifier
+    item.addElement(('testns', 'test'), content=content)
+    return item
+
+
+
+class LeafNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.storage = file_storage.Storage(self.path)
+        config = dict(self.storage.getDefaultConfiguration('leaf'))
+        config['pubsub#node_type'] = 'leaf'
+        self.storage.createNode('test', OWNER, config)
+        self.node = self.storage._nodes['test']
+        self.node.storeItems([makeItem('item%d' % i) for i in xrange(10)],
+                             PUBLISHER)
+
+
+    def tearDown(self):
+        self.storage.close()
+
+
+    def reload(self):
+        self.storage.close()
+        self.storage = file_storage.Storage(self.path)
+        self.node = self.storage._nodes['test']
+
+
+    def getItemIdentifiers(self):
+        result = []
+        d = self.node.getItems()
+        d.addCallback(lambda items: result.extend([item.itemIdentifier
+                                                   for item in items]))
+        return result
+
+
+    def test_removeItems(self):
+        """
+        Removed items are only marked as removed in the index.
+        """
+        self.node.removeItems(['item3', 'item5'])
+        self.assertEqual(10, self.node._count)
+        self.assertEqual(2, self.node._removed)
+        self.assertEqual(['item%d' % i for i in (9, 8, 7, 6, 4, 2, 1, 0)],
+                         self.getItemIdentifiers())
+
+
+    def test_storeUpdatedItem(self):
+        """
+        Storing an item again marks the old index entry as removed.
+        """
+        self.node.storeItems([makeItem('item3', u'Updated')], PUBLISHER)
+        self.assertEqual(11, self.node._count)
+        self.assertEqual(1, self.node._removed)
+        self.assertEqual('item3', self.getItemIdentifiers()[0])
+
+        self.reload()
+        self.assertEqual(1, self.node._removed)
+        self.assertEqual('item3', self.getItemIdentifiers()[0])
+
+
+    def test_compact(self):
+        """
+        Compacting drops removed items from the files.
+        """
+        def cb(_):
+            self.assertEqual(7, self.node._count)
+            self.assertEqual(0, self.node._removed)
+            self.assertEqual(expected, self.getItemIdentifiers())
+            self.assertFalse(os.path.exists(os.path.join(self.node.path,
+                                                         'index.compact')))
+            self.reload()
+            self.assertEqual(expected, self.getItemIdentifiers())
+
+        size = os.path.getsize(os.path.join(self.node.path, 'segment'))
+        self.node.removeItems(['item1', 'item4', 'item7'])
+        expected = self.getItemIdentifiers()
+
+        d = self.node.compact()
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.assertTrue(
+            os.path.getsize(os.path.join(self.node.path, 'segment')) < size))
+        return d
+
+
+    def test_compactWhileChanging(self):
+        """
+        Items stored and removed while compacting are accounted for.
+        """
+        def cb(_):
+            self.assertEqual(expected, self.getItemIdentifiers())
+            removed = self.node._removed
+            self.reload()
+            self.assertEqual(removed, self.node._removed)
+            self.assertEqual(expected, self.getItemIdentifiers())
+
+        self.node.removeItems(['item1'])
+        d = self.node.compact()
+        self.node.removeItems(['item2', 'item4'])
+        self.node.storeItems([makeItem('item10'), makeItem('item4')],
+                             PUBLISHER)
+        self.node.storeItems([makeItem('item6', u'Updated')], PUBLISHER)
+        expected = self.getItemIdentifiers()
+        self.assertEqual(['item6', 'item4', 'item10', 'item9', 'item8',
+                          'item7', 'item5', 'item3', 'item0'], expected)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_compactAutomatically(self):
+        """
+        The node is compacted when enough of its items have been removed.
+        """
+        self.node.compactMinimum = 5
+        self.node.removeItems(['item0', 'item1', 'item2', 'item3'])
+        self.assertIdentical(None, self.node._compacting)
+        self.node.removeItems(['item4'])
+        self.assertNotIdentical(None, self.node._compacting)
+        return self.node._compacting
+
+
+    def test_purgeWhileCompacting(self):
+        """
+        The result of compacting is dropped if the node was purged.
+        """
+        def cb(_):
+            self.assertEqual([], self.getItemIdentifiers())
+            self.assertEqual(['index', 'metadata', 'segment'],
+                             sorted(os.listdir(self.node.path)))
+
+        self.node.removeItems(['item1'])
+        d = self.node.compact()
+        self.node.purge()
+        d.addCallback(cb)
+        return d
+
+
+    def test_recoverPartialWrite(self):
+        """
+        An item that was only partly written is dropped at startup.
+        """
+        segment = open(os.path.join(self.node.path, 'segment'), 'ab')
+        segment.write('item10\0publisher@example.com\0<item id=')
+        segment.close()
+        index = open(os.path.join(self.node.path, 'index'), 'ab')
+        index.write(file_storage.INDEX_ENTRY.pack(0, 0, 0, 0)[:10])
+        index.close()
+
+        self.reload()
+        self.assertEqual(10, self.node._count)
+        self.node.storeItems([makeItem('item10')], PUBLISHER)
+        self.reload()
+        self.assertEqual('item10', self.getItemIdentifiers()[0])
+        self.assertEqual(11, len(self.getItemIdentifiers()))
+
+
+    def test_deleteNode(self):
+        """
+        Deleting a node removes its directory.
+        """
+        path = self.node.path
+        self.storage.deleteNode('test')
+        self.assertFalse(os.path.exists(path))
+        self.storage = file_storage.Storage(self.path)
+        self.assertEqual([''], self.storage._nodes.keys())
+
+
+    def test_restartRootSubscriptions(self):
+        """
+        The subscriptions and configuration of the root collection node
+        are kept across restarts.
+        """
+        root = self.storage._nodes['']
+        root.addSubscription(SUBSCRIBER, 'subscribed', {})
+        root.setConfiguration({'pubsub#deliver_payloads': False})
+        self.reload()
+
+        root = self.storage._nodes['']
+        self.assertEqual('collection', root.nodeType)
+        self.assertEqual([SUBSCRIBER.full()], root._subscriptions.keys())
+        self.assertFalse(root.getConfiguration()['pubsub#deliver_payloads'])
+
+
+    def test_longNodeIdentifier(self):
+        """
+        Nodes with identifiers too long for the name of a directory are
+        kept under a hash of their identifier.
+        """
+        nodeIdentifier = u'\u2083' * 300
+        config = dict(self.storage.getDefaultConfiguration('leaf'))
+        config['pubsub#node_type'] = 'leaf'
+        self.storage.createNode(nodeIdentifier, OWNER, config)
+        self.reload()
+        self.assertIn(nodeIdentifier, self.storage._nodes)
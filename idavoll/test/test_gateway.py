@@ -8,12 +8,25 @@ Note that some tests are functional tests that require a running idavoll
 service.
 """
 
-from twisted.internet import defer
+import zlib
+
+import simplejson
+
+from twisted.internet import defer, task
 from twisted.trial import unittest
 from twisted.web import error
+from twisted.web2 import http, http_headers, responsecode
+from twisted.web2.stream import readStream
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.protocols.jabber.xmlstream import toResponse
 from twisted.words.xish import domish
 
-from idavoll import gateway
+from wokkel import shim
+from wokkel.pubsub import NS_PUBSUB
+from wokkel.test.helpers import XmlStreamStub
+
+from idavoll import gateway, memory_storage
+from idavoll.error import UnsupportedEncoding
 
 AGENT = "Idavoll Test Script"
 NS_ATOM = "http://www.w3.org/2005/Atom"
@@ -28,6 +41,724 @@ TEST_ENTRY.addElement("content", content="Some text.")
 baseURI = "http://localhost:8086/"
 componentJID = "pubsub"
 
+class SerializeFeedTest(unittest.TestCase):
+    """
+    Tests for L{gateway.serializeFeed}.
+    """
+
+    def setUp(self):
+        self.patch(gateway, 'gmtime',
+                   lambda: (2009, 9, 7, 12, 0, 0, 0, 250, 0))
+        self.service = JID('pubsub.example.org')
+
+
+    def test_sameAsConstructFeed(self):
+        """
+        The serialized chunks together form the same document as the
+        serialization of the feed built by L{gateway.constructFeed}.
+        """
+        entries = [TEST_ENTRY, TEST_ENTRY]
+        feed = gateway.constructFeed(self.service, 'test', entries, 'Test')
+        chunks = gateway.serializeFeed(self.service, 'test', entries, 'Test')
+        self.assertEqual(feed.toXml().encode('utf-8'), ''.join(chunks))
+
+
+    def test_chunkPerEntry(self):
+        """
+        Each entry is serialized as a separate chunk.
+        """
+        entries = [TEST_ENTRY, TEST_ENTRY]
+        chunks = list(gateway.serializeFeed(self.service, 'test', entries,
+                                            'Test'))
+        entry = TEST_ENTRY.toXml(defaultUri=NS_ATOM).encode('utf-8')
+        self.assertEqual(entry, chunks[-2])
+        self.assertEqual(entry, chunks[-3])
+        self.assertEqual('</feed>', chunks[-1])
+
+
+    def test_iteratorStream(self):
+        """
+        L{gateway.IteratorStream} returns the chunks in order, then C{None}.
+        """
+        stream = gateway.IteratorStream(['a', 'b'])
+        self.assertEqual('a', stream.read())
+        self.assertEqual('b', stream.read())
+        self.assertIdentical(None, stream.read())
+        self.assertIdentical(None, stream.read())
+
+
+
+class FeedValidatorsTest(unittest.TestCase):
+    """
+    Tests for L{gateway.parseAtomDate} and L{gateway.getFeedValidators}.
+    """
+
+    def makeEntry(self, identifier, updated):
+        entry = domish.Element((NS_ATOM, 'entry'))
+        entry.addElement('id', content=identifier)
+        entry.addElement('updated', content=updated)
+        return entry
+
+
+    def test_parseAtomDate(self):
+        self.assertEqual(1252324800,
+                         gateway.parseAtomDate(u'2009-09-07T12:00:00Z'))
+        self.assertEqual(1252324800,
+                         gateway.parseAtomDate(u'2009-09-07T12:00:00.25Z'))
+        self.assertEqual(1252324800,
+                         gateway.parseAtomDate(u'2009-09-07T14:00:00+02:00'))
+
+
+    def test_parseAtomDateInvalid(self):
+        self.assertIdentical(None, gateway.parseAtomDate(u'yesterday'))
+        self.assertIdentical(None,
+                             gateway.parseAtomDate(u'2009-09-07T12:00:00'))
+
+
+    def test_lastModified(self):
+        """
+        The modification time is that of the most recently updated entry.
+        """
+        entries = [self.makeEntry(u'1', u'2009-09-07T12:00:00Z'),
+                   self.makeEntry(u'2', u'2009-09-07T13:00:00Z'),
+                   self.makeEntry(u'3', u'garbage')]
+        tag, lastModified = gateway.getFeedValidators(entries)
+        self.assertEqual(1252328400, lastModified)
+
+
+    def test_lastModifiedNone(self):
+        tag, lastModified = gateway.getFeedValidators([TEST_ENTRY])
+        self.assertIdentical(None, lastModified)
+
+
+    def test_filterEntriesSince(self):
+        """
+        Only entries updated after the given time, or without a valid
+        update time, are kept.
+        """
+        entries = [self.makeEntry(u'1', u'2009-09-07T12:00:00Z'),
+                   self.makeEntry(u'2', u'2009-09-07T13:00:00Z'),
+                   self.makeEntry(u'3', u'garbage')]
+        since = gateway.parseAtomDate(u'2009-09-07T12:00:00Z')
+        self.assertEqual(entries[1:],
+                         gateway.filterEntriesSince(entries, since))
+
+
+    def test_tagChangesOnUpdate(self):
+        """
+        The entity tag changes when an entry is updated.
+        """
+        before = [self.makeEntry(u'1', u'2009-09-07T12:00:00Z')]
+        after = [self.makeEntry(u'1', u'2009-09-07T12:00:01Z')]
+        self.assertEqual(gateway.getFeedValidators(before)[0],
+                         gateway.getFeedValidators(before)[0])
+        self.assertNotEqual(gateway.getFeedValidators(before)[0],
+                            gateway.getFeedValidators(after)[0])
+
+
+
+class CompressionTest(unittest.TestCase):
+    """
+    Tests for compression of gateway requests and responses.
+    """
+
+    def makeRequest(self, acceptEncoding):
+        class TestRequest(object):
+            headers = http_headers.Headers(
+                    {'accept-encoding': acceptEncoding})
+
+        return TestRequest()
+
+
+    def makeResponse(self, body, contentType='application/atom+xml'):
+        return http.Response(responsecode.OK, stream=body,
+                headers={'content-type':
+                            http_headers.MimeType.fromString(contentType)})
+
+
+    def test_chooseEncoding(self):
+        self.assertEqual('gzip', gateway.chooseEncoding(
+            self.makeRequest({'gzip': 1.0, 'deflate': 1.0})))
+        self.assertEqual('deflate', gateway.chooseEncoding(
+            self.makeRequest({'gzip': 0.5, 'deflate': 1.0})))
+        self.assertEqual('gzip', gateway.chooseEncoding(
+            self.makeRequest({'*': 1.0})))
+        self.assertIdentical(None, gateway.chooseEncoding(
+            self.makeRequest({'identity': 1.0})))
+
+
+    def test_compressResponse(self):
+        """
+        Large textual bodies are gzipped if the client accepts that.
+        """
+        body = 'x' * gateway.COMPRESS_THRESHOLD
+        request = self.makeRequest({'gzip': 1.0})
+        response = gateway.compressResponse(request, self.makeResponse(body))
+        self.assertEqual(['gzip'],
+                         response.headers.getHeader('content-encoding'))
+
+        data = []
+        d = readStream(response.stream, data.append)
+        d.addCallback(lambda _: self.assertEqual(
+            body, zlib.decompress(''.join(data), 16 + zlib.MAX_WBITS)))
+        return d
+
+
+    def test_compressResponseWeakETag(self):
+        """
+        A strong entity tag is made weak for the compressed body.
+        """
+        body = 'x' * gateway.COMPRESS_THRESHOLD
+        request = self.makeRequest({'gzip': 1.0})
+        response = self.makeResponse(body)
+        response.headers.setHeader('etag', http_headers.ETag('test'))
+        response = gateway.compressResponse(request, response)
+        self.assertEqual(http_headers.ETag('test', weak=True),
+                         response.headers.getHeader('etag'))
+        self.assertEqual(['Accept-Encoding'],
+                         response.headers.getRawHeaders('vary'))
+
+
+    def test_compressResponseBelowThreshold(self):
+        body = 'x' * (gateway.COMPRESS_THRESHOLD - 1)
+        request = self.makeRequest({'gzip': 1.0})
+        response = gateway.compressResponse(request, self.makeResponse(body))
+        self.assertFalse(response.headers.hasHeader('content-encoding'))
+
+
+    def test_compressResponseBinary(self):
+        body = 'x' * gateway.COMPRESS_THRESHOLD
+        request = self.makeRequest({'gzip': 1.0})
+        response = gateway.compressResponse(request,
+                                            self.makeResponse(body,
+                                                              'image/png'))
+        self.assertFalse(response.headers.hasHeader('content-encoding'))
+
+
+    def test_parseGzipped(self):
+        """
+        L{gateway.WebStreamParser} decompresses gzipped documents.
+        """
+        data = gateway.gzipData(TEST_ENTRY.toXml().encode('utf-8'))
+        d = gateway.WebStreamParser().parse(data, 'gzip')
+        d.addCallback(lambda document:
+                      self.assertEqual(TEST_ENTRY.toXml(), document.toXml()))
+        return d
+
+
+    def test_subscribeCallbackUnsupportedEncoding(self):
+        service = gateway.RemoteSubscriptionService(None, None)
+        d = service.subscribeCallback(JID('pubsub.example.org'), 'test',
+                                      'http://example.org/callback',
+                                      encoding='compress')
+        self.assertFailure(d, UnsupportedEncoding)
+        return d
+
+
+    def test_subscribeCallbackEncoding(self):
+        """
+        The content coding of a callback is kept in the storage.
+        """
+        service = JID('pubsub.example.org')
+        storage = memory_storage.GatewayStorage()
+        gatewayService = gateway.RemoteSubscriptionService(None, storage)
+
+        d = storage.addCallback(service, '', 'http://example.org/other')
+        d.addCallback(lambda _: gatewayService.subscribeCallback(
+            service, '', 'http://example.org/callback', encoding='gzip'))
+        d.addCallback(lambda _: storage.getCallbacks(service, ''))
+        d.addCallback(self.assertEqual,
+                      {'http://example.org/other': None,
+                       'http://example.org/callback': 'gzip'})
+        return d
+
+
+    def test_callCallbacksGzip(self):
+        """
+        Notifications are POSTed gzipped to callbacks that asked for it.
+        """
+        posted = defer.Deferred()
+
+        class TestFactory(object):
+            deferred = defer.succeed(None)
+
+        def getPageWithFactory(url, method, postdata, headers):
+            posted.callback((url, postdata, headers))
+            return TestFactory()
+
+        def cb(result):
+            url, postdata, headers = result
+            self.assertEqual('http://example.org/callback', url)
+            self.assertEqual('gzip', headers['Content-Encoding'])
+            self.assertEqual(TEST_ENTRY.toXml().encode('utf-8'),
+                             zlib.decompress(postdata, 16 + zlib.MAX_WBITS))
+
+        self.patch(gateway, 'getPageWithFactory', getPageWithFactory)
+        service = JID('pubsub.example.org')
+        storage = memory_storage.GatewayStorage()
+        gatewayService = gateway.RemoteSubscriptionService(None, storage)
+        gatewayService.compressThreshold = 0
+
+        storage.addCallback(service, 'test', 'http://example.org/callback',
+                            'gzip')
+        gatewayService.callCallbacks(service, 'test', TEST_ENTRY,
+                                     gateway.MIME_ATOM_ENTRY)
+        posted.addCallback(cb)
+        return posted
+
+
+
+class PublishResourceTest(unittest.TestCase):
+    """
+    Tests for L{gateway.PublishResource}.
+    """
+
+    def setUp(self):
+        self.resource = gateway.PublishResource(None, JID(componentJID),
+                                                JID(componentJID))
+
+
+    def test_itemsFromEntry(self):
+        items = self.resource.itemsFromPayload(TEST_ENTRY, 'entry')
+        self.assertEqual(1, len(items))
+        self.assertEqual('current', items[0]['id'])
+
+
+    def test_itemsFromFeed(self):
+        """
+        Each entry of a feed becomes an item, identified by the entry's id.
+        """
+        entry = domish.Element((NS_ATOM, 'entry'))
+        entry.addElement('id', content=u'tag:example.org,2009:2')
+        feed = gateway.constructFeed(JID(componentJID), 'test',
+                                     [TEST_ENTRY, entry], 'Test')
+
+        items = self.resource.itemsFromPayload(feed, 'feed')
+        self.assertEqual([u'urn:uuid:1225c695-cfb8-4ebb-aaaa-80da344efa6a',
+                          u'tag:example.org,2009:2'],
+                         [item['id'] for item in items])
+        self.assertIdentical(TEST_ENTRY, items[0].firstChildElement())
+
+
+    def test_itemsFromFeedNoEntries(self):
+        feed = gateway.constructFeed(JID(componentJID), 'test', [], 'Test')
+        self.assertRaises(http.HTTPError,
+                          self.resource.itemsFromPayload, feed, 'feed')
+
+
+    def test_itemsFromFeedNotFeed(self):
+        self.assertRaises(http.HTTPError,
+                          self.resource.itemsFromPayload, TEST_ENTRY, 'feed')
+
+
+
+class ListResourceTest(unittest.TestCase):
+    """
+    Tests for L{gateway.ListResource}.
+    """
+
+    def setUp(self):
+        nodes = [u'node%d' % i for i in xrange(5)]
+        self.version = ('test-1', 1252324800)
+        self.retrieved = []
+
+        class TestService(object):
+            def getNodesVersion(service):
+                return defer.succeed(self.version)
+
+            def getNodes(service, after=None, maxNodes=None):
+                self.retrieved.append(after)
+                result = [node for node in nodes
+                          if after is None or node > after]
+                return defer.succeed(result[:maxNodes])
+
+        self.nodes = nodes
+        self.resource = gateway.ListResource(TestService())
+
+
+    def render(self, headers=None, **args):
+        class TestRequest(object):
+            method = 'GET'
+            path = '/list'
+
+        request = TestRequest()
+        request.headers = http_headers.Headers(headers)
+        request.args = dict((key, [value]) for key, value in args.iteritems())
+        return self.resource.render(request)
+
+
+    def assertNotModified(self, d):
+        """
+        Assert that a response is Not Modified, without retrieving nodes.
+        """
+        def eb(failure):
+            failure.trap(http.HTTPError)
+            self.assertEqual(responsecode.NOT_MODIFIED,
+                             failure.value.response.code)
+            self.assertEqual([], self.retrieved)
+
+        d.addCallbacks(lambda _: self.fail("Expected Not Modified"), eb)
+        return d
+
+
+    def getNodes(self, response):
+        data = []
+        d = readStream(response.stream, data.append)
+        d.addCallback(lambda _: simplejson.loads(''.join(data)))
+        return d
+
+
+    def test_all(self):
+        def cb(response):
+            self.assertIdentical(None, response.headers.getRawHeaders('Link'))
+            return self.getNodes(response)
+
+        d = self.render()
+        d.addCallback(cb)
+        d.addCallback(self.assertEqual, self.nodes)
+        return d
+
+
+    def test_page(self):
+        """
+        A page that is followed by more nodes links to the next page.
+        """
+        def cb(response):
+            self.assertEqual(['</list?after=node2&max=2>; rel="next"'],
+                             response.headers.getRawHeaders('Link'))
+            return self.getNodes(response)
+
+        d = self.render(after='node0', max='2')
+        d.addCallback(cb)
+        d.addCallback(self.assertEqual, self.nodes[1:3])
+        return d
+
+
+    def test_lastPage(self):
+        def cb(response):
+            self.assertIdentical(None, response.headers.getRawHeaders('Link'))
+            return self.getNodes(response)
+
+        d = self.render(after='node2', max='2')
+        d.addCallback(cb)
+        d.addCallback(self.assertEqual, self.nodes[3:])
+        return d
+
+
+    def test_validators(self):
+        """
+        The node list carries the version of the list as entity tag.
+        """
+        def cb(response):
+            self.assertEqual(http_headers.ETag('test-1', weak=True),
+                             response.headers.getHeader('ETag'))
+            self.assertEqual(1252324800,
+                             response.headers.getHeader('Last-Modified'))
+
+        d = self.render()
+        d.addCallback(cb)
+        return d
+
+
+    def test_ifNoneMatch(self):
+        """
+        The list is not retrieved if it has the given entity tag.
+        """
+        d = self.render({'If-None-Match': [http_headers.ETag('test-1',
+                                                             weak=True)]})
+        return self.assertNotModified(d)
+
+
+    def test_ifNoneMatchChanged(self):
+        """
+        The list is sent if it has another entity tag than given.
+        """
+        d = self.render({'If-None-Match': [http_headers.ETag('test-0')]})
+        d.addCallback(self.getNodes)
+        d.addCallback(self.assertEqual, self.nodes)
+        return d
+
+
+    def test_ifModifiedSince(self):
+        """
+        The list is not retrieved if it was not modified since the given
+        time.
+        """
+        d = self.render({'If-Modified-Since': 1252324800})
+        return self.assertNotModified(d)
+
+
+    def test_ifModifiedSinceChanged(self):
+        """
+        The list is sent if it was modified since the given time.
+        """
+        d = self.render({'If-Modified-Since': 1252324799})
+        d.addCallback(self.getNodes)
+        d.addCallback(self.assertEqual, self.nodes)
+        return d
+
+
+    def test_ifModifiedSinceUnknown(self):
+        """
+        Without a modification time of the list, it is always sent for
+        If-Modified-Since, and there is no Last-Modified header.
+        """
+        def cb(response):
+            self.assertIdentical(None,
+                                 response.headers.getHeader('Last-Modified'))
+            return self.getNodes(response)
+
+        self.version = ('test-1', None)
+        d = self.render({'If-Modified-Since': 1252324800})
+        d.addCallback(cb)
+        d.addCallback(self.assertEqual, self.nodes)
+        return d
+
+
+
+class ItemsSinceTest(unittest.TestCase):
+    """
+    Tests for L{gateway.RemoteSubscriptionService.itemsSince}.
+    """
+
+    def test_itemsSince(self):
+        """
+        The time is sent in a C{Since} header, and the items in the
+        response are returned.
+        """
+        def cb(items):
+            self.assertEqual([u'item1'], [item['id'] for item in items])
+
+        stub = XmlStreamStub()
+        service = gateway.RemoteSubscriptionService(None, None)
+        service.xmlstream = stub.xmlstream
+        d = service.itemsSince(JID('pubsub.example.org'), u'test',
+                               1252324800, 10)
+        d.addCallback(cb)
+
+        iq = stub.output[-1]
+        self.assertEqual(u'10', iq.pubsub.items['max_items'])
+        self.assertEqual({u'Since': [u'2009-09-07T12:00:00Z']},
+                         shim.extractHeaders(iq.pubsub))
+
+        response = toResponse(iq, 'result')
+        items = response.addElement((NS_PUBSUB, 'pubsub')).addElement('items')
+        items.addElement('item')['id'] = u'item1'
+        stub.send(response)
+        return d
+
+
+
+class RemoteItemsResourceTest(unittest.TestCase):
+    """
+    Tests for L{gateway.RemoteItemsResource}.
+    """
+
+    def setUp(self):
+        item = domish.Element((None, 'item'))
+        entry = item.addElement((NS_ATOM, 'entry'))
+        entry.addElement('id', content=u'urn:uuid:1')
+        entry.addElement('updated', content=u'2009-09-07T12:00:00Z')
+        self.items = [item]
+
+        class TestService(object):
+            def cachedItems(service, jid, nodeIdentifier, maxItems):
+                return defer.succeed(self.items)
+
+            def itemsSince(service, jid, nodeIdentifier, since, maxItems):
+                self.since = since
+                return defer.succeed(self.items)
+
+        self.since = None
+        self.resource = gateway.RemoteItemsResource(TestService())
+        self.tag = gateway.getFeedValidators([entry])[0]
+
+
+    def render(self, headers=None, args=None):
+        class TestRequest(object):
+            method = 'GET'
+
+        request = TestRequest()
+        request.args = {'uri': ['xmpp:pubsub.example.org?;node=test']}
+        request.args.update(args or {})
+        request.headers = http_headers.Headers(headers)
+        return self.resource.render(request)
+
+
+    def test_since(self):
+        """
+        With C{since}, the items published since are retrieved, and only
+        the entries updated since are included.
+        """
+        def cb(response):
+            self.assertEqual(1252324800, self.since)
+            self.assertEqual(None, response.headers.getHeader('Last-Modified'))
+
+        d = self.render(args={'since': ['2009-09-07T12:00:00Z']})
+        d.addCallback(cb)
+        return d
+
+
+    def assertNotModified(self, d):
+        def eb(failure):
+            failure.trap(http.HTTPError)
+            self.assertEqual(responsecode.NOT_MODIFIED,
+                             failure.value.response.code)
+
+        d.addCallbacks(lambda _: self.fail("Expected Not Modified"), eb)
+        return d
+
+
+    def test_validators(self):
+        """
+        The feed carries a weak entity tag and the time of its latest entry.
+        """
+        def cb(response):
+            self.assertEqual(http_headers.ETag(self.tag, weak=True),
+                             response.headers.getHeader('ETag'))
+            self.assertEqual(1252324800,
+                             response.headers.getHeader('Last-Modified'))
+
+        d = self.render()
+        d.addCallback(cb)
+        return d
+
+
+    def test_ifNoneMatch(self):
+        """
+        The feed is not sent if it has the given entity tag.
+        """
+        d = self.render({'If-None-Match': [http_headers.ETag(self.tag,
+                                                             weak=True)]})
+        return self.assertNotModified(d)
+
+
+    def test_ifModifiedSince(self):
+        """
+        The feed is not sent if none of its entries was updated since the
+        given time.
+        """
+        d = self.render({'If-Modified-Since': 1252324800})
+        return self.assertNotModified(d)
+
+
+    def test_ifModifiedSinceChanged(self):
+        def cb(response):
+            self.assertEqual(responsecode.OK, response.code)
+
+        d = self.render({'If-Modified-Since': 1252324799})
+        d.addCallback(cb)
+        return d
+
+
+
+class ItemsCacheTest(unittest.TestCase):
+    """
+    Tests for L{gateway.ItemsCache}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = gateway.ItemsCache(ttl=10, maxEntries=2, clock=self.clock)
+        self.service = JID('pubsub.example.org')
+        self.requests = []
+
+
+    def fetch(self, service, nodeIdentifier, maxItems):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+
+    def test_hit(self):
+        """
+        Items are retrieved once and then served from the cache.
+        """
+        d1 = self.cache.get(self.service, 'test', None, self.fetch)
+        self.requests[0].callback(['item'])
+        d2 = self.cache.get(self.service, 'test', None, self.fetch)
+        self.assertEqual(1, len(self.requests))
+        return defer.gatherResults([d1, d2]).addCallback(
+                self.assertEqual, [['item'], ['item']])
+
+
+    def test_expire(self):
+        """
+        Cached items are retrieved again after the time to live has passed.
+        """
+        self.cache.get(self.service, 'test', None, self.fetch)
+        self.requests[0].callback(['item'])
+        self.clock.advance(11)
+        self.cache.get(self.service, 'test', None, self.fetch)
+        self.assertEqual(2, len(self.requests))
+
+
+    def test_collapseMisses(self):
+        """
+        Concurrent misses for the same key result in one request.
+        """
+        d1 = self.cache.get(self.service, 'test', 5, self.fetch)
+        d2 = self.cache.get(self.service, 'test', 5, self.fetch)
+        self.assertEqual(1, len(self.requests))
+        self.requests[0].callback(['item'])
+        return defer.gatherResults([d1, d2]).addCallback(
+                self.assertEqual, [['item'], ['item']])
+
+
+    def test_collapseMissesFailure(self):
+        """
+        A failed request is passed to all waiters and not cached.
+        """
+        d1 = self.cache.get(self.service, 'test', None, self.fetch)
+        d2 = self.cache.get(self.service, 'test', None, self.fetch)
+        self.requests[0].errback(error.Error('500'))
+        self.assertFailure(d1, error.Error)
+        self.assertFailure(d2, error.Error)
+        self.cache.get(self.service, 'test', None, self.fetch)
+        self.assertEqual(2, len(self.requests))
+        return defer.gatherResults([d1, d2])
+
+
+    def test_invalidate(self):
+        """
+        Invalidation drops all cached results for the node.
+        """
+        self.cache.get(self.service, 'test', None, self.fetch)
+        self.requests[0].callback(['item'])
+        self.cache.invalidate(self.service, 'test')
+        self.cache.get(self.service, 'test', None, self.fetch)
+        self.assertEqual(2, len(self.requests))
+
+
+    def test_invalidatePending(self):
+        """
+        The result of a request outstanding during invalidation is not cached.
+        """
+        d = self.cache.get(self.service, 'test', None, self.fetch)
+        self.cache.invalidate(self.service, 'test')
+        self.requests[0].callback(['item'])
+        self.cache.get(self.service, 'test', None, self.fetch)
+        self.assertEqual(2, len(self.requests))
+        return d
+
+
+    def test_bounded(self):
+        """
+        The entry that expires first is evicted when the cache is full.
+        """
+        for nodeIdentifier in ('a', 'b', 'c'):
+            self.cache.get(self.service, nodeIdentifier, None, self.fetch)
+            self.requests[-1].callback([nodeIdentifier])
+            self.clock.advance(1)
+
+        self.cache.get(self.service, 'c', None, self.fetch)
+        self.cache.get(self.service, 'b', None, self.fetch)
+        self.assertEqual(3, len(self.requests))
+        self.cache.get(self.service, 'a', None, self.fetch)
+        self.assertEqual(4, len(self.requests))
+
+
+
 class GatewayTest(unittest.TestCase):
     timeout = 2
 
@@ -88,6 +819,28 @@ class GatewayTest(unittest.TestCase):
         d.addCallback(cb1)
         return d
 
+
+    def test_publishFeed(self):
+        """
+        Publishing a feed publishes its entries as items.
+        """
+        feed = gateway.constructFeed(JID(componentJID), 'test',
+                                     [TEST_ENTRY], 'Test')
+
+        def cb2(response):
+            self.assertIn('urn:uuid:1225c695-cfb8-4ebb-aaaa-80da344efa6a',
+                          response)
+
+        def cb1(response):
+            d = self.client.items(response['uri'])
+            d.addCallback(cb2)
+            return d
+
+        d = self.client.publish(feed)
+        d.addCallback(cb1)
+        return d
+
+
     def test_publishNonExisting(self):
         def cb(err):
             self.assertEqual('404', err.status)
@@ -396,3 +1149,14 @@ class GatewayTest(unittest.TestCase):
         d = self.client.publish(TEST_ENTRY)
         d.addCallback(cb)
         return d
+
+
+    def test_itemsSince(self):
+        def cb(response):
+            xmppURI = response['uri']
+            d = self.client.items(xmppURI, since='2009-09-07T12:00:00Z')
+            return d
+
+        d = self.client.publish(TEST_ENTRY)
+        d.addCallback(cb)
+        return d
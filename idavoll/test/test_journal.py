@@ -0,0 +1,266 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.journal}.
+"""
+
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from idavoll import journal, memory_storage
+
+OWNER = jid.JID('owner@example.com')
+SUBSCRIBER = jid.JID('subscriber@example.com/Home')
+PUBLISHER = jid.JID('publisher@example.com')
+
+def makeItem(itemIdentifier):
+    item = domish.Element((None, 'item'))
+    item['id'] = itemIdentifier
+    item.addElement(('testns', 'test'), content=u'Test \u2083 item')
+    return item
+
+
+
+def makeChanges(storage):
+    """
+    Make a change of each kind to the storage.
+    """
+    config = dict(storage.getDefaultConfiguration('leaf'))
+    config['pubsub#node_type'] = 'leaf'
+    storage.createNode('test', OWNER, config)
+    storage.createNode('to-be-deleted', OWNER, config)
+    storage.deleteNode('to-be-deleted')
+
+    node = storage._nodes['test']
+    node.setConfiguration({'pubsub#deliver_payloads': False})
+    node.addSubscription(SUBSCRIBER, 'subscribed', {})
+    node.addSubscription(OWNER, 'subscribed', {})
+    node.removeSubscription(OWNER)
+    node.storeItems([makeItem('item1'), makeItem('item2')], PUBLISHER)
+    node.storeItems([makeItem('item3')], PUBLISHER)
+    node.removeItems(['item2'])
+
+
+
+def checkRestored(testCase, storage):
+    """
+    Check that the storage holds the changes made by L{makeChanges}.
+    """
+    testCase.assertEqual(['', 'test'], sorted(storage._nodes))
+
+    node = storage._nodes['test']
+    testCase.assertFalse(node.getConfiguration()['pubsub#deliver_payloads'])
+    testCase.assertEqual([SUBSCRIBER.full()], node._subscriptions.keys())
+    testCase.assertEqual(['item1', 'item3'],
+                         [item.element['id'] for item in node._itemlist])
+    testCase.assertEqual(PUBLISHER, node._itemlist[0].publisher)
+    testCase.assertEqual(makeItem('item1').toXml(),
+                         node._itemlist[0].element.toXml())
+
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.journal = journal.Journal(self.path)
+        self.journal.open(0)
+
+
+    def test_replay(self):
+        """
+        Replaying the journal restores the changes made to the storage.
+        """
+        storage = memory_storage.Storage()
+        storage.setJournal(self.journal)
+        makeChanges(storage)
+        self.journal.close()
+
+        restored = memory_storage.Storage()
+        generation, length = journal.replay(self.path, restored.applyRecord)
+        self.assertEqual(0, generation)
+        self.assertEqual(os.path.getsize(self.path), length)
+        checkRestored(self, restored)
+
+        dates = [item.date for item in storage._nodes['test']._itemlist]
+        restoredDates = [item.date
+                         for item in restored._nodes['test']._itemlist]
+        self.assertEqual(dates, restoredDates)
+
+
+    def test_replayTruncated(self):
+        """
+        A partly written record is dropped, and overwritten by new records.
+        """
+        self.journal.write(('deleteNode', 'first'))
+        self.journal.close()
+        length = os.path.getsize(self.path)
+
+        f = open(self.path, 'ab')
+        f.write('\x80\x02(U\x0adeleteN')
+        f.close()
+
+        records = []
+        generation, replayedLength = journal.replay(self.path,
+                                                    records.append)
+        self.assertEqual([('deleteNode', 'first')], records)
+        self.assertEqual(length, replayedLength)
+        self.flushLoggedErrors()
+
+        self.journal.open(generation, replayedLength)
+        self.journal.write(('deleteNode', 'second'))
+        self.journal.close()
+
+        records = []
+        journal.replay(self.path, records.append)
+        self.assertEqual([('deleteNode', 'first'), ('deleteNode', 'second')],
+                         records)
+
+
+    def test_replayOldGeneration(self):
+        """
+        Journal files older than the given generation are not replayed.
+        """
+        self.journal.write(('deleteNode', 'test'))
+        self.journal.close()
+
+        records = []
+        generation, length = journal.replay(self.path, records.append, 1)
+        self.assertEqual(0, generation)
+        self.assertEqual([], records)
+
+
+    def test_fsyncInterval(self):
+        """
+        Unless synchronizing after every record, records are synchronized
+        to disk by L{journal.Journal.sync}.
+        """
+        def cb(_):
+            self.assertFalse(self.journal._dirty)
+            self.journal.close()
+
+        self.journal.fsync = 0.1
+        d = self.journal.write(('deleteNode', 'test'))
+        self.assertTrue(d.called)
+        self.assertTrue(self.journal._dirty)
+        d = self.journal.sync()
+        d.addCallback(cb)
+        return d
+
+
+    def test_fsyncGrouped(self):
+        """
+        Records written together are synchronized to disk once, before
+        they are acknowledged.
+        """
+        def fsync(fd):
+            synced.append(fd)
+
+        def cb(_):
+            self.assertEqual(1, len(synced))
+            self.journal.close()
+
+        synced = []
+        self.patch(os, 'fsync', fsync)
+        d1 = self.journal.write(('deleteNode', 'first'))
+        d2 = self.journal.write(('deleteNode', 'second'))
+        self.assertFalse(d1.called)
+        self.assertFalse(d2.called)
+
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(cb)
+        return d
+
+
+    def test_rotate(self):
+        self.journal.write(('deleteNode', 'test'))
+        self.assertEqual(1, self.journal.rotate())
+        self.journal.close()
+
+        oldFiles = self.journal.getOldFiles()
+        self.assertEqual([(0, os.path.abspath(self.path + '.0'))], oldFiles)
+
+        records = []
+        self.assertEqual(1, journal.replay(self.path, records.append)[0])
+        self.assertEqual([], records)
+
+
+
+class JournalServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.journalPath = os.path.join(directory, 'journal')
+        self.snapshotPath = os.path.join(directory, 'snapshot')
+        self.storage = memory_storage.Storage()
+        self.service = self.makeService(self.storage)
+
+
+    def makeService(self, storage):
+        return journal.JournalService(storage, self.journalPath,
+                                      self.snapshotPath)
+
+
+    def restart(self):
+        storage = memory_storage.Storage()
+        service = self.makeService(storage)
+        service.startService()
+        self.addCleanup(self.crash, service)
+        return storage
+
+
+    def crash(self, service):
+        """
+        Stop the service without compacting, as if the process stopped.
+        """
+        service._compactLoop.stop()
+        service.journal.close()
+
+
+    def test_restartWithoutCompaction(self):
+        """
+        Changes are restored from the journal alone.
+        """
+        self.service.startService()
+        makeChanges(self.storage)
+        self.crash(self.service)
+
+        checkRestored(self, self.restart())
+
+
+    def test_stopService(self):
+        """
+        Stopping the service compacts the journal into a snapshot.
+        """
+        def cb(_):
+            self.assertTrue(os.path.exists(self.snapshotPath))
+            self.assertEqual([], self.service.journal.getOldFiles())
+            checkRestored(self, self.restart())
+
+        self.service.startService()
+        makeChanges(self.storage)
+        d = self.service.stopService()
+        d.addCallback(cb)
+        return d
+
+
+    def test_compactInterrupted(self):
+        """
+        If the process stops after the journal was moved aside, but before
+        the snapshot was written, the old journal is replayed as well.
+        """
+        self.service.startService()
+        self.storage.createNode('test', OWNER, {'pubsub#node_type': 'leaf'})
+        self.service.journal.rotate()
+        node = self.storage._nodes['test']
+        node.storeItems([makeItem('item1')], PUBLISHER)
+        self.crash(self.service)
+
+        storage = self.restart()
+        self.assertEqual(['item1'], storage._nodes['test']._items.keys())
@@ -0,0 +1,361 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.pgsql_shards}.
+"""
+
+from StringIO import StringIO
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+
+from idavoll import iidavoll, memory_storage, pgsql_shards
+
+OWNER = jid.JID('owner@example.com')
+SUBSCRIBER = jid.JID('subscriber@example.com/Home')
+
+class ParseShardsTest(unittest.TestCase):
+
+    def test_parse(self):
+        """
+        Shards are given as comma separated name=dsn.
+        """
+        self.assertEqual([('a', 'db1::pubsub'), ('b', 'db2::pubsub')],
+                         pgsql_shards.parseShards('a=db1::pubsub,'
+                                                  'b=db2::pubsub'))
+
+
+    def test_parseInvalid(self):
+        """
+        Shards without a name are refused.
+        """
+        self.assertRaises(ValueError, pgsql_shards.parseShards,
+                          'a=db1::pubsub,db2::pubsub')
+
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_stable(self):
+        """
+        A key always belongs to the same shard.
+        """
+        ring = pgsql_shards.HashRing(['a', 'b', 'c'])
+        other = pgsql_shards.HashRing(['c', 'b', 'a'])
+        for i in xrange(100):
+            key = u'node%d' % i
+            self.assertEqual(ring.getShard(key), other.getShard(key))
+        self.assertEqual(ring.getShard(u'test'), ring.getShard('test'))
+
+
+    def test_spread(self):
+        """
+        Keys are spread over all shards.
+        """
+        ring = pgsql_shards.HashRing(['a', 'b', 'c'])
+        counts = {}
+        for i in xrange(3000):
+            shard = ring.getShard('node%d' % i)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(['a', 'b', 'c'], sorted(counts))
+        for count in counts.itervalues():
+            self.assertTrue(count > 500)
+
+
+    def test_addShard(self):
+        """
+        Adding a shard only moves keys to the new shard.
+        """
+        ring = pgsql_shards.HashRing(['a', 'b', 'c'])
+        grown = pgsql_shards.HashRing(['a', 'b', 'c', 'd'])
+        moved = 0
+        for i in xrange(3000):
+            key = 'node%d' % i
+            if ring.getShard(key) != grown.getShard(key):
+                self.assertEqual('d', grown.getShard(key))
+                moved += 1
+        self.assertTrue(0 < moved < 1500)
+
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = {'a': memory_storage.Storage(),
+                       'b': memory_storage.Storage()}
+        self.storage = pgsql_shards.Storage(sorted(self.shards.iteritems()))
+
+        # Find a node identifier for each of the shards.
+        self.nodes = {}
+        for i in xrange(100):
+            nodeIdentifier = 'node%d' % i
+            self.nodes[self.storage.ring.getShard(nodeIdentifier)] = \
+                    nodeIdentifier
+        self.assertEqual(['a', 'b'], sorted(self.nodes))
+
+
+    def createNodes(self):
+        config = dict(self.storage.getDefaultConfiguration('leaf'))
+        config['pubsub#node_type'] = 'leaf'
+        for nodeIdentifier in self.nodes.itervalues():
+            self.storage.createNode(nodeIdentifier, OWNER, config)
+
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(iidavoll.IStorage, self.storage))
+
+
+    def test_createNode(self):
+        """
+        A node is created in the database it hashes to.
+        """
+        self.createNodes()
+        for name, nodeIdentifier in self.nodes.iteritems():
+            for shard, storage in self.shards.iteritems():
+                if shard == name:
+                    self.assertIn(nodeIdentifier, storage._nodes)
+                else:
+                    self.assertNotIn(nodeIdentifier, storage._nodes)
+
+
+    def test_getNode(self):
+        """
+        A node is retrieved from the database it hashes to.
+        """
+        def cb(node):
+            self.assertIdentical(self.shards['b']._nodes[self.nodes['b']],
+                                 node)
+
+        self.createNodes()
+        d = self.storage.getNode(self.nodes['b'])
+        d.addCallback(cb)
+        return d
+
+
+    def test_deleteNode(self):
+        """
+        A node is deleted from the database it hashes to.
+        """
+        def cb(_):
+            self.assertNotIn(self.nodes['a'], self.shards['a']._nodes)
+            self.assertIn(self.nodes['b'], self.shards['b']._nodes)
+
+        self.createNodes()
+        d = self.storage.deleteNode(self.nodes['a'])
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodeIds(self):
+        """
+        The nodes of all databases are listed once, in order.
+        """
+        def cb(nodeIdentifiers):
+            self.assertEqual(sorted([''] + self.nodes.values()),
+                             nodeIdentifiers)
+
+        self.createNodes()
+        d = self.storage.getNodeIds()
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodeIdsMaxNodes(self):
+        """
+        A page of nodes is taken from the combined nodes of all databases.
+        """
+        def cb(nodeIdentifiers):
+            self.assertEqual(sorted(self.nodes.values())[:1],
+                             nodeIdentifiers)
+
+        self.createNodes()
+        d = self.storage.getNodeIds('', 1)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodesVersion(self):
+        """
+        The version of the list of nodes changes with the nodes of any of
+        the databases, and was last modified when any of them was.
+        """
+        versions = []
+
+        def getVersion(_):
+            d = self.storage.getNodesVersion()
+            d.addCallback(versions.append)
+            return d
+
+        def cb(_):
+            self.assertNotEqual(versions[0][0], versions[1][0])
+            self.assertEqual(max(self.shards['a']._nodesModified,
+                                 self.shards['b']._nodesModified),
+                             versions[1][1])
+
+        d = getVersion(None)
+        d.addCallback(lambda _: self.createNodes())
+        d.addCallback(getVersion)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getAffiliations(self):
+        """
+        The affiliations of an entity are gathered from all databases.
+        """
+        def cb(affiliations):
+            expected = [(nodeIdentifier, 'owner')
+                        for nodeIdentifier in self.nodes.itervalues()]
+            self.assertEqual(sorted(expected), sorted(affiliations))
+
+        self.createNodes()
+        d = self.storage.getAffiliations(OWNER)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getSubscriptions(self):
+        """
+        The subscriptions of an entity are gathered from all databases.
+        """
+        def subscribe(node):
+            return node.addSubscription(SUBSCRIBER, 'subscribed', {})
+
+        def cb(subscriptions):
+            self.assertEqual(sorted(self.nodes.values()),
+                             sorted([subscription.nodeIdentifier
+                                     for subscription in subscriptions]))
+
+        self.createNodes()
+        d = self.storage.getNode(self.nodes['a'])
+        d.addCallback(subscribe)
+        d.addCallback(lambda _: self.storage.getNode(self.nodes['b']))
+        d.addCallback(subscribe)
+        d.addCallback(lambda _: self.storage.getSubscriptions(SUBSCRIBER))
+        d.addCallback(cb)
+        return d
+
+
+
+class ScriptedCursor(object):
+    """
+    Cursor that returns the rows given for the first matching statement.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+
+    def execute(self, query, args=()):
+        query = ' '.join(query.split())
+        self.connection.statements.append(query)
+        self.rows = []
+        for prefix, rows in self.connection.results:
+            if query.startswith(prefix):
+                self.rows = list(rows)
+                break
+
+
+    def fetchone(self):
+        return self.rows and self.rows.pop(0) or None
+
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+
+class ScriptedConnection(object):
+
+    def __init__(self, results):
+        self.results = results
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+
+
+    def cursor(self):
+        return ScriptedCursor(self)
+
+
+    def commit(self):
+        self.commits += 1
+
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+
+class MoveNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = ScriptedConnection([
+            ('SELECT node_type', [('leaf', True, True, 'on_sub')]),
+            ('SELECT count(*)', [(3,)]),
+            ])
+
+
+    def test_lock(self):
+        """
+        The node is locked in the source database while it is moved.
+        """
+        target = ScriptedConnection([('SELECT node_id', [(1,)])])
+        pgsql_shards.moveNode(self.source, target, 'test')
+        self.assertTrue(self.source.statements[0].endswith('FOR UPDATE'))
+        self.assertEqual(1, target.commits)
+        self.assertIn('DELETE FROM nodes WHERE node=%s',
+                      self.source.statements)
+        self.assertEqual(1, self.source.commits)
+
+
+    def test_earlierCopy(self):
+        """
+        A copy of an earlier move is kept if it has all items.
+        """
+        target = ScriptedConnection([('SELECT 1', [(1,)]),
+                                     ('SELECT count(*)', [(3,)])])
+        pgsql_shards.moveNode(self.source, target, 'test')
+        self.assertNotIn('INSERT INTO nodes', ' '.join(target.statements))
+        self.assertIn('DELETE FROM nodes WHERE node=%s',
+                      self.source.statements)
+
+
+    def test_earlierCopyDiffers(self):
+        """
+        A node is not deleted if a copy of an earlier move has other items.
+        """
+        target = ScriptedConnection([('SELECT 1', [(1,)]),
+                                     ('SELECT count(*)', [(2,)])])
+        self.assertRaises(pgsql_shards.MoveError, pgsql_shards.moveNode,
+                          self.source, target, 'test')
+        self.assertNotIn('DELETE FROM nodes WHERE node=%s',
+                         self.source.statements)
+        self.assertEqual(0, self.source.commits)
+        self.assertEqual(1, self.source.rollbacks)
+
+
+    def test_rebalanceSkipsDiffering(self):
+        """
+        Nodes that can't be moved are reported and not counted.
+        """
+        self.source.results.insert(0, ('SELECT node FROM', [('test',)]))
+        target = ScriptedConnection([('SELECT node FROM', []),
+                                     ('SELECT 1', [(1,)]),
+                                     ('SELECT count(*)', [(2,)])])
+        ring = pgsql_shards.HashRing(['b'])
+        out = StringIO()
+        moved = pgsql_shards.rebalance({'a': self.source, 'b': target},
+                                       ring, out)
+        self.assertEqual(0, moved)
+        self.assertIn('not moved', out.getvalue())
@@ -0,0 +1,353 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.protocol}.
+"""
+
+import datetime
+
+from zope.interface import implements
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish import domish
+
+from wokkel import disco, shim
+from wokkel.iwokkel import IDisco
+from wokkel.pubsub import Item, PubSubRequest
+
+from idavoll import protocol, rsm
+from idavoll.serialized import SerializedItem
+
+NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
+SERVICE = JID('pubsub.example.org')
+NODES = [u'node%d' % i for i in xrange(5)]
+
+class PagedDiscoHandler(object):
+    """
+    Sibling handler that pages through L{NODES}.
+    """
+    implements(IDisco)
+
+    def getDiscoItems(self, requestor, target, nodeIdentifier):
+        return defer.succeed([disco.DiscoItem(target, node)
+                              for node in NODES])
+
+
+    def getDiscoItemsPage(self, requestor, target, nodeIdentifier, after,
+                                maxItems):
+        nodes = [node for node in NODES if after is None or node > after]
+        return defer.succeed([disco.DiscoItem(target, node)
+                              for node in nodes[:maxItems]])
+
+
+
+class DiscoHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = protocol.DiscoHandler()
+        self.handler.parent = [PagedDiscoHandler()]
+
+
+    def makeRequest(self, rsmRequest=None):
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['from'] = 'user@example.org/home'
+        iq['to'] = SERVICE.full()
+        query = iq.addElement((disco.NS_DISCO_ITEMS, 'query'))
+        if rsmRequest is not None:
+            query.addChild(rsmRequest.toElement())
+        return iq
+
+
+    def getNodes(self, element):
+        return [item.getAttribute('node')
+                for item in element.elements()
+                if item.name == 'item']
+
+
+    def test_itemsWithoutRSM(self):
+        """
+        Without a C{<set/>} in the request, all items are returned.
+        """
+        def cb(element):
+            self.assertEqual(NODES, self.getNodes(element))
+            self.assertIdentical(None, rsm.RSMRequest.fromElement(element))
+
+        d = self.handler._onDiscoItems(self.makeRequest())
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsFirstPage(self):
+        def cb(element):
+            self.assertEqual(NODES[:2], self.getNodes(element))
+            self.assertEqual(NODES[0], unicode(element.set.first))
+            self.assertEqual(NODES[1], unicode(element.set.last))
+
+        d = self.handler._onDiscoItems(self.makeRequest(rsm.RSMRequest(2)))
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsNextPage(self):
+        def cb(element):
+            self.assertEqual(NODES[2:4], self.getNodes(element))
+
+        rsmRequest = rsm.RSMRequest(2, NODES[1])
+        d = self.handler._onDiscoItems(self.makeRequest(rsmRequest))
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsMaxPageSize(self):
+        """
+        Pages are no larger than the maximum page size.
+        """
+        self.handler.maxPageSize = 3
+
+        def cb(element):
+            self.assertEqual(NODES[:3], self.getNodes(element))
+
+        rsmRequest = rsm.RSMRequest(100)
+        d = self.handler._onDiscoItems(self.makeRequest(rsmRequest))
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsBefore(self):
+        """
+        Paging backwards is not supported.
+        """
+        rsmRequest = rsm.RSMRequest(2, before=u'')
+        self.assertRaises(StanzaError, self.handler._onDiscoItems,
+                          self.makeRequest(rsmRequest))
+
+
+
+class PubSubServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = protocol.PubSubService()
+
+
+    def makeRequest(self, rsmRequest=None, maxItems=None, since=None):
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['from'] = 'user@example.org/home'
+        iq['to'] = SERVICE.full()
+        pubsub = iq.addElement((NS_PUBSUB, 'pubsub'))
+        items = pubsub.addElement('items')
+        items['node'] = 'test'
+        if maxItems:
+            items['max_items'] = str(maxItems)
+        if rsmRequest is not None:
+            pubsub.addChild(rsmRequest.toElement())
+        if since is not None:
+            pubsub.addChild(shim.Headers([('Since', since)]))
+        return PubSubRequest.fromElement(iq)
+
+
+    def makeItems(self, *itemIdentifiers):
+        return [Item(id=itemIdentifier)
+                for itemIdentifier in itemIdentifiers]
+
+
+    def test_preProcessItems(self):
+        request = self.makeRequest(rsm.RSMRequest(2, u'item1'))
+        request = self.service._preProcess_items(None, request)
+        self.assertEqual(2, request.maxItems)
+        self.assertEqual(u'item1', request.rsm.after)
+
+
+    def test_preProcessItemsMaxPageSize(self):
+        """
+        Without a maximum, a page holds the maximum page size of items.
+        """
+        self.service.maxPageSize = 10
+        request = self.makeRequest(rsm.RSMRequest())
+        request = self.service._preProcess_items(None, request)
+        self.assertEqual(10, request.maxItems)
+
+
+    def test_preProcessItemsMaxZero(self):
+        """
+        A maximum of zero asks for an empty page, not for all items.
+        """
+        self.service.maxPageSize = 10
+        request = self.makeRequest(rsm.RSMRequest(0))
+        request = self.service._preProcess_items(None, request)
+        self.assertEqual(0, request.maxItems)
+
+
+    def test_preProcessItemsWithoutRSM(self):
+        request = self.makeRequest(maxItems=5)
+        request = self.service._preProcess_items(None, request)
+        self.assertEqual(5, request.maxItems)
+        self.assertIdentical(None, request.rsm)
+        self.assertIdentical(None, request.since)
+
+
+    def test_preProcessItemsSince(self):
+        """
+        The value of a C{Since} header is passed on as C{since}.
+        """
+        request = self.makeRequest(since=u'2009-09-07T12:00:00.5+02:00')
+        request = self.service._preProcess_items(None, request)
+        self.assertEqual(datetime.datetime(2009, 9, 7, 10, 0, 0, 500000),
+                         request.since)
+
+
+    def test_preProcessItemsSinceItem(self):
+        """
+        A C{Since} header that is not a date-time names an item.
+        """
+        request = self.makeRequest(since=u'item1')
+        request = self.service._preProcess_items(None, request)
+        self.assertEqual(u'item1', request.since)
+
+
+    def test_toResponseItems(self):
+        request = self.makeRequest(rsm.RSMRequest(2))
+        request = self.service._preProcess_items(None, request)
+        response = self.service._toResponse_items(
+                self.makeItems(u'item3', u'item2'), None, request)
+        self.assertEqual(u'item3', unicode(response.set.first))
+        self.assertEqual(u'item2', unicode(response.set.last))
+
+
+    def test_toResponseSerializedItems(self):
+        """
+        Items returned serialized by a storage are paged on their
+        identifier, and included in the response as they are.
+        """
+        request = self.makeRequest(rsm.RSMRequest(2))
+        request = self.service._preProcess_items(None, request)
+        items = [SerializedItem(u"<item id='item3'><x/></item>", u'item3'),
+                 SerializedItem(u"<item id='item2'/>", u'item2')]
+        response = self.service._toResponse_items(items, None, request)
+        self.assertEqual(u'item3', unicode(response.set.first))
+        self.assertEqual(u'item2', unicode(response.set.last))
+        self.assertIn(u"<items node='test'><item id='item3'><x/></item>"
+                      u"<item id='item2'/></items>", response.toXml())
+
+
+    def test_toResponseItemsWithoutRSM(self):
+        request = self.makeRequest()
+        request = self.service._preProcess_items(None, request)
+        response = self.service._toResponse_items(
+                self.makeItems(u'item3', u'item2'), None, request)
+        self.assertIdentical(None, response.set)
+
+
+    def test_notifyPublish(self):
+        """
+        Notifications are the same as those of the base service, with the
+        event serialized once for all subscribers.
+        """
+        from wokkel.pubsub import PubSubService as BasePubSubService
+        from wokkel.pubsub import Subscription
+
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item1'
+        item.addElement(('testns', 'test'), content=u'Test \u2083 item')
+        items = [item]
+        notifications = [
+            (JID('user1@example.org'),
+             [Subscription('test', JID('user1@example.org'), 'subscribed')],
+             items),
+            (JID('user2@example.org'),
+             [Subscription('', JID('user2@example.org'), 'subscribed')],
+             items)]
+
+        sent = []
+        self.service.sendBuffer.send = sent.append
+        self.service.notifyPublish(SERVICE, 'test', notifications)
+
+        expected = []
+        base = BasePubSubService()
+        base.send = expected.append
+        base.notifyPublish(SERVICE, 'test', notifications)
+
+        self.assertEqual([message.toXml() for message in expected],
+                         [message.toXml() for message in sent])
+        self.assertIdentical(sent[0].children[0], sent[1].children[0])
+
+
+    def test_notifyPublishBuffered(self):
+        """
+        Notifications are sent together, at the end of the reactor
+        iteration.
+        """
+        clock = task.Clock()
+        self.service.sendBuffer.clock = clock
+        sent = []
+        self.service.send = sent.append
+
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item1'
+        notifications = [(JID('user%d@example.org' % i), [], [item])
+                         for i in xrange(3)]
+        self.service.notifyPublish(SERVICE, 'test', notifications)
+        self.assertEqual([], sent)
+
+        clock.advance(0)
+        self.assertEqual(1, len(sent))
+        self.assertEqual(3, sent[0].count('<message '))
+
+
+
+class SendBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.clock = task.Clock()
+        self.buffer = protocol.SendBuffer(self.sent.append, maxSize=100,
+                                          clock=self.clock)
+
+
+    def makeStanza(self, size):
+        message = domish.Element((None, 'message'))
+        message.addElement('body', content=u'x' * size)
+        return message
+
+
+    def test_flushAtEndOfIteration(self):
+        """
+        Buffered stanzas are sent together in the next reactor iteration.
+        """
+        self.buffer.send(self.makeStanza(1))
+        self.buffer.send(self.makeStanza(2))
+        self.assertEqual([], self.sent)
+        self.clock.advance(0)
+        self.assertEqual(['<message><body>x</body></message>'
+                          '<message><body>xx</body></message>'], self.sent)
+
+
+    def test_flushAtMaxSize(self):
+        """
+        The buffer is flushed right away once it holds C{maxSize} bytes.
+        """
+        self.buffer.send(self.makeStanza(50))
+        self.buffer.send(self.makeStanza(50))
+        self.assertEqual(1, len(self.sent))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+        self.buffer.send(self.makeStanza(1))
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.sent))
+
+
+    def test_encoding(self):
+        """
+        Stanzas are sent encoded in UTF-8.
+        """
+        message = domish.Element((None, 'message'))
+        message.addElement('body', content=u'\u2083')
+        self.buffer.send(message)
+        self.buffer.flush()
+        self.assertEqual(['<message><body>\xe2\x82\x83</body></message>'],
+                         self.sent)
@@ -0,0 +1,68 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.rsm}.
+"""
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.xish import domish
+
+from idavoll import rsm
+
+class RSMRequestTest(unittest.TestCase):
+
+    def test_fromElement(self):
+        query = domish.Element(('http://jabber.org/protocol/disco#items',
+                                'query'))
+        query.addChild(rsm.RSMRequest(10, u'node1').toElement())
+
+        request = rsm.RSMRequest.fromElement(query)
+        self.assertEqual(10, request.max)
+        self.assertEqual(u'node1', request.after)
+        self.assertIdentical(None, request.before)
+
+
+    def test_fromElementNoSet(self):
+        query = domish.Element(('http://jabber.org/protocol/disco#items',
+                                'query'))
+        self.assertIdentical(None, rsm.RSMRequest.fromElement(query))
+
+
+    def test_fromElementLastPage(self):
+        """
+        An empty C{<before/>} requests the last page.
+        """
+        query = domish.Element(('http://jabber.org/protocol/disco#items',
+                                'query'))
+        query.addElement((rsm.NS_RSM, 'set')).addElement('before')
+
+        request = rsm.RSMRequest.fromElement(query)
+        self.assertEqual(u'', request.before)
+        self.assertIdentical(None, request.after)
+
+
+    def test_fromElementInvalidMax(self):
+        query = domish.Element(('http://jabber.org/protocol/disco#items',
+                                'query'))
+        query.addElement((rsm.NS_RSM, 'set')).addElement('max',
+                                                         content='many')
+
+        self.assertRaises(StanzaError, rsm.RSMRequest.fromElement, query)
+
+
+
+class RSMResponseTest(unittest.TestCase):
+
+    def test_fromKeys(self):
+        element = rsm.RSMResponse.fromKeys([u'a', u'b', u'c']).toElement()
+        self.assertEqual(rsm.NS_RSM, element.uri)
+        self.assertEqual(u'a', unicode(element.first))
+        self.assertEqual(u'c', unicode(element.last))
+        self.assertIdentical(None, element.count)
+
+
+    def test_fromKeysEmpty(self):
+        element = rsm.RSMResponse.fromKeys([]).toElement()
+        self.assertEqual([], list(element.elements()))
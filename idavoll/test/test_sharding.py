@@ -0,0 +1,394 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.sharding}.
+"""
+
+import os
+import shutil
+import tempfile
+
+from zope.interface.verify import verifyObject
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from wokkel.pubsub import Subscription
+
+from idavoll import backend, error, iidavoll, memory_storage, sharding
+from idavoll.serialized import SerializedItem
+
+OWNER = jid.JID('owner@example.com/home')
+SUBSCRIBER = jid.JID('subscriber@example.com/home')
+
+class GetNodeShardTest(unittest.TestCase):
+
+    def test_stable(self):
+        """
+        A node is always owned by the same shard.
+        """
+        self.assertEqual(sharding.getNodeShard(u'test', 4),
+                         sharding.getNodeShard('test', 4))
+
+
+    def test_spread(self):
+        """
+        Nodes are spread over all shards.
+        """
+        shards = set([sharding.getNodeShard('node%d' % i, 4)
+                      for i in xrange(100)])
+        self.assertEqual(set(range(4)), shards)
+
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_roundTrip(self):
+        """
+        Plain values, JIDs, subscriptions and elements are passed as is.
+        """
+        element = domish.Element((None, 'item'))
+        element['id'] = 'item1'
+        element.addElement(('testns', 'test'), content=u'Test \u2083 item')
+        subscription = Subscription(u'test', SUBSCRIBER, 'subscribed',
+                                    {'pubsub#digest': True})
+        value = {u'node': (u'test', 1, None, False, [OWNER]),
+                 u'subscription': subscription,
+                 u'items': [element, SerializedItem(u'<item/>', u'item2')]}
+
+        result = sharding._loads(sharding._dumps(value))
+
+        self.assertEqual(value[u'node'], result[u'node'])
+        self.assertEqual(subscription.nodeIdentifier,
+                         result[u'subscription'].nodeIdentifier)
+        self.assertEqual(SUBSCRIBER, result[u'subscription'].subscriber)
+        self.assertEqual({'pubsub#digest': True},
+                         result[u'subscription'].options)
+        self.assertEqual(element.toXml(), result[u'items'][0].toXml())
+        self.assertIsInstance(result[u'items'][1], SerializedItem)
+        self.assertEqual(u'item2', result[u'items'][1].itemIdentifier)
+
+
+    def test_error(self):
+        """
+        Errors are passed by the name of their class in L{idavoll.error}.
+        """
+        result = sharding._loads(sharding._dumps(error.NodeNotFound()))
+        self.assertIsInstance(result, error.NodeNotFound)
+
+
+    def test_errorUnknown(self):
+        """
+        Names that are not errors of L{idavoll.error} give a generic error.
+        """
+        result = sharding._loads('{"error":["Subscription","test"]}')
+        self.assertEqual(error.Error, result.__class__)
+        self.assertEqual('test', result.msg)
+
+
+    def test_encodeUnknown(self):
+        """
+        Other objects can't be passed.
+        """
+        self.assertRaises(TypeError, sharding._dumps, object())
+
+
+    def test_decodeUnknown(self):
+        """
+        Unknown types are refused.
+        """
+        self.assertRaises(ValueError, sharding._loads,
+                          '{"pickle":"cos\\nsystem\\n"}')
+
+
+
+class ShardRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.backends = []
+        self.factories = []
+        self.ports = []
+        paths = []
+        for index in xrange(2):
+            path = os.path.join(self.tmpdir, 'shard-%d.sock' % index)
+            bs = backend.BackendService(memory_storage.Storage())
+            factory = sharding.ShardServerFactory(bs)
+            self.ports.append(reactor.listenUNIX(path, factory, mode=0600))
+            self.backends.append(bs)
+            self.factories.append(factory)
+            paths.append(path)
+
+        self.router = sharding.ShardRouter(paths)
+        self.router.startService()
+
+        # Find a node identifier for each of the shards.
+        self.nodes = [None, None]
+        for i in xrange(100):
+            nodeIdentifier = 'node%d' % i
+            self.nodes[sharding.getNodeShard(nodeIdentifier, 2)] = \
+                    nodeIdentifier
+        self.assertNotIn(None, self.nodes)
+
+        # Wait for the router to be connected to all shards.
+        return defer.gatherResults([shard.callRemote('getNodes')
+                                    for shard in self.router.shards])
+
+
+    def tearDown(self):
+        disconnected = []
+        for factory in self.factories:
+            for router in factory.routers:
+                d = defer.Deferred()
+                router.connectionLost = lambda reason, d=d: d.callback(None)
+                disconnected.append(d)
+
+        self.router.stopService()
+        dl = [port.stopListening() for port in self.ports]
+        d = defer.gatherResults(disconnected + dl)
+        d.addCallback(lambda _: shutil.rmtree(self.tmpdir))
+        return d
+
+
+    def createNodes(self):
+        return defer.gatherResults([self.router.createNode(nodeIdentifier,
+                                                           OWNER)
+                                    for nodeIdentifier in self.nodes])
+
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(iidavoll.IBackendService, self.router))
+
+
+    def test_createNode(self):
+        """
+        A node is created in the shard that owns it.
+        """
+        def cb(result):
+            self.assertEqual(self.nodes, result)
+            for index, nodeIdentifier in enumerate(self.nodes):
+                storage = self.backends[index].storage
+                self.assertIn(nodeIdentifier, storage._nodes)
+                self.assertNotIn(nodeIdentifier,
+                                 self.backends[1 - index].storage._nodes)
+
+        d = self.createNodes()
+        d.addCallback(cb)
+        return d
+
+
+    def test_createNodeInstant(self):
+        """
+        Instant nodes get an identifier that picks their shard.
+        """
+        def cb(nodeIdentifier):
+            self.assertTrue(nodeIdentifier.startswith('generic/'))
+            index = sharding.getNodeShard(nodeIdentifier, 2)
+            self.assertIn(nodeIdentifier,
+                          self.backends[index].storage._nodes)
+
+        d = self.router.createNode(None, OWNER)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodes(self):
+        """
+        The nodes of all shards are listed, in order.
+        """
+        def cb(nodeIdentifiers):
+            self.assertEqual(sorted([''] + self.nodes), nodeIdentifiers)
+
+        d = self.createNodes()
+        d.addCallback(lambda _: self.router.getNodes())
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodesMaxNodes(self):
+        """
+        A page of nodes is taken from the combined nodes of all shards.
+        """
+        def cb(nodeIdentifiers):
+            self.assertEqual(sorted(self.nodes)[:1], nodeIdentifiers)
+
+        d = self.createNodes()
+        d.addCallback(lambda _: self.router.getNodes('', 1))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodesVersion(self):
+        """
+        The version of the list of nodes changes with the nodes of any of
+        the shards.
+        """
+        versions = []
+
+        def getVersion(_):
+            d = self.router.getNodesVersion()
+            d.addCallback(versions.append)
+            return d
+
+        def cb(_):
+            self.assertNotEqual(versions[0], versions[1])
+            self.assertEqual(versions[1], versions[2])
+
+        d = getVersion(None)
+        d.addCallback(lambda _: self.createNodes())
+        d.addCallback(getVersion)
+        d.addCallback(getVersion)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getSubscriptions(self):
+        """
+        The subscriptions of an entity are gathered from all shards.
+        """
+        def subscribe(_):
+            return defer.gatherResults([
+                self.router.subscribe(nodeIdentifier, SUBSCRIBER, SUBSCRIBER)
+                for nodeIdentifier in self.nodes])
+
+        def cb(subscriptions):
+            self.assertEqual(sorted(self.nodes),
+                             sorted([subscription.nodeIdentifier
+                                     for subscription in subscriptions]))
+            for subscription in subscriptions:
+                self.assertEqual(SUBSCRIBER, subscription.subscriber)
+
+        d = self.createNodes()
+        d.addCallback(subscribe)
+        d.addCallback(lambda _: self.router.getSubscriptions(SUBSCRIBER))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getAffiliations(self):
+        """
+        The affiliations of an entity are gathered from all shards.
+        """
+        def cb(affiliations):
+            self.assertEqual([(nodeIdentifier, 'owner')
+                              for nodeIdentifier in sorted(self.nodes)],
+                             sorted(affiliations))
+
+        d = self.createNodes()
+        d.addCallback(lambda _: self.router.getAffiliations(OWNER))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodeNotFound(self):
+        """
+        Errors raised in a shard are raised by the router.
+        """
+        d = self.router.getNodeConfiguration('missing')
+        self.assertFailure(d, error.NodeNotFound)
+        return d
+
+
+    def test_publish(self):
+        """
+        Notifications of items published in a shard are dispatched by the
+        router, and the items can be retrieved.
+        """
+        notified = defer.Deferred()
+        self.router.registerNotifier(notified.callback)
+
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item1'
+        item.addElement(('testns', 'test'), content=u'Test \u2083 item')
+
+        def notify(data):
+            self.assertEqual(self.nodes[1], data['nodeIdentifier'])
+            self.assertEqual(1, len(data['items']))
+            self.assertEqual(item.toXml(), data['items'][0].toXml())
+
+        def getItems(_):
+            return self.router.getItems(self.nodes[1], OWNER)
+
+        def cb(items):
+            self.assertEqual(1, len(items))
+            self.assertEqual(item.toXml(), items[0].toXml())
+
+        d = self.createNodes()
+        d.addCallback(lambda _: self.router.publish(self.nodes[1], [item],
+                                                    OWNER))
+        d.addCallback(lambda _: notified)
+        d.addCallback(notify)
+        d.addCallback(getItems)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNotifications(self):
+        """
+        Subscribers to the root node are notified of publishes to nodes of
+        all shards.
+        """
+        items = []
+        rootShard = sharding.getNodeShard('', 2)
+        nodeIdentifier = self.nodes[1 - rootShard]
+
+        def subscribe(_):
+            return defer.gatherResults([
+                self.router.subscribe(nodeIdentifier, SUBSCRIBER, SUBSCRIBER),
+                self.router.subscribe('', OWNER, OWNER)])
+
+        def cb(notifications):
+            self.assertEqual(2, len(notifications))
+            subscribers = {}
+            for subscriber, subscriptions, notifiedItems in notifications:
+                self.assertIdentical(items, notifiedItems)
+                subscribers[subscriber] = [subscription.nodeIdentifier
+                                           for subscription in subscriptions]
+            self.assertEqual({SUBSCRIBER: [nodeIdentifier], OWNER: ['']},
+                             subscribers)
+
+        d = self.createNodes()
+        d.addCallback(subscribe)
+        d.addCallback(lambda _: self.router.getNotifications(nodeIdentifier,
+                                                             items))
+        d.addCallback(cb)
+        return d
+
+
+    def test_deleteNode(self):
+        """
+        Callbacks registered with the router are called before deleting a
+        node in a shard, and the shard waits for them.
+        """
+        preDeleted = defer.Deferred()
+        nodeIdentifier = self.nodes[0]
+        storage = self.backends[0].storage
+
+        def preDelete(data):
+            self.assertEqual(nodeIdentifier, data['nodeIdentifier'])
+            d = self.router.getSubscribers(nodeIdentifier)
+            d.addCallback(preDeleted.callback)
+            return d
+
+        def cb(subscribers):
+            self.assertEqual([SUBSCRIBER], subscribers)
+            self.assertIn(nodeIdentifier, storage._nodes)
+
+        def checkDeleted(_):
+            self.assertNotIn(nodeIdentifier, storage._nodes)
+
+        self.router.registerPreDelete(preDelete)
+        d = self.createNodes()
+        d.addCallback(lambda _: self.router.subscribe(nodeIdentifier,
+                                                      SUBSCRIBER,
+                                                      SUBSCRIBER))
+        d.addCallback(lambda _: self.router.deleteNode(nodeIdentifier, OWNER))
+        d.addCallback(lambda _: preDeleted)
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.router.getNodes())
+        d.addCallback(checkDeleted)
+        return d
@@ -2,16 +2,21 @@
 # See LICENSE for details.
 
 """
-Tests for L{idavoll.memory_storage} and L{idavoll.pgsql_storage}.
+Tests for L{idavoll.memory_storage}, L{idavoll.pgsql_storage} and
+L{idavoll.tiered_storage}.
 """
 
+import datetime
+import os
+
 from zope.interface.verify import verifyObject
 from twisted.trial import unittest
 from twisted.words.protocols.jabber import jid
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.words.xish import domish
 
 from idavoll import error, iidavoll
+from idavoll.serialized import SerializedItem
 
 OWNER = jid.JID('owner@example.com/Work')
 SUBSCRIBER = jid.JID('subscriber@example.com/Home')
@@ -81,6 +86,85 @@ class StorageTests:
         return self.s.getNodeIds().addCallback(cb)
 
 
+    def test_getNodeIdsPaged(self):
+        """
+        Node identifiers can be retrieved in pages, in order.
+        """
+        def cb(nodeIdentifiers):
+            self.assertEqual(['to-be-deleted', 'to-be-purged'],
+                             nodeIdentifiers)
+
+        d = self.s.getNodeIds(after='pre-existing', maxNodes=2)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodeIdsPagedAfterChanges(self):
+        """
+        Created and deleted nodes are reflected in later pages.
+        """
+        def create(_):
+            config = self.s.getDefaultConfiguration('leaf')
+            config['pubsub#node_type'] = 'leaf'
+            d = self.s.createNode('pre-existing 2', OWNER, config)
+            d.addCallback(lambda _: self.s.deleteNode('to-be-deleted'))
+            d.addCallback(lambda _: self.s.getNodeIds(after='pre-existing',
+                                                      maxNodes=2))
+            return d
+
+        def cb(nodeIdentifiers):
+            self.assertEqual(['pre-existing 2', 'to-be-purged'],
+                             nodeIdentifiers)
+
+        d = self.s.getNodeIds()
+        d.addCallback(create)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodesVersion(self):
+        """
+        The version of the list of nodes only changes with the nodes.
+        """
+        def cb(result):
+            (version1, lastModified1), (version2, lastModified2) = result
+            self.assertEqual(version1, version2)
+            self.assertEqual(lastModified1, lastModified2)
+
+        d = defer.gatherResults([self.s.getNodesVersion(),
+                                 self.s.getNodesVersion()])
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodesVersionChanges(self):
+        """
+        Every creation and deletion of a node changes the version of the
+        list of nodes, also when a node replaces the one deleted last.
+        """
+        versions = []
+        config = self.s.getDefaultConfiguration('leaf')
+        config['pubsub#node_type'] = 'leaf'
+
+        def getVersion(_):
+            d = self.s.getNodesVersion()
+            d.addCallback(lambda result: versions.append(result[0]))
+            return d
+
+        def cb(_):
+            self.assertEqual(4, len(set(versions)))
+
+        d = getVersion(None)
+        d.addCallback(lambda _: self.s.createNode('new 1', OWNER, config))
+        d.addCallback(getVersion)
+        d.addCallback(lambda _: self.s.deleteNode('new 1'))
+        d.addCallback(getVersion)
+        d.addCallback(lambda _: self.s.createNode('new 2', OWNER, config))
+        d.addCallback(getVersion)
+        d.addCallback(cb)
+        return d
+
+
     def test_createExistingNode(self):
         config = self.s.getDefaultConfiguration('leaf')
         config['pubsub#node_type'] = 'leaf'
@@ -368,6 +452,26 @@ class StorageTests:
         return d
 
 
+    def test_getItemsSerialized(self):
+        """
+        Items are returned serialized, and are written as they are into
+        an element.
+        """
+        def cb(result):
+            self.assertEqual(1, len(result))
+            self.assertIsInstance(result[0], SerializedItem)
+            self.assertEqual(u'current', result[0].itemIdentifier)
+            element = domish.Element((None, 'items'))
+            element.addChild(result[0])
+            self.assertEqual(u'<items>%s</items>' % ITEM.toXml(),
+                             element.toXml())
+            self.assertEqual(ITEM.toXml(), result[0].toElement().toXml())
+
+        d = self.node.getItems(1)
+        d.addCallback(cb)
+        return d
+
+
     def test_lastItem(self):
         def cb(result):
             self.assertEqual(1, len(result))
@@ -378,6 +482,123 @@ class StorageTests:
         return d
 
 
+    def test_getItemsOrder(self):
+        """
+        Items are returned from most recently to least recently published.
+        """
+        def cb(result):
+            self.assertEqual(['current', 'to-be-deleted'],
+                             [item.itemIdentifier for item in result])
+
+        d = self.node.getItems()
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsAfter(self):
+        def cb(result):
+            self.assertEqual(['to-be-deleted'],
+                             [item.itemIdentifier for item in result])
+
+        d = self.node.getItems(1, after='current')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsAfterLast(self):
+        def cb(result):
+            self.assertEqual([], result)
+
+        d = self.node.getItems(1, after='to-be-deleted')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsBefore(self):
+        def cb(result):
+            self.assertEqual(['current'],
+                             [item.itemIdentifier for item in result])
+
+        d = self.node.getItems(1, before='to-be-deleted')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsLastPage(self):
+        """
+        An empty C{before} gets the least recently published items.
+        """
+        def cb(result):
+            self.assertEqual(['to-be-deleted'],
+                             [item.itemIdentifier for item in result])
+
+        d = self.node.getItems(1, before='')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsNone(self):
+        """
+        Asking for no items gives an empty page, not all items.
+        """
+        def cb(result):
+            self.assertEqual([], result)
+
+        d = self.node.getItems(0)
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.node.getItems(0, after='current'))
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.node.getItems(0, before=''))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsAfterNonExisting(self):
+        d = self.node.getItems(1, after='non-existing')
+        self.assertFailure(d, error.ItemNotFound)
+        return d
+
+
+    def test_getItemsSinceItem(self):
+        def cb(result):
+            self.assertEqual(['current'],
+                             [item.itemIdentifier for item in result])
+
+        d = self.node.getItems(since='to-be-deleted')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsSinceDate(self):
+        """
+        Only items published after the given time are returned.
+        """
+        def cb(result):
+            self.assertEqual(['current'],
+                             [item.itemIdentifier for item in result])
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        d = self.node.getItems(since=since)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsSinceNow(self):
+        def cb(result):
+            self.assertEqual([], result)
+
+        since = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        d = self.node.getItems(since=since)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsSinceNonExisting(self):
+        d = self.node.getItems(since='non-existing')
+        self.assertFailure(d, error.ItemNotFound)
+        return d
+
+
     def test_getItemsById(self):
         def cb(result):
             self.assertEqual(1, len(result))
@@ -459,7 +680,8 @@ class MemoryStorageStorageTestCase(unittest.TestCase, StorageTests):
                 Subscription('pre-existing', SUBSCRIBER_PENDING,
                              'pending')
 
-        item = PublishedItem(ITEM_TO_BE_DELETED, PUBLISHER)
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        item = PublishedItem(ITEM_TO_BE_DELETED, PUBLISHER, yesterday)
         self.s._nodes['pre-existing']._items['to-be-deleted'] = item
         self.s._nodes['pre-existing']._itemlist.append(item)
         self.s._nodes['to-be-purged']._items['to-be-deleted'] = item
@@ -471,6 +693,164 @@ class MemoryStorageStorageTestCase(unittest.TestCase, StorageTests):
         return StorageTests.setUp(self)
 
 
+    def test_getItemsAfterSameDate(self):
+        """
+        Pages start after the given item among items with the same date.
+        """
+        from idavoll.memory_storage import PublishedItem
+
+        node = self.s._nodes['to-be-reconfigured']
+        date = datetime.datetime(2008, 7, 1)
+        for itemIdentifier in ('1', '2', '3'):
+            element = domish.Element((None, 'item'))
+            element['id'] = itemIdentifier
+            item = PublishedItem(element, PUBLISHER, date)
+            node._items[itemIdentifier] = item
+            node._itemlist.append(item)
+
+        def cb(result):
+            self.assertEqual(['1'], [item.itemIdentifier for item in result])
+
+        d = node.getItems(after='2')
+        d.addCallback(cb)
+        return d
+
+
+    def test_storeItemDistinctDates(self):
+        """
+        Items published at the same time get distinct dates, in order.
+        """
+        node = self.s._nodes['to-be-reconfigured']
+        date = datetime.datetime(2008, 7, 1)
+        node._storeItem(ITEM_NEW, PUBLISHER, date)
+        node._storeItem(ITEM, PUBLISHER, date)
+        first, second = node._itemlist
+        self.assertEqual(date, first.date)
+        self.assertTrue(second.date > date)
+
+
+
+class MemoryStorageSnapshotTestCase(MemoryStorageStorageTestCase):
+    """
+    Storage tests for a memory storage restored from a snapshot.
+    """
+
+    def setUp(self):
+        from idavoll.memory_storage import Storage
+
+        d = MemoryStorageStorageTestCase.setUp(self)
+        path = self.mktemp()
+
+        def restore(_):
+            self.assertFalse(os.path.exists(path + '.tmp'))
+            self.s = Storage()
+            self.s.loadSnapshot(path)
+            return StorageTests.setUp(self)
+
+        d.addCallback(lambda _: self.s.writeSnapshot(path))
+        d.addCallback(restore)
+        return d
+
+
+    def test_loadSnapshotUnsupportedVersion(self):
+        """
+        Snapshots of other versions are refused.
+        """
+        import cPickle
+        from idavoll.memory_storage import Storage
+
+        path = self.mktemp()
+        f = open(path, 'wb')
+        cPickle.dump((1, [], 3), f)
+        f.close()
+
+        self.assertRaises(ValueError, Storage().loadSnapshot, path)
+
+
+
+class FileStorageStorageTestCase(unittest.TestCase, StorageTests):
+
+    def setUp(self):
+        from idavoll.file_storage import Storage
+
+        self.path = self.mktemp()
+        self.s = Storage(self.path)
+        config = dict(Storage.defaultConfig['leaf'])
+        config['pubsub#node_type'] = 'leaf'
+        for nodeIdentifier in ('pre-existing', 'to-be-deleted',
+                               'to-be-reconfigured', 'to-be-purged'):
+            self.s.createNode(nodeIdentifier, OWNER, config)
+
+        node = self.s._nodes['pre-existing']
+        node.addSubscription(SUBSCRIBER, 'subscribed', {})
+        node.addSubscription(SUBSCRIBER_TO_BE_DELETED, 'subscribed', {})
+        node.addSubscription(SUBSCRIBER_PENDING, 'pending', {})
+
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        node._storeItem(ITEM_TO_BE_DELETED, PUBLISHER, yesterday)
+        node._storeItem(ITEM, PUBLISHER)
+        node._flush()
+        self.s._nodes['to-be-purged'].storeItems([ITEM_TO_BE_DELETED],
+                                                 PUBLISHER)
+
+        return StorageTests.setUp(self)
+
+
+    def tearDown(self):
+        self.s.close()
+
+
+
+class FileStorageReloadTestCase(FileStorageStorageTestCase):
+    """
+    Storage tests for a file storage loaded from its directory.
+    """
+
+    def setUp(self):
+        from idavoll.file_storage import Storage
+
+        def reload(_):
+            self.s.close()
+            self.s = Storage(self.path)
+            return StorageTests.setUp(self)
+
+        d = FileStorageStorageTestCase.setUp(self)
+        d.addCallback(reload)
+        return d
+
+
+
+class SnapshotServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        from idavoll.memory_storage import Storage, SnapshotService
+        self.path = self.mktemp()
+        self.storage = Storage()
+        self.service = SnapshotService(self.storage, self.path)
+
+
+    def test_stopService(self):
+        """
+        A snapshot is written when the service stops, and loaded when it
+        starts again.
+        """
+        from idavoll.memory_storage import Storage
+
+        def cb(_):
+            self.storage = Storage()
+            self.service.storage = self.storage
+            self.service.startService()
+            self.assertIn('new', self.storage._nodes)
+            return self.service.stopService()
+
+        self.service.startService()
+        self.storage.createNode('new', OWNER,
+                                {'pubsub#node_type': 'leaf'})
+        d = self.service.stopService()
+        d.addCallback(cb)
+        return d
+
+
 
 class PgsqlStorageStorageTestCase(unittest.TestCase, StorageTests):
 
@@ -485,13 +865,17 @@ class PgsqlStorageStorageTestCase(unittest.TestCase, StorageTests):
                                             cp_reconnect=True,
                                             client_encoding='utf-8',
                                             )
-        self.s = Storage(self.dbpool)
+        self.s = Storage(self.dbpool, cache=self.makeCache())
         self.dbpool.start()
         d = self.dbpool.runInteraction(self.init)
         d.addCallback(lambda _: StorageTests.setUp(self))
         return d
 
 
+    def makeCache(self):
+        return None
+
+
     def tearDown(self):
         return self.dbpool.runInteraction(self.cleandb)
 
@@ -567,7 +951,7 @@ class PgsqlStorageStorageTestCase(unittest.TestCase, StorageTests):
         cursor.execute("""DELETE FROM nodes WHERE node in
                           ('non-existing', 'pre-existing', 'to-be-deleted',
                            'new 1', 'new 2', 'new 3', 'to-be-reconfigured',
-                           'to-be-purged')""")
+                           'to-be-purged', 'pre-existing 2')""")
         cursor.execute("""DELETE FROM entities WHERE jid=%s""",
                        OWNER.userhost())
         cursor.execute("""DELETE FROM entities WHERE jid=%s""",
@@ -584,3 +968,553 @@ try:
     pyPgSQL
 except ImportError:
     PgsqlStorageStorageTestCase.skip = "pyPgSQL not available"
+
+
+
+class PgsqlCachedStorageStorageTestCase(PgsqlStorageStorageTestCase):
+
+    def makeCache(self):
+        from idavoll.pgsql_storage import NodeCache
+        return NodeCache()
+
+
+
+class TieredStorageStorageTestCase(PgsqlStorageStorageTestCase):
+
+    def setUp(self):
+        from idavoll.tiered_storage import Storage
+        from twisted.enterprise import adbapi
+        if self.dbpool is None:
+            self.__class__.dbpool = adbapi.ConnectionPool('pyPgSQL.PgSQL',
+                                            database='pubsub_test',
+                                            cp_reconnect=True,
+                                            client_encoding='utf-8',
+                                            )
+        self.s = Storage(self.dbpool)
+        self.dbpool.start()
+        d = self.dbpool.runInteraction(self.init)
+        d.addCallback(lambda _: self.s.load())
+        d.addCallback(lambda _: StorageTests.setUp(self))
+        return d
+
+
+    def tearDown(self):
+        d = self.s.stop()
+        d.addCallback(lambda _: PgsqlStorageStorageTestCase.tearDown(self))
+        return d
+
+
+    def test_restartRootSubscriptions(self):
+        """
+        Subscriptions to the root node are kept over a restart.
+        """
+        from idavoll.tiered_storage import Storage
+
+        def restart(_):
+            d = self.s.stop()
+            d.addCallback(lambda _: Storage(self.dbpool))
+            d.addCallback(lambda storage: setattr(self, 's', storage))
+            d.addCallback(lambda _: self.s.load())
+            return d
+
+        d = self.s.getNode('')
+        d.addCallback(lambda node: node.addSubscription(SUBSCRIBER_NEW,
+                                                        'subscribed', {}))
+        d.addCallback(restart)
+        d.addCallback(lambda _: self.s.getNode(''))
+        d.addCallback(lambda node: node.getSubscription(SUBSCRIBER_NEW))
+        d.addCallback(lambda subscription:
+                      self.assertEqual('subscribed', subscription.state))
+        return d
+
+
+
+class SqliteStorageStorageTestCase(unittest.TestCase, StorageTests):
+
+    def setUp(self):
+        from idavoll.sqlite_storage import ConnectionPool, Storage
+        self.dbpool = ConnectionPool(self.mktemp(), readers=2)
+        self.dbpool.start()
+        self.s = Storage(self.dbpool)
+        d = self.dbpool.runInteraction(self.init)
+        d.addCallback(lambda _: StorageTests.setUp(self))
+        return d
+
+
+    def tearDown(self):
+        self.dbpool.close()
+
+
+    def init(self, cursor):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        now = datetime.datetime.utcnow()
+
+        cursor.execute("""INSERT INTO nodes
+                          (node, node_type, persist_items)
+                          VALUES ('pre-existing', 'leaf', 1)""")
+        cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-deleted')""")
+        cursor.execute("""INSERT INTO nodes (node)
+                          VALUES ('to-be-reconfigured')""")
+        cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-purged')""")
+        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                       OWNER.userhost())
+        cursor.execute("""INSERT INTO affiliations
+                          (node_id, entity_id, affiliation)
+                          SELECT node_id, entity_id, 'owner'
+                          FROM nodes, entities
+                          WHERE node='pre-existing' AND jid=%s""",
+                       OWNER.userhost())
+
+        for subscriber, state in ((SUBSCRIBER, 'subscribed'),
+                                  (SUBSCRIBER_TO_BE_DELETED, 'subscribed'),
+                                  (SUBSCRIBER_PENDING, 'pending')):
+            cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                           subscriber.userhost())
+            cursor.execute("""INSERT INTO subscriptions
+                              (node_id, entity_id, resource, state)
+                              SELECT node_id, entity_id, %s, %s
+                              FROM nodes, entities
+                              WHERE node='pre-existing' AND jid=%s""",
+                           (subscriber.resource,
+                            state,
+                            subscriber.userhost()))
+
+        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                       PUBLISHER.userhost())
+
+        for node, item, date in (('pre-existing', ITEM_TO_BE_DELETED,
+                                  yesterday),
+                                 ('to-be-purged', ITEM_TO_BE_DELETED, now),
+                                 ('pre-existing', ITEM, now)):
+            cursor.execute("""INSERT INTO items
+                              (node_id, publisher, item, data, date)
+                              SELECT node_id, %s, %s, %s, %s
+                              FROM nodes
+                              WHERE node=%s""",
+                           (PUBLISHER.userhost(),
+                            item['id'],
+                            item.toXml(),
+                            date.isoformat() + '+00:00',
+                            node))
+
+
+    def test_commitBatcher(self):
+        """
+        Publishes can share a transaction on the writer connection, with
+        one that fails rolled back on its own.
+        """
+        from idavoll.pgsql_storage import CommitBatcher
+        batcher = CommitBatcher(self.dbpool, 0.01)
+        self.node.batcher = batcher
+        missing = self.s._makeLeafNode('non-existing', {})
+        missing.dbpool = self.dbpool
+        missing.batcher = batcher
+
+        def cb(result):
+            (success1, result1), (success2, result2) = result
+            self.assertTrue(success1)
+            self.assertFalse(success2)
+            result2.trap(error.NodeNotFound)
+            return self.node.getItemsById(['new'])
+
+        def cbItems(items):
+            self.assertEqual(1, len(items))
+
+        d1 = self.node.storeItems([ITEM_NEW], PUBLISHER)
+        d2 = missing.storeItems([ITEM_NEW], PUBLISHER)
+        d = defer.DeferredList([d1, d2], consumeErrors=True)
+        d.addCallback(cb)
+        d.addCallback(cbItems)
+        return d
+
+
+    def test_gatewayCallbackEncoding(self):
+        """
+        The gateway storage keeps the content coding of callbacks, and
+        replaces it when a callback is added again.
+        """
+        from idavoll.pgsql_storage import GatewayStorage
+        storage = GatewayStorage(self.dbpool)
+        service = jid.JID('pubsub.example.org')
+
+        d = storage.addCallback(service, 'test', 'http://example.org/1',
+                                'gzip')
+        d.addCallback(lambda _: storage.addCallback(service, 'test',
+                                                    'http://example.org/2'))
+        d.addCallback(lambda _: storage.addCallback(service, 'test',
+                                                    'http://example.org/1'))
+        d.addCallback(lambda _: storage.getCallbacks(service, 'test'))
+        d.addCallback(self.assertEqual, {'http://example.org/1': None,
+                                         'http://example.org/2': None})
+        return d
+
+
+
+class TestCursor(object):
+    """
+    Cursor that records the executed statements.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+
+    def execute(self, statement, args=None):
+        self.statements.append(statement)
+
+
+
+class TestConnectionPool(object):
+    """
+    Connection pool that runs interactions right away, on a L{TestCursor}.
+    """
+
+    def __init__(self):
+        self.cursors = []
+
+
+    def runInteraction(self, interaction, *args, **kw):
+        cursor = TestCursor()
+        self.cursors.append(cursor)
+        return defer.maybeDeferred(interaction, cursor, *args, **kw)
+
+
+
+class CommitBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        from idavoll.pgsql_storage import CommitBatcher
+        self.dbpool = TestConnectionPool()
+        self.clock = task.Clock()
+        self.batcher = CommitBatcher(self.dbpool, 0.001, 3, self.clock)
+
+
+    def test_window(self):
+        """
+        Interactions within the window share a transaction, and each
+        Deferred fires with the result of its own interaction.
+        """
+        results = []
+        for value in (1, 2):
+            d = self.batcher.runInteraction(lambda cursor, v: v, value)
+            d.addCallback(results.append)
+
+        self.assertEqual([], self.dbpool.cursors)
+        self.clock.advance(0.001)
+        self.assertEqual(1, len(self.dbpool.cursors))
+        self.assertEqual([1, 2], results)
+
+
+    def test_maxBatch(self):
+        """
+        A full batch is run right away.
+        """
+        for i in xrange(3):
+            self.batcher.runInteraction(lambda cursor: None)
+
+        self.assertEqual(1, len(self.dbpool.cursors))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_failure(self):
+        """
+        A failing interaction is rolled back without affecting the others.
+        """
+        def fail(cursor):
+            raise error.NodeNotFound()
+
+        d1 = self.batcher.runInteraction(fail)
+        self.assertFailure(d1, error.NodeNotFound)
+        d2 = self.batcher.runInteraction(lambda cursor: 'ok')
+        d2.addCallback(self.assertEqual, 'ok')
+        self.clock.advance(0.001)
+
+        self.assertEqual(['SAVEPOINT batched',
+                          'ROLLBACK TO SAVEPOINT batched',
+                          'SAVEPOINT batched',
+                          'RELEASE SAVEPOINT batched'],
+                         self.dbpool.cursors[0].statements)
+        return defer.gatherResults([d1, d2])
+
+
+
+class NodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        from idavoll.pgsql_storage import NodeCache
+        self.cache = NodeCache()
+        self.loads = []
+
+
+    def load(self, value):
+        self.loads.append(value)
+        return defer.succeed(value)
+
+
+    def test_get(self):
+        """
+        A value is loaded once, and then taken from the cache.
+        """
+        results = []
+        for value in ('first', 'second'):
+            d = self.cache.get('test', 'subscriptions', self.load, value)
+            d.addCallback(results.append)
+
+        self.assertEqual(['first'], self.loads)
+        self.assertEqual(['first', 'first'], results)
+
+
+    def test_invalidate(self):
+        """
+        The values of an invalidated node are loaded again.
+        """
+        self.cache.get('test', 'subscriptions', self.load, 'first')
+        self.cache.get('other', 'subscriptions', self.load, 'other')
+        self.cache.invalidate('test')
+        self.cache.get('test', 'subscriptions', self.load, 'second')
+        self.cache.get('other', 'subscriptions', self.load, 'other')
+        self.assertEqual(['first', 'other', 'second'], self.loads)
+
+
+    def test_invalidateWhileLoading(self):
+        """
+        A value that was being loaded while its node was invalidated, is
+        not kept.
+        """
+        loading = defer.Deferred()
+        self.cache.get('test', 'node', lambda: loading)
+        self.cache.invalidate('test')
+        loading.callback('old')
+        self.cache.get('test', 'node', self.load, 'new')
+        self.assertEqual(['new'], self.loads)
+
+
+    def test_clear(self):
+        """
+        Clearing the cache drops the values of all nodes.
+        """
+        self.cache.get('test', 'node', self.load, 'first')
+        self.cache.clear()
+        self.cache.get('test', 'node', self.load, 'second')
+        self.assertEqual(['first', 'second'], self.loads)
+
+
+    def test_maxNodes(self):
+        """
+        When too many nodes are cached, the least recently used is dropped.
+        """
+        self.cache.maxNodes = 2
+        self.cache.get('first', 'node', self.load, 'first')
+        self.cache.get('second', 'node', self.load, 'second')
+        self.cache.get('first', 'node', self.load, 'first')
+        self.cache.get('third', 'node', self.load, 'third')
+        self.cache.get('first', 'node', self.load, 'first')
+        self.cache.get('second', 'node', self.load, 'second')
+        self.assertEqual(['first', 'second', 'third', 'second'], self.loads)
+
+
+
+class ChangeListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        from idavoll.pgsql_storage import ChangeListener, NodeCache
+        self.listener = ChangeListener(NodeCache(), None)
+        self.listener._low = 10
+
+
+    def test_processChanges(self):
+        """
+        The nodes of new changes are returned, and the last change seen is
+        kept.
+        """
+        nodes = self.listener._processChanges([(11, 'a'), (12, 'b')], 0)
+        self.assertEqual(set(['a', 'b']), nodes)
+        self.assertEqual(12, self.listener._low)
+
+
+    def test_processChangesGap(self):
+        """
+        Changes after a gap are read again until the gap is filled, but only
+        returned once.
+        """
+        nodes = self.listener._processChanges([(12, 'b')], 0)
+        self.assertEqual(set(['b']), nodes)
+        self.assertEqual(10, self.listener._low)
+
+        nodes = self.listener._processChanges([(11, 'a'), (12, 'b')], 1)
+        self.assertEqual(set(['a']), nodes)
+        self.assertEqual(12, self.listener._low)
+
+
+    def test_processChangesGapTimeout(self):
+        """
+        Gaps are skipped after a while.
+        """
+        self.listener._processChanges([(12, 'b')], 0)
+        nodes = self.listener._processChanges(
+                [(12, 'b')], self.listener.gapTimeout + 1)
+        self.assertEqual(set(), nodes)
+        self.assertEqual(12, self.listener._low)
+
+
+
+class RecordingConnectionPool(object):
+    """
+    Connection pool that records the interactions, without running them.
+    """
+
+    def __init__(self):
+        self.interactions = []
+
+
+    def runInteraction(self, interaction, *args, **kw):
+        self.interactions.append(interaction.__name__)
+        return defer.succeed(None)
+
+
+
+class StatementCursor(object):
+    """
+    Cursor that records the executed statements.
+    """
+
+    def __init__(self, statements):
+        self.statements = statements
+
+
+    def execute(self, statement, args=None):
+        self.statements.append(' '.join(statement.split()))
+
+
+
+class StatementConnectionPool(object):
+    """
+    Connection pool that runs interactions on a L{StatementCursor}.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+
+    def runInteraction(self, interaction, *args, **kw):
+        return defer.maybeDeferred(interaction,
+                                   StatementCursor(self.statements),
+                                   *args, **kw)
+
+
+
+class RunChangeTest(unittest.TestCase):
+
+    def setUp(self):
+        from idavoll.pgsql_storage import Storage
+        self.dbpool = StatementConnectionPool()
+        self.storage = Storage(self.dbpool)
+
+
+    def change(self, cursor):
+        cursor.execute("""UPDATE nodes""")
+
+
+    def test_runChange(self):
+        """
+        Without notifying changes, only the change is made.
+        """
+        from idavoll.pgsql_storage import _runChange
+        _runChange(self.storage, 'test', self.change)
+        self.assertEqual(['UPDATE nodes'], self.dbpool.statements)
+
+
+    def test_runChangeNotify(self):
+        """
+        Changes are recorded and notified in the same transaction.
+        """
+        from idavoll.pgsql_storage import _runChange
+        self.storage.notifyChanges = True
+        _runChange(self.storage, 'test', self.change)
+        self.assertEqual(['UPDATE nodes',
+                          'INSERT INTO node_changes (node) VALUES (%s)',
+                          'NOTIFY node_changes'],
+                         self.dbpool.statements)
+
+
+    def test_notifyChangesCache(self):
+        """
+        With a cache, changes are always notified, also by its nodes.
+        """
+        from idavoll.pgsql_storage import NodeCache, Storage
+        storage = Storage(self.dbpool, cache=NodeCache())
+        self.assertTrue(storage.notifyChanges)
+        node = storage._makeNode('test', 'leaf', {})
+        self.assertTrue(node.notifyChanges)
+
+
+
+class RecentWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        from idavoll.pgsql_storage import RecentWrites
+        self.clock = task.Clock()
+        self.recentWrites = RecentWrites(1, self.clock)
+        self.dbpool = RecordingConnectionPool()
+        self.readpool = RecordingConnectionPool()
+        self.node = self.makeNode('test')
+        self.other = self.makeNode('other')
+
+
+    def makeNode(self, nodeIdentifier):
+        from idavoll.pgsql_storage import LeafNode
+        node = LeafNode(nodeIdentifier, {})
+        node.dbpool = self.dbpool
+        node.readpool = self.readpool
+        node.recentWrites = self.recentWrites
+        return node
+
+
+    def test_isRecent(self):
+        """
+        Keys are recent until the window after their write has passed.
+        """
+        self.recentWrites.add(('node', 'test'))
+        self.assertTrue(self.recentWrites.isRecent(('node', 'test')))
+        self.assertFalse(self.recentWrites.isRecent(('node', 'other')))
+        self.clock.advance(1)
+        self.assertFalse(self.recentWrites.isRecent(('node', 'test')))
+
+
+    def test_readFromReplica(self):
+        """
+        Reads are made from the replica.
+        """
+        self.node.getItems()
+        self.assertEqual(['_getItems'], self.readpool.interactions)
+        self.assertEqual([], self.dbpool.interactions)
+
+
+    def test_readYourWrites(self):
+        """
+        Reads about a node written to are made from the primary, until the
+        window has passed.
+        """
+        self.node.purge()
+        self.node.getItems()
+        self.other.getItems()
+        self.assertEqual(['_purge', '_getItems'], self.dbpool.interactions)
+        self.assertEqual(['_getItems'], self.readpool.interactions)
+
+        self.clock.advance(1)
+        self.node.getItems()
+        self.assertEqual(['_getItems', '_getItems'],
+                         self.readpool.interactions)
+
+
+    def test_readYourWritesEntity(self):
+        """
+        Reads about an entity that has subscribed are made from the primary,
+        also for other nodes.
+        """
+        self.node.addSubscription(SUBSCRIBER, 'subscribed', {})
+        self.other.getSubscription(SUBSCRIBER)
+        self.other.getSubscription(SUBSCRIBER_NEW)
+        self.assertEqual(['_addSubscription', '_getSubscription'],
+                         self.dbpool.interactions)
+        self.assertEqual(['_getSubscription'], self.readpool.interactions)
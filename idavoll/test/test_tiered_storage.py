@@ -0,0 +1,339 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.tiered_storage}.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from idavoll import tiered_storage
+
+OWNER = jid.JID('owner@example.com')
+PUBLISHER = jid.JID('publisher@example.com')
+SUBSCRIBER = jid.JID('subscriber@example.com/Home')
+
+def makeConfig():
+    return {'pubsub#node_type': 'leaf',
+            'pubsub#persist_items': True,
+            'pubsub#deliver_payloads': True,
+            'pubsub#send_last_published_item': 'on_sub'}
+
+
+
+class TestConnectionPool(object):
+    """
+    Connection pool that records interactions, to be completed by the test.
+    """
+
+    def __init__(self):
+        self.interactions = []
+
+
+    def runInteraction(self, interaction, *args):
+        d = defer.Deferred()
+        self.interactions.append((interaction, args, d))
+        return d
+
+
+
+class TestCursor(object):
+    """
+    Cursor that records the executed statements.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+
+    def execute(self, statement, args=None):
+        self.statements.append(statement)
+
+
+
+class LoadCursor(object):
+    """
+    Cursor that returns the given rows for each query, in order.
+    """
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+
+    def execute(self, statement, args=None):
+        self.rows = self.results.pop(0)
+
+
+    def fetchall(self):
+        return self.rows
+
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbpool = TestConnectionPool()
+        self.clock = task.Clock()
+        self.storage = tiered_storage.Storage(self.dbpool, 1.0, 3,
+                                              self.clock)
+        self.storage.load()
+        interaction, args, d = self.dbpool.interactions.pop()
+        d.callback(None)
+
+
+    def getBatch(self):
+        """
+        Get the changes written by the last flush.
+        """
+        interaction, args, d = self.dbpool.interactions[-1]
+        self.assertEqual(self.storage._applyBatch, interaction)
+        return [operation.__name__ for operation, args, nodeIdentifier
+                                   in args[0]]
+
+
+    def test_whenLoaded(self):
+        """
+        Storage methods wait for the storage to be loaded.
+        """
+        storage = tiered_storage.Storage(self.dbpool, clock=self.clock)
+        storage.load()
+        d = storage.getNode('')
+        self.assertFalse(d.called)
+
+        nodes = []
+        d.addCallback(nodes.append)
+        interaction, args, loadDeferred = self.dbpool.interactions.pop()
+        loadDeferred.callback(None)
+        self.assertEqual([''], [node.nodeIdentifier for node in nodes])
+
+
+    def test_whenLoadFailed(self):
+        """
+        If loading the storage fails, storage methods fail instead of
+        waiting, both before and after the failure.
+        """
+        storage = tiered_storage.Storage(self.dbpool, clock=self.clock)
+        d = storage.load()
+        self.assertFailure(d, RuntimeError)
+        before = storage.getNode('')
+        self.assertFailure(before, RuntimeError)
+
+        interaction, args, loadDeferred = self.dbpool.interactions.pop()
+        loadDeferred.errback(RuntimeError())
+        after = storage.getNode('')
+        self.assertFailure(after, RuntimeError)
+        return defer.gatherResults([d, before, after])
+
+
+    def test_writeBehind(self):
+        """
+        Changes are applied in memory right away, and written to the
+        database after the flush interval.
+        """
+        d = self.storage.createNode('test', OWNER, makeConfig())
+        self.assertTrue(d.called)
+        self.assertIn('test', self.storage._nodes)
+        self.assertEqual([], self.dbpool.interactions)
+
+        self.clock.advance(1.0)
+        self.assertEqual(['_createNode'], self.getBatch())
+
+
+    def test_groupCommit(self):
+        """
+        All pending changes are written in a single transaction.
+        """
+        self.storage.createNode('test', OWNER, makeConfig())
+        node = self.storage._nodes['test']
+        node.addSubscription(OWNER, 'subscribed', {})
+
+        self.clock.advance(1.0)
+        self.assertEqual(1, len(self.dbpool.interactions))
+        self.assertEqual(['_createNode', '_addSubscription'],
+                         self.getBatch())
+
+
+    def test_writeBehindRoot(self):
+        """
+        Changes to the root node are written to the database.
+        """
+        node = self.storage._nodes['']
+        node.addSubscription(SUBSCRIBER, 'subscribed', {})
+        node.setConfiguration({'pubsub#deliver_payloads': False})
+        node.removeSubscription(SUBSCRIBER)
+
+        self.clock.advance(1.0)
+        self.assertEqual(['_addSubscription', '_setConfiguration',
+                          '_removeSubscription'], self.getBatch())
+
+
+    def test_loadRoot(self):
+        """
+        The subscriptions to the root node are loaded back, and later
+        changes to it are written to the database.
+        """
+        cursor = LoadCursor(
+                [('', 'collection', None, True, 'on_sub')],
+                [],
+                [('', SUBSCRIBER.userhost(), SUBSCRIBER.resource,
+                  'subscribed', None, None)],
+                [])
+        self.storage._load(cursor)
+
+        node = self.storage._nodes['']
+        d = node.getSubscription(SUBSCRIBER)
+        d.addCallback(lambda subscription:
+                      self.assertEqual('subscribed', subscription.state))
+
+        node.removeSubscription(SUBSCRIBER)
+        self.clock.advance(1.0)
+        self.assertEqual(['_removeSubscription'], self.getBatch())
+        return d
+
+
+    def test_applyBatchNotify(self):
+        """
+        With notifyChanges, changes to nodes are recorded for the caches of
+        other instances, in the same transaction.
+        """
+        def apply(cursor):
+            pass
+
+        self.storage.notifyChanges = True
+        cursor = TestCursor()
+        self.storage._applyBatch(cursor, [(apply, (), 'test'),
+                                          (apply, (), None)])
+        self.assertEqual(['SAVEPOINT write_behind',
+                          'INSERT INTO node_changes (node) VALUES (%s)',
+                          'NOTIFY node_changes',
+                          'RELEASE SAVEPOINT write_behind',
+                          'SAVEPOINT write_behind',
+                          'RELEASE SAVEPOINT write_behind'],
+                         cursor.statements)
+
+
+    def test_writeChangeNode(self):
+        """
+        Changes to nodes are written with their node identifier.
+        """
+        self.storage.createNode('test', OWNER, makeConfig())
+        node = self.storage._nodes['test']
+        node.addSubscription(OWNER, 'subscribed', {})
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item1'
+        node.storeItems([item], PUBLISHER)
+        self.storage.flush()
+
+        interaction, args, d = self.dbpool.interactions[-1]
+        self.assertEqual(['test', 'test', None],
+                         [nodeIdentifier
+                          for operation, args, nodeIdentifier in args[0]])
+
+
+    def test_maxDirty(self):
+        """
+        When there are too many pending changes, they are flushed right
+        away, and the change that filled up the set waits for the commit.
+        """
+        for nodeIdentifier in ('test1', 'test2'):
+            d = self.storage.createNode(nodeIdentifier, OWNER, makeConfig())
+            self.assertTrue(d.called)
+
+        committed = []
+        d = self.storage.createNode('test3', OWNER, makeConfig())
+        d.addCallback(committed.append)
+        self.assertEqual([], committed)
+        self.assertEqual(['_createNode'] * 3, self.getBatch())
+
+        interaction, args, flushDeferred = self.dbpool.interactions[-1]
+        flushDeferred.callback(None)
+        self.assertEqual([None], committed)
+
+
+    def test_flushWhileFlushing(self):
+        """
+        A flush requested while flushing starts when the first completes.
+        """
+        self.storage.createNode('test1', OWNER, makeConfig())
+        d1 = self.storage.flush()
+        self.storage.createNode('test2', OWNER, makeConfig())
+        d2 = self.storage.flush()
+        self.assertEqual(1, len(self.dbpool.interactions))
+
+        interaction, args, flushDeferred = self.dbpool.interactions[0]
+        flushDeferred.callback(None)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        self.assertEqual(2, len(self.dbpool.interactions))
+        self.assertEqual(['_createNode'], self.getBatch())
+
+
+    def test_flushFailed(self):
+        """
+        If writing fails, the changes are retried after the flush interval.
+        """
+        self.storage.createNode('test', OWNER, makeConfig())
+        d = self.storage.flush()
+
+        interaction, args, flushDeferred = self.dbpool.interactions[-1]
+        flushDeferred.errback(RuntimeError())
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+        self.assertFalse(d.called)
+
+        self.clock.advance(1.0)
+        self.assertEqual(2, len(self.dbpool.interactions))
+        self.assertEqual(['_createNode'], self.getBatch())
+
+
+    def test_storeItemsDate(self):
+        """
+        Items are written with their time of publication in memory.
+        """
+        self.storage.createNode('test', OWNER, makeConfig())
+        node = self.storage._nodes['test']
+        item = domish.Element((None, 'item'))
+        item['id'] = 'item1'
+        node.storeItems([item], PUBLISHER)
+        self.storage.flush()
+
+        interaction, args, d = self.dbpool.interactions[-1]
+        operation, operationArgs, nodeIdentifier = args[0][-1]
+        self.assertEqual('_storeItem', operation.__name__)
+        self.assertEqual(node._items['item1'].date, operationArgs[-1])
+
+
+    def test_stop(self):
+        """
+        Stopping writes all pending changes, and no flush is scheduled.
+        """
+        self.storage.createNode('test', OWNER, makeConfig())
+        self.storage.stop()
+        self.assertEqual(['_createNode'], self.getBatch())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_applyBatch(self):
+        """
+        A change that fails is rolled back, without affecting the others.
+        """
+        applied = []
+
+        def fail(cursor):
+            raise RuntimeError()
+
+        def apply(cursor):
+            applied.append(cursor)
+
+        cursor = TestCursor()
+        self.storage._applyBatch(cursor, [(fail, (), None),
+                                          (apply, (), None)])
+        self.assertEqual([cursor], applied)
+        self.assertEqual(['SAVEPOINT write_behind',
+                          'ROLLBACK TO SAVEPOINT write_behind',
+                          'SAVEPOINT write_behind',
+                          'RELEASE SAVEPOINT write_behind'],
+                         cursor.statements)
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
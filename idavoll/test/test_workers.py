@@ -0,0 +1,145 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.workers}.
+"""
+
+import cPickle
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish import domish, utility
+
+from wokkel.pubsub import Subscription
+
+from idavoll import protocol, workers
+from idavoll.component import getShard
+
+SERVICE = JID('pubsub.example.org')
+
+def makeNotifications(count):
+    item = domish.Element((None, 'item'))
+    item['id'] = 'item1'
+    item.addElement(('testns', 'test'), content=u'Test \u2083 item')
+    items = [item]
+
+    notifications = []
+    for i in xrange(count):
+        subscriber = JID('user%d@example.org/home' % i)
+        nodeIdentifier = i % 2 and 'test' or ''
+        subscriptions = [Subscription(nodeIdentifier, subscriber,
+                                      'subscribed')]
+        notifications.append((subscriber, subscriptions, items))
+    return notifications
+
+
+
+class FakeComponent(object):
+
+    def __init__(self):
+        self.xmlstream = utility.EventDispatcher()
+
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.written = []
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.component = FakeComponent()
+        self.pool = workers.WorkerPool(self.component, '127.0.0.1', 5347,
+                                       SERVICE.full(), 'secret', 3)
+        self.jobs = [[] for worker in self.pool.workers]
+        for worker in self.pool.workers:
+            worker.sendJob = self.jobs[worker.index].append
+
+
+    def test_notifyPublish(self):
+        """
+        Each worker gets a job with the subscribers in its shard.
+        """
+        notifications = makeNotifications(20)
+        self.pool.notifyPublish(SERVICE, 'test', notifications)
+
+        for index, jobs in enumerate(self.jobs):
+            self.assertEqual(1, len(jobs))
+            serviceJID, nodeIdentifier, groups = cPickle.loads(jobs[0])
+            self.assertEqual(SERVICE.full(), serviceJID)
+            self.assertEqual('test', nodeIdentifier)
+            self.assertEqual(1, len(groups))
+            expected = [subscriber.full()
+                        for subscriber, subscriptions, items in notifications
+                        if getShard(subscriber.full(), 3) == index]
+            self.assertEqual(expected,
+                             [subscriber for subscriber, subscribedNodes
+                                         in groups[0][1]])
+
+
+    def test_notifyPublishEmptyShard(self):
+        """
+        Workers without subscribers to notify get no job.
+        """
+        notifications = makeNotifications(1)
+        self.pool.notifyPublish(SERVICE, 'test', notifications)
+        self.assertEqual(1, sum([len(jobs) for jobs in self.jobs]))
+
+
+    def test_queueJobs(self):
+        """
+        Jobs for a worker that isn't running are sent once it is.
+        """
+        worker = workers.WorkerProcess(self.pool, 0)
+        worker.sendJob('job')
+        transport = FakeTransport()
+        worker.makeConnection(transport)
+        self.assertEqual(['3:job,'], transport.written)
+
+
+    def test_stanzaReceived(self):
+        """
+        Stanzas received by workers are dispatched on the stream of the
+        component.
+        """
+        received = []
+        self.component.xmlstream.addObserver(
+                '/iq', lambda iq: received.append(iq))
+        worker = self.pool.workers[0]
+        worker.makeConnection(FakeTransport())
+        worker.outReceived("16:<iq type='get'/>,")
+        self.assertEqual(1, len(received))
+        self.assertEqual('get', received[0]['type'])
+
+
+
+class JobReceiverTest(unittest.TestCase):
+
+    def test_stringReceived(self):
+        """
+        A worker sends the same notifications as the service would.
+        """
+        notifications = makeNotifications(5)
+
+        expected = []
+        service = protocol.PubSubService()
+        service.sendBuffer.send = expected.append
+        service.notifyPublish(SERVICE, 'test', notifications)
+
+        sent = []
+        service = protocol.PubSubService()
+        service.sendBuffer.send = sent.append
+        receiver = workers.JobReceiver(service)
+        job = workers.makeJobs(SERVICE, 'test', notifications, 1)[0]
+        receiver.stringReceived(job)
+
+        self.assertEqual([message.toXml() for message in expected],
+                         [message.toXml() for message in sent])
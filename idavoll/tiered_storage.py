@@ -0,0 +1,482 @@
+# -*- test-case-name: idavoll.test.test_tiered_storage -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tiered storage, with a memory front and a PostgreSQL back.
+
+All reads are served from an in-memory model, as in
+L{idavoll.memory_storage}. Changes are applied to that model right away and
+written behind to the database of L{idavoll.pgsql_storage}, batched in a
+single transaction per flush. At startup, the memory model is loaded from
+the database.
+"""
+
+import copy
+import datetime
+
+from twisted.application import service
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.words.protocols.jabber import jid
+
+from wokkel.pubsub import Subscription
+
+from idavoll import memory_storage, pgsql_storage
+
+class Storage(memory_storage.Storage):
+    """
+    Memory storage that writes changes behind to PostgreSQL.
+
+    Pending changes are flushed every C{flushInterval} seconds. When the
+    number of pending changes reaches C{maxDirty}, they are flushed right
+    away, and the Deferreds for the changes that are added while that
+    flush is in progress only fire once these have been committed as well.
+    This bounds the amount of changes that can be lost, and slows down
+    publishers when the database can't keep up.
+
+    Storage methods that aren't bound to a node wait for L{load} to
+    complete.
+
+    @ivar dbpool: The database connection pool.
+    @type dbpool: L{twisted.enterprise.adbapi.ConnectionPool}
+    @ivar flushInterval: Maximum number of seconds changes are kept
+                         before being written to the database.
+    @type flushInterval: C{float}
+    @ivar maxDirty: Number of pending changes at which they are written to
+                    the database right away.
+    @type maxDirty: C{int}
+    @ivar clock: Provider of delayed calls, for scheduling flushes.
+    @type clock: L{IReactorTime<twisted.internet.interfaces.IReactorTime>}
+    @ivar notifyChanges: Whether changes to the configuration, affiliations
+                         and subscriptions of nodes are recorded for the
+                         node caches of other instances, see
+                         L{pgsql_storage.ChangeListener}.
+    @type notifyChanges: C{bool}
+    """
+
+    def __init__(self, dbpool, flushInterval=1.0, maxDirty=1000, clock=None,
+                       notifyChanges=False):
+        memory_storage.Storage.__init__(self)
+        self._nodes[''] = CollectionNode(self, '', jid.JID('localhost'),
+                                         self._nodes['']._config)
+        self.dbpool = dbpool
+        self.flushInterval = flushInterval
+        self.maxDirty = maxDirty
+        self.clock = clock or reactor
+        self.notifyChanges = notifyChanges
+
+        self._backing = pgsql_storage.Storage(dbpool)
+        self._loaded = False
+        self._loadFailure = None
+        self._loadWaiters = []
+        self._dirty = []
+        self._flushWaiters = []
+        self._flushing = False
+        self._flushCall = None
+
+
+    def load(self):
+        """
+        Load the memory model from the database.
+
+        @return: Deferred that fires when the model has been loaded.
+        """
+        def loaded(result):
+            self._loaded = True
+            waiters, self._loadWaiters = self._loadWaiters, []
+            for d in waiters:
+                d.callback(None)
+
+        def failed(failure):
+            self._loadFailure = failure
+            waiters, self._loadWaiters = self._loadWaiters, []
+            for d in waiters:
+                d.errback(failure)
+            return failure
+
+        d = self.dbpool.runInteraction(self._load)
+        d.addCallbacks(loaded, failed)
+        return d
+
+
+    def _load(self, cursor):
+        nodes = {}
+        placeholder = jid.internJID('localhost')
+
+        cursor.execute("""SELECT node, node_type, persist_items,
+                                 deliver_payloads, send_last_published_item
+                          FROM nodes""")
+        for (nodeIdentifier, nodeType, persistItems, deliverPayloads,
+             sendLastPublishedItem) in cursor.fetchall():
+            config = {'pubsub#deliver_payloads': deliverPayloads,
+                      'pubsub#send_last_published_item':
+                          sendLastPublishedItem}
+            if nodeType == 'leaf':
+                config['pubsub#persist_items'] = persistItems
+                node = self._makeLeafNode(nodeIdentifier, placeholder,
+                                          config)
+            else:
+                node = CollectionNode(self, nodeIdentifier, placeholder,
+                                      config)
+            node._affiliations = {}
+            nodes[nodeIdentifier] = node
+
+        cursor.execute("""SELECT node, jid, affiliation FROM nodes
+                          NATURAL JOIN affiliations
+                          NATURAL JOIN entities""")
+        for nodeIdentifier, entity, affiliation in cursor.fetchall():
+            nodes[nodeIdentifier]._affiliations[entity] = affiliation
+
+        cursor.execute("""SELECT node, jid, resource, state,
+                                 subscription_type, subscription_depth
+                          FROM nodes
+                          NATURAL JOIN subscriptions
+                          NATURAL JOIN entities""")
+        for (nodeIdentifier, entity, resource, state,
+             subscriptionType, subscriptionDepth) in cursor.fetchall():
+            if resource:
+                subscriber = jid.internJID('%s/%s' % (entity, resource))
+            else:
+                subscriber = jid.internJID(entity)
+
+            options = {}
+            if subscriptionType:
+                options['pubsub#subscription_type'] = subscriptionType
+            if subscriptionDepth:
+                options['pubsub#subscription_depth'] = subscriptionDepth
+
+            subscription = Subscription(nodeIdentifier, subscriber, state,
+                                        options)
+            nodes[nodeIdentifier]._subscriptions[subscriber.full()] = \
+                    subscription
+
+        cursor.execute("""SELECT node, item, publisher, data,
+                                 to_char(date AT TIME ZONE 'UTC',
+                                         'YYYY-MM-DD HH24:MI:SS.US')
+                          FROM nodes
+                          NATURAL JOIN items
+                          ORDER BY date, item_id""")
+        for (nodeIdentifier, itemIdentifier, publisher, data,
+             date) in cursor.fetchall():
+            node = nodes[nodeIdentifier]
+            date = datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f')
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            item = memory_storage.PublishedItem.fromData(
+                    itemIdentifier, data, jid.internJID(publisher), date)
+            node._items[itemIdentifier] = item
+            node._itemlist.append(item)
+
+        self._nodes = nodes
+        self._nodeIds = None
+        self._nodesChanged()
+
+
+    def _whenLoaded(self, f, *args):
+        """
+        Call C{f} with C{args} once the memory model has been loaded.
+
+        If loading failed, the returned Deferred fails with the same error.
+        """
+        if self._loaded:
+            return f(self, *args)
+        elif self._loadFailure is not None:
+            return defer.fail(self._loadFailure)
+
+        d = defer.Deferred()
+        d.addCallback(lambda _: f(self, *args))
+        self._loadWaiters.append(d)
+        return d
+
+
+    def getNode(self, nodeIdentifier):
+        return self._whenLoaded(memory_storage.Storage.getNode,
+                                nodeIdentifier)
+
+
+    def getNodeIds(self, after=None, maxNodes=None):
+        return self._whenLoaded(memory_storage.Storage.getNodeIds,
+                                after, maxNodes)
+
+
+    def getNodesVersion(self):
+        return self._whenLoaded(memory_storage.Storage.getNodesVersion)
+
+
+    def createNode(self, nodeIdentifier, owner, config):
+        d = self._whenLoaded(memory_storage.Storage.createNode,
+                             nodeIdentifier, owner, config)
+        d.addCallback(lambda _: self._writeChange(nodeIdentifier,
+                                                  self._backing._createNode,
+                                                  nodeIdentifier, owner,
+                                                  copy.copy(config)))
+        return d
+
+
+    def deleteNode(self, nodeIdentifier):
+        d = self._whenLoaded(memory_storage.Storage.deleteNode,
+                             nodeIdentifier)
+        d.addCallback(lambda _: self._writeChange(nodeIdentifier,
+                                                  self._backing._deleteNode,
+                                                  nodeIdentifier))
+        return d
+
+
+    def getAffiliations(self, entity):
+        return self._whenLoaded(memory_storage.Storage.getAffiliations,
+                                entity)
+
+
+    def getSubscriptions(self, entity):
+        return self._whenLoaded(memory_storage.Storage.getSubscriptions,
+                                entity)
+
+
+    def _makeLeafNode(self, nodeIdentifier, owner, config):
+        return LeafNode(self, nodeIdentifier, owner, config)
+
+
+    def _write(self, operation, *args):
+        """
+        Add a change to be written to the database.
+
+        @param operation: Callable that applies the change, given a database
+                          cursor and C{args}.
+        @return: Deferred that fires right away, or, if there are too many
+                 pending changes, when the change has been committed.
+        """
+        return self._writeChange(None, operation, *args)
+
+
+    def _writeChange(self, nodeIdentifier, operation, *args):
+        """
+        Add a change to the configuration, affiliations or subscriptions of
+        a node to be written to the database.
+
+        See L{_write}. If C{notifyChanges} is set, the change is recorded
+        for the node caches of other instances.
+        """
+        self._dirty.append((operation, args, nodeIdentifier))
+
+        if len(self._dirty) >= self.maxDirty:
+            return self.flush()
+
+        if self._flushCall is None:
+            self._flushCall = self.clock.callLater(self.flushInterval,
+                                                   self.flush)
+
+        return defer.succeed(None)
+
+
+    def flush(self):
+        """
+        Write all pending changes to the database.
+
+        @return: Deferred that fires when the changes have been committed.
+        """
+        d = defer.Deferred()
+        self._flushWaiters.append(d)
+
+        if not self._flushing:
+            self._flush()
+
+        return d
+
+
+    def _flush(self):
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        batch, self._dirty = self._dirty, []
+        waiters, self._flushWaiters = self._flushWaiters, []
+
+        def flushed(result):
+            self._flushing = False
+            for d in waiters:
+                d.callback(None)
+
+            # Flushes requested while this one was in progress.
+            if self._flushWaiters:
+                self._flush()
+
+        def failed(failure):
+            # Keep the changes, in order, to retry them with the next flush.
+            log.err(failure, "Writing changes to the database failed")
+            self._flushing = False
+            self._dirty[0:0] = batch
+            self._flushWaiters[0:0] = waiters
+            if self._flushCall is None:
+                self._flushCall = self.clock.callLater(self.flushInterval,
+                                                       self.flush)
+
+        if not batch:
+            flushed(None)
+            return
+
+        self._flushing = True
+        d = self.dbpool.runInteraction(self._applyBatch, batch)
+        d.addCallbacks(flushed, failed)
+
+
+    def _applyBatch(self, cursor, batch):
+        for operation, args, nodeIdentifier in batch:
+            # A change that fails because the database does not match the
+            # memory model should not prevent the others from being written.
+            cursor.execute("""SAVEPOINT write_behind""")
+            try:
+                operation(cursor, *args)
+                if self.notifyChanges and nodeIdentifier is not None:
+                    pgsql_storage._recordChange(cursor, nodeIdentifier)
+            except Exception:
+                cursor.execute("""ROLLBACK TO SAVEPOINT write_behind""")
+                log.err(None, "Writing a change to the database failed")
+            else:
+                cursor.execute("""RELEASE SAVEPOINT write_behind""")
+
+
+    def stop(self):
+        """
+        Stop scheduling flushes and write all pending changes.
+
+        @return: Deferred that fires when the changes have been committed.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        return self.flush()
+
+
+
+class WriteBehindMixin:
+    """
+    Mixin for nodes that write their changes behind through their storage.
+
+    @cvar backingClass: The class of the PostgreSQL node that writes the
+                        changes.
+    """
+
+    backingClass = None
+
+    def _getBacking(self):
+        return self.backingClass(self.nodeIdentifier, self._config)
+
+
+    def setConfiguration(self, options):
+        d = memory_storage.Node.setConfiguration(self, options)
+        d.addCallback(lambda _: self._storage._writeChange(
+            self.nodeIdentifier, self._getBacking()._setConfiguration,
+            copy.copy(self._config)))
+        return d
+
+
+    def addSubscription(self, subscriber, state, options):
+        d = memory_storage.Node.addSubscription(self, subscriber, state,
+                                                options)
+        d.addCallback(lambda _: self._storage._writeChange(
+            self.nodeIdentifier, self._getBacking()._addSubscription,
+            subscriber, state, options or {}))
+        return d
+
+
+    def removeSubscription(self, subscriber):
+        d = memory_storage.Node.removeSubscription(self, subscriber)
+        d.addCallback(lambda _: self._storage._writeChange(
+            self.nodeIdentifier, self._getBacking()._removeSubscription,
+            subscriber))
+        return d
+
+
+
+class LeafNode(WriteBehindMixin, memory_storage.LeafNode):
+    """
+    Leaf node that writes its changes behind through its storage.
+    """
+
+    backingClass = pgsql_storage.LeafNode
+
+    def __init__(self, storage, nodeIdentifier, owner, config):
+        memory_storage.LeafNode.__init__(self, nodeIdentifier, owner, config)
+        self._storage = storage
+
+
+    def storeItems(self, items, publisher):
+        d = memory_storage.LeafNode.storeItems(self, items, publisher)
+
+        def write(_):
+            # Store the items with the same dates as in the memory model,
+            # so that they are loaded back in the same order.
+            backing = self._getBacking()
+            dl = []
+            for element in items:
+                date = self._items[element["id"]].date
+                dl.append(self._storage._write(backing._storeItem, element,
+                                               publisher, date))
+            return defer.gatherResults(dl)
+
+        d.addCallback(write)
+        return d
+
+
+    def removeItems(self, itemIdentifiers):
+        d = memory_storage.LeafNode.removeItems(self, itemIdentifiers)
+
+        def write(deleted):
+            if not deleted:
+                return deleted
+
+            d = self._storage._write(self._getBacking()._removeItems,
+                                     deleted)
+            d.addCallback(lambda _: deleted)
+            return d
+
+        d.addCallback(write)
+        return d
+
+
+    def purge(self):
+        d = memory_storage.LeafNode.purge(self)
+        d.addCallback(lambda _: self._storage._write(
+            self._getBacking()._purge))
+        return d
+
+
+
+class CollectionNode(WriteBehindMixin, memory_storage.CollectionNode):
+    """
+    Collection node that writes its changes behind through its storage.
+    """
+
+    backingClass = pgsql_storage.CollectionNode
+
+    def __init__(self, storage, nodeIdentifier, owner, config):
+        memory_storage.CollectionNode.__init__(self, nodeIdentifier, owner,
+                                               config)
+        self._storage = storage
+
+
+
+class StorageService(service.Service):
+    """
+    Service that loads the tiered storage at startup, and writes all
+    pending changes at shutdown.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+
+    def startService(self):
+        service.Service.startService(self)
+        d = self.storage.load()
+        d.addErrback(log.err, "Loading the storage failed")
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return self.storage.stop()
@@ -0,0 +1,304 @@
+# -*- test-case-name: idavoll.test.test_workers -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Worker processes that send notifications over connections of their own.
+
+The main process passes the notifications of a publish to the workers as
+jobs, one per worker, each with the subscribers in its shard (see
+L{getShard<idavoll.component.getShard>}). A worker has its own component
+connection to the server, under the same JID as the main process, and
+creates, serializes and sends the notifications of its jobs. Stanzas that
+the server sends to a worker's connection are passed back to the main
+process, to be handled there.
+
+Jobs and stanzas are passed as netstrings over the standard input and
+output of the worker.
+
+A worker is run as C{python -m idavoll.workers host port jid}, with the
+component secret in the C{IDAVOLL_SECRET} environment variable.
+"""
+
+import cPickle
+import os
+import sys
+
+from twisted.application import service
+from twisted.internet import protocol, reactor
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+from twisted.words.protocols.jabber.jid import internJID
+from twisted.words.xish import domish
+
+from wokkel.generic import parseXml
+from wokkel.pubsub import Subscription
+from wokkel.subprotocols import XMPPHandler
+
+from idavoll.component import getShard
+
+def _toNetstring(data):
+    return '%d:%s,' % (len(data), data)
+
+
+
+def _serializeItems(items):
+    serialized = []
+    for item in items:
+        if isinstance(item, domish.SerializedXML):
+            serialized.append(unicode(item))
+        else:
+            serialized.append(item.toXml())
+    return u''.join(serialized)
+
+
+
+def makeJobs(service, nodeIdentifier, notifications, count):
+    """
+    Split the notifications of a publish into a job for each worker.
+
+    The items are serialized once for all subscribers that are notified of
+    the same list of items.
+
+    @param count: The number of workers.
+    @type count: C{int}
+    @return: The job for each worker, or C{None} for workers that have
+             no subscribers to notify.
+    @rtype: C{list} of C{str}
+    """
+    serialized = {}
+    groups = [{} for i in xrange(count)]
+    for subscriber, subscriptions, items in notifications:
+        if id(items) not in serialized:
+            serialized[id(items)] = _serializeItems(items)
+
+        index = getShard(subscriber.full(), count)
+        recipients = groups[index].setdefault(id(items), [])
+        recipients.append((subscriber.full(),
+                           [subscription.nodeIdentifier
+                            for subscription in subscriptions]))
+
+    jobs = []
+    for group in groups:
+        if group:
+            job = (service.full(), nodeIdentifier,
+                   [(serialized[key], recipients)
+                    for key, recipients in group.iteritems()])
+            jobs.append(cPickle.dumps(job, cPickle.HIGHEST_PROTOCOL))
+        else:
+            jobs.append(None)
+
+    return jobs
+
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    The connection of the main process with a worker.
+
+    Jobs are queued while the worker is not running.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self._queue = []
+        self._stanzas = NetstringReceiver()
+        self._stanzas.stringReceived = self.pool.stanzaReceived
+        self._stanzas.MAX_LENGTH = 2 ** 24
+        self.connected = False
+
+
+    def connectionMade(self):
+        self.connected = True
+        self._stanzas.makeConnection(self.transport)
+        for job in self._queue:
+            self.transport.write(_toNetstring(job))
+        self._queue = []
+
+
+    def sendJob(self, job):
+        if self.connected:
+            self.transport.write(_toNetstring(job))
+        else:
+            self._queue.append(job)
+
+
+    def outReceived(self, data):
+        self._stanzas.dataReceived(data)
+
+
+    def errReceived(self, data):
+        for line in data.splitlines():
+            log.msg("Worker %d: %s" % (self.index, line))
+
+
+    def processEnded(self, reason):
+        self.connected = False
+        self.pool.workerEnded(self)
+
+
+
+class WorkerPool(service.Service):
+    """
+    Pool of worker processes that send notifications.
+
+    Workers that end while the pool is running are started again after
+    C{restartDelay} seconds.
+
+    @ivar component: The component of the main process, that handles the
+                     stanzas received by the workers.
+    @type component: L{StreamManager<wokkel.subprotocols.StreamManager>}
+    @ivar workers: The connections with the workers.
+    @type workers: C{list} of L{WorkerProcess}
+    """
+
+    restartDelay = 1
+
+    def __init__(self, component, host, port, jid, password, workers=2):
+        self.component = component
+        self.host = host
+        self.port = port
+        self.jid = jid
+        self.password = password
+        self.workers = [WorkerProcess(self, index)
+                        for index in xrange(workers)]
+
+
+    def startService(self):
+        service.Service.startService(self)
+        for worker in self.workers:
+            self._spawn(worker)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for worker in self.workers:
+            if worker.connected:
+                worker.transport.closeStdin()
+
+
+    def _spawn(self, worker):
+        env = dict(os.environ)
+        env['IDAVOLL_SECRET'] = self.password
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        reactor.spawnProcess(worker, sys.executable,
+                             [sys.executable, '-m', 'idavoll.workers',
+                              self.host, str(self.port), self.jid],
+                             env=env)
+
+
+    def workerEnded(self, worker):
+        if self.running:
+            log.msg("Worker %d ended, restarting" % worker.index)
+            reactor.callLater(self.restartDelay, self._spawn, worker)
+
+
+    def notifyPublish(self, service, nodeIdentifier, notifications):
+        """
+        Pass the notifications of a publish to the workers.
+        """
+        jobs = makeJobs(service, nodeIdentifier, notifications,
+                        len(self.workers))
+        for worker, job in zip(self.workers, jobs):
+            if job is not None:
+                worker.sendJob(job)
+
+
+    def stanzaReceived(self, data):
+        """
+        Handle a stanza received by a worker, as if received by the
+        component of the main process.
+        """
+        xs = self.component.xmlstream
+        if xs is not None:
+            xs.dispatch(parseXml(data))
+
+
+
+class JobReceiver(NetstringReceiver):
+    """
+    Receiver of jobs, in a worker.
+
+    @ivar service: The service that sends the notifications.
+    @type service: L{PubSubService<idavoll.protocol.PubSubService>}
+    """
+
+    MAX_LENGTH = 2 ** 30
+
+    def __init__(self, service):
+        self.service = service
+
+
+    def stringReceived(self, data):
+        serviceJID, nodeIdentifier, groups = cPickle.loads(data)
+
+        notifications = []
+        for serialized, recipients in groups:
+            items = [domish.SerializedXML(serialized)]
+            for subscriber, subscribedNodes in recipients:
+                subscriber = internJID(subscriber)
+                subscriptions = [Subscription(subscribedNode, subscriber,
+                                              'subscribed')
+                                 for subscribedNode in subscribedNodes]
+                notifications.append((subscriber, subscriptions, items))
+
+        self.service.notifyPublish(internJID(serviceJID), nodeIdentifier,
+                                   notifications)
+
+
+    def sendStanza(self, element):
+        """
+        Pass a stanza received by the worker on to the main process.
+        """
+        self.sendString(element.toXml().encode('utf-8'))
+
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+
+class RelayHandler(XMPPHandler):
+    """
+    Handler that passes all stanzas received by a worker to a receiver.
+    """
+
+    def __init__(self, receiver):
+        XMPPHandler.__init__(self)
+        self.receiver = receiver
+
+
+    def connectionInitialized(self):
+        self.xmlstream.addObserver('/*', self.receiver.sendStanza)
+
+
+
+def main(host, port, jid):
+    from twisted.internet import stdio
+    from wokkel.component import Component
+    from idavoll.protocol import PubSubService
+
+    log.startLogging(sys.stderr)
+
+    cs = Component(host, int(port), jid, os.environ['IDAVOLL_SECRET'])
+    cs.factory.maxDelay = 900
+
+    # The service is not a handler of the component, as requests are
+    # handled by the main process.
+    ps = PubSubService()
+    ps.send = cs.send
+
+    receiver = JobReceiver(ps)
+    RelayHandler(receiver).setHandlerParent(cs)
+    stdio.StandardIO(receiver)
+
+    cs.startService()
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -53,7 +53,9 @@ setup(name='idavoll',
                                         'twisted/plugins/idavoll_http.py']},
       data_files=[('share/idavoll', ['db/pubsub.sql',
                                      'db/gateway.sql',
+                                     'db/gateway_to_idavoll_0.10.sql',
                                      'db/to_idavoll_0.8.sql',
+                                     'db/to_idavoll_0.10.sql',
                                      'doc/examples/idavoll.tac',
                                      ])],
       zip_safe=False,